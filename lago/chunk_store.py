@@ -0,0 +1,261 @@
+"""
+Content addressed store of disk image blocks, used to export disks that
+share most of their data, like all the disks of an environment that were
+created from the same templates, without storing the shared data more than
+once.
+
+The images are split in fixed size blocks, and each block is stored once, in
+a file named after its sha256, under the ``chunks`` dir of the export. Each
+image is described by a manifest, a json file with the list of the blocks of
+the image, in order, and the format it should be rebuilt as. Blocks of zeros
+are not stored, so the rebuilt images are sparse.
+"""
+from __future__ import absolute_import
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from . import log_utils, utils
+
+LOGGER = logging.getLogger(__name__)
+LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
+#: Size of the blocks the images are split in
+BLOCK_SIZE = 1024 * 1024
+#: Name of the dir the blocks are stored in, next to the manifests
+CHUNKS_DIR = 'chunks'
+#: Extension of the manifest files
+MANIFEST_SUFFIX = '.manifest'
+#: Version of the manifest format
+MANIFEST_VERSION = 1
+#: Image formats that are stored as they are, without any conversion
+RAW_FORMATS = ('raw', 'iso')
+
+
+class ChunkStore(object):
+    """
+    Directory of blocks, each one stored in a file named after its sha256.
+    Several exports can write to the same store at the same time.
+
+    Attributes:
+        path (str): Path to the store dir
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def __contains__(self, digest):
+        return os.path.exists(self._chunk_path(digest))
+
+    def add(self, data):
+        """
+        Store the given block, unless it's already in the store
+
+        Args:
+            data (bytes): Block to store
+
+        Returns:
+            str: sha256 hex digest of the block
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in self:
+            return digest
+
+        chunk_dir = os.path.dirname(self._chunk_path(digest))
+        os.makedirs(chunk_dir, exist_ok=True)
+        # write it under a temporary name, so a block is never seen partially
+        # written by a concurrent export of the same block
+        fd, tmp_path = tempfile.mkstemp(dir=chunk_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as chunk_fd:
+                chunk_fd.write(data)
+            os.rename(tmp_path, self._chunk_path(digest))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        return digest
+
+    def get(self, digest):
+        """
+        Args:
+            digest (str): sha256 hex digest of the block
+
+        Returns:
+            bytes: The block
+
+        Raises:
+            ChunkStoreError: If the block is missing or corrupted
+        """
+        try:
+            with open(self._chunk_path(digest), 'rb') as chunk_fd:
+                data = chunk_fd.read()
+        except (IOError, OSError) as err:
+            raise ChunkStoreError(
+                'Block {} is missing from {}: {}'.format(
+                    digest, self.path, err
+                )
+            )
+
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ChunkStoreError(
+                'Block {} in {} is corrupted'.format(digest, self.path)
+            )
+        return data
+
+
+def is_manifest(path):
+    """
+    Args:
+        path (str): Path of a disk image
+
+    Returns:
+        bool: True if the given path is the manifest of a chunked image
+    """
+    return path.endswith(MANIFEST_SUFFIX)
+
+
+def store_for(manifest_path):
+    """
+    Args:
+        manifest_path (str): Path to a manifest
+
+    Returns:
+        ChunkStore: The store the blocks of the manifest are in
+    """
+    return ChunkStore(os.path.join(os.path.dirname(manifest_path), CHUNKS_DIR))
+
+
+def write_image(image_path, manifest_path, image_format, checksum='sha1'):
+    """
+    Split the given raw image in blocks, add them to the store next to the
+    manifest, and write the manifest
+
+    Args:
+        image_path (str): Path to the raw image
+        manifest_path (str): Path to write the manifest to
+        image_format (str): Format the image should be rebuilt as
+        checksum (str): Hash to calculate for the whole image, one of the
+            supported by hashlib
+
+    Returns:
+        str: hex digest of the whole image
+    """
+    store = store_for(manifest_path)
+    image_hash = getattr(hashlib, checksum)()
+    chunks = []
+    with open(image_path, 'rb') as image_fd:
+        for block in iter(functools.partial(image_fd.read, BLOCK_SIZE), b''):
+            image_hash.update(block)
+            if block.count(b'\0') == len(block):
+                chunks.append(None)
+            else:
+                chunks.append(store.add(block))
+
+        size = image_fd.tell()
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'format': image_format,
+        'size': size,
+        'block_size': BLOCK_SIZE,
+        checksum: image_hash.hexdigest(),
+        'chunks': chunks,
+    }
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'wt') as manifest_fd:
+        json.dump(manifest, manifest_fd)
+    os.rename(tmp_path, manifest_path)
+
+    return image_hash.hexdigest()
+
+
+def read_manifest(manifest_path):
+    """
+    Args:
+        manifest_path (str): Path to the manifest
+
+    Returns:
+        dict: The manifest
+
+    Raises:
+        ChunkStoreError: If the manifest is of an unsupported version
+    """
+    with open(manifest_path) as manifest_fd:
+        manifest = json.load(manifest_fd)
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ChunkStoreError(
+            'Unsupported version {} of manifest {}'.format(
+                manifest.get('version'), manifest_path
+            )
+        )
+    return manifest
+
+
+def rebuild_image(manifest_path, dest, image_format=None):
+    """
+    Write the image described by the given manifest
+
+    Args:
+        manifest_path (str): Path to the manifest
+        dest (str): Path to write the image to
+        image_format (str or None): Format to write the image in, the one in
+            the manifest if not passed
+
+    Returns:
+        str: Format of the written image
+
+    Raises:
+        ChunkStoreError: If any of the blocks is missing or corrupted
+    """
+    manifest = read_manifest(manifest_path)
+    store = store_for(manifest_path)
+    image_format = image_format or manifest['format']
+    raw_path = dest if image_format in RAW_FORMATS else dest + '.raw'
+
+    with LogTask('Rebuild {} from {}'.format(dest, manifest_path)):
+        with utils.RollbackContext() as rollback:
+            rollback.prependDefer(_remove, dest)
+            rollback.prependDefer(_remove, raw_path)
+
+            with open(raw_path, 'wb') as image_fd:
+                # blocks of zeros are left as holes
+                image_fd.truncate(manifest['size'])
+                for idx, digest in enumerate(manifest['chunks']):
+                    if digest is not None:
+                        os.pwrite(
+                            image_fd.fileno(),
+                            store.get(digest),
+                            idx * manifest['block_size'],
+                        )
+
+            if raw_path != dest:
+                utils.qemu_convert(
+                    source=raw_path,
+                    target=dest,
+                    target_format=image_format,
+                    source_format='raw',
+                )
+                _remove(raw_path)
+
+            rollback.clear()
+
+    return image_format
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class ChunkStoreError(utils.LagoException):
+    pass
@@ -22,6 +22,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import argparse
+import datetime
 import logging
 import os
 import pkg_resources
@@ -33,8 +34,10 @@ from signal import signal, SIGTERM, SIGHUP
 import six
 
 import lago
+import lago.compression
 import lago.plugins
 import lago.plugins.cli
+import lago.plugins.vm
 import lago.templates
 from lago.config import config
 from lago import (log_utils, workdir as lago_workdir, utils, lago_ansible)
@@ -86,6 +89,29 @@ in_lago_prefix = in_prefix(
     help='Location to store templates at',
     type=os.path.abspath,
 )
+@lago.plugins.cli.cli_plugin_add_argument(
+    '--template-store-quota',
+    help=(
+        'Maximum size of the template store (for example 50G), least '
+        'recently used templates will be evicted after downloading new ones'
+    ),
+)
+@lago.plugins.cli.cli_plugin_add_argument(
+    '--template-store-format',
+    help=(
+        'Format to keep the templates in the store, sparse raw, qcow2 or '
+        'compressed qcow2'
+    ),
+    choices=sorted(lago.templates.STORE_FORMATS),
+)
+@lago.plugins.cli.cli_plugin_add_argument(
+    '--template-store-share-layers',
+    action='store_true',
+    help=(
+        'If passed, layered templates whose base is already in the store '
+        'are kept as a thin layer on top of it, instead of being flattened'
+    ),
+)
 @lago.plugins.cli.cli_plugin_add_argument(
     '--template-repos',
     help='Location to store repos',
@@ -120,6 +146,9 @@ def do_init(
     template_repo_path=None,
     template_repo_name=None,
     template_store=None,
+    template_store_quota=None,
+    template_store_format='raw',
+    template_store_share_layers=False,
     template_repos=None,
     set_current=False,
     skip_bootstrap=False,
@@ -178,7 +207,8 @@ def do_init(
                 )
             elif template_repo_name:
                 repo = lago.templates.find_repo_by_name(
-                    name=template_repo_name
+                    name=template_repo_name,
+                    repo_dir=template_repos,
                 )
 
             else:
@@ -186,7 +216,12 @@ def do_init(
                     'No template repo was configured or specified'
                 )
 
-            store = lago.templates.TemplateStore(template_store)
+            store = lago.templates.TemplateStore(
+                template_store,
+                quota=template_store_quota,
+                image_format=template_store_format,
+                share_layers=utils.str_to_bool(template_store_share_layers),
+            )
 
             with open(virt_config, 'r') as virt_fd:
                 prefix.virt_conf_from_stream(
@@ -207,6 +242,50 @@ def do_init(
         return workdir, prefix
 
 
+@lago.plugins.cli.cli_plugin(help='Manage the local template store')
+@lago.plugins.cli.cli_plugin_add_argument(
+    'action',
+    help=(
+        'list: show the stored templates, gc: evict the least recently used '
+        'templates that no prefix uses, until the store fits in the quota'
+    ),
+    choices=['list', 'gc'],
+)
+@lago.plugins.cli.cli_plugin_add_argument(
+    '--template-store',
+    help='Location of the template store, defaults to the init one',
+    type=os.path.abspath,
+)
+@lago.plugins.cli.cli_plugin_add_argument(
+    '--quota',
+    help=(
+        'Maximum size of the template store (for example 50G), defaults to '
+        'the init template-store-quota'
+    ),
+)
+def do_store(action, out_format, template_store=None, quota=None, **kwargs):
+    init_config = config.get_section('init', {})
+    store = lago.templates.TemplateStore(
+        template_store or init_config.get('template_store')
+    )
+
+    if action == 'list':
+        templates = store.list()
+        for entry in templates.values():
+            if entry['last_access'] is not None:
+                entry['last_access'] = datetime.datetime.fromtimestamp(
+                    entry['last_access']
+                ).isoformat()
+        print(out_format.format(templates))
+
+    elif action == 'gc':
+        quota = quota or init_config.get('template_store_quota')
+        if not quota:
+            raise LagoUserException('No template store quota configured')
+
+        print(out_format.format({'evicted': store.gc(quota)}))
+
+
 @lago.plugins.cli.cli_plugin(help='Clean up deployed resources')
 @in_lago_prefix
 @with_logging
@@ -338,8 +417,35 @@ def do_shutdown(prefix, vm_names, reboot, **kwargs):
 @lago.plugins.cli.cli_plugin_add_argument(
     '--compress',
     '-c',
-    help='If specified, compress the exported images with xz',
+    help='If specified, compress the exported images',
+    action='store_true',
+)
+@lago.plugins.cli.cli_plugin_add_argument(
+    '--compression',
+    help=(
+        'Codec to compress the exported images with, implies --compress. '
+        'Defaults to the export_compression setting (xz)'
+    ),
+    choices=list(lago.compression.CODECS),
+)
+@lago.plugins.cli.cli_plugin_add_argument(
+    '--chunked',
     action='store_true',
+    help=(
+        'Export the disks into a chunk store shared by all of them, with a '
+        'manifest for each disk, so the data they share is stored once. '
+        'Disks with any number of layers can be exported this way, '
+        '--standalone and --compress do not apply'
+    ),
+)
+@lago.plugins.cli.cli_plugin_add_argument(
+    '--since',
+    metavar='SNAPSHOT',
+    help=(
+        'Export only the changes made to the disks since the given snapshot, '
+        'each as a qcow2 layer on top of the image the disk had then, which '
+        'should be placed next to it. --standalone does not apply'
+    ),
 )
 @lago.plugins.cli.cli_plugin_add_argument(
     '--dst-dir',
@@ -365,12 +471,21 @@ def do_shutdown(prefix, vm_names, reboot, **kwargs):
 @in_lago_prefix
 @with_logging
 def do_export(
-    prefix, vm_names, standalone, dst_dir, compress, init_file_name,
-    out_format, collect_only, without_threads, **kwargs
+    prefix, vm_names, standalone, dst_dir, compress, compression, chunked,
+    since, init_file_name, out_format, collect_only, without_threads, **kwargs
 ):
     output = prefix.export_vms(
-        vm_names, standalone, dst_dir, compress, init_file_name, out_format,
-        collect_only, not without_threads
+        vm_names,
+        standalone,
+        dst_dir,
+        compress or bool(compression),
+        init_file_name,
+        out_format,
+        collect_only,
+        not without_threads,
+        compression,
+        chunked,
+        since,
     )
     if collect_only:
         print(out_format.format(output))
@@ -417,6 +532,9 @@ def do_revert(prefix, snapshot_name, **kwargs):
     prefix.revert_snapshots(snapshot_name)
 
 
+SHELL_SELECTORS = ('group:', 'vm-type:')
+
+
 @lago.plugins.cli.cli_plugin(
     help='Open shell on the domain or run as script/command',
     prefix_chars='\x00',
@@ -434,13 +552,20 @@ def do_revert(prefix, snapshot_name, **kwargs):
 )
 @lago.plugins.cli.cli_plugin_add_argument(
     'host',
-    help='Host to connect to',
+    help=(
+        'Host to connect to. To run a command or script on several hosts '
+        'at once, pass --all, or a comma separated list of host names, '
+        'group:GROUP and vm-type:VM_TYPE selectors'
+    ),
     metavar='HOST',
 )
 @in_lago_prefix
 @with_logging
 def do_shell(prefix, host, args=None, **kwargs):
     args = args or []
+    if host == '--all' or ',' in host or host.startswith(SHELL_SELECTORS):
+        return _fan_out_shell(prefix, host, args)
+
     try:
         host = prefix.virt_env.get_vm(host)
     except KeyError:
@@ -479,6 +604,49 @@ def do_shell(prefix, host, args=None, **kwargs):
     sys.exit(result.code)
 
 
+def _fan_out_shell(prefix, selector, args):
+    if not args:
+        raise utils.LagoUserException(
+            'A command or a script is needed to run on several hosts'
+        )
+
+    names, groups, vm_types = [], [], []
+    if selector != '--all':
+        for item in selector.split(','):
+            if item.startswith('group:'):
+                groups.append(item[len('group:'):])
+            elif item.startswith('vm-type:'):
+                vm_types.append(item[len('vm-type:'):])
+            else:
+                names.append(item)
+
+    if len(args) == 1 and os.path.isfile(args[0]):
+        command, script = None, args[0]
+    else:
+        command, script = args[1:] if args[0] == '-c' else args, None
+
+    failed = False
+    for name, result in prefix.exec_on_vms(
+        command=command,
+        script=script,
+        names=names,
+        groups=groups,
+        vm_types=vm_types,
+    ):
+        for stream, data in (
+            (sys.stdout, result.out),
+            (sys.stderr, result.err)
+        ):
+            for line in data.decode('utf-8', 'replace').splitlines():
+                stream.write('{}: {}\n'.format(name, line))
+            stream.flush()
+        if result.code != 0:
+            LOGGER.error('%s: exited with %d', name, result.code)
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
 @lago.plugins.cli.cli_plugin(
     help='Open serial console to the domain',
 )
@@ -578,51 +746,54 @@ def do_status(prefix, out_format, **kwargs):
     with open(prefix.paths.uuid()) as f:
         uuid = f.read()
 
-    info_dict = {
-        'Prefix':
-            {
-                'Base directory':
-                    prefix.paths.prefix_path(),
-                'UUID':
-                    uuid,
-                'Networks':
-                    dict(
-                        (
-                            net.name(), {
-                                'gateway': net.gw(),
-                                'status': net.alive() and 'up' or 'down',
-                                'management': net.is_management(),
-                            }
-                        ) for net in prefix.virt_env.get_nets().values()
-                    ),
-                'VMs':
-                    dict(
-                        (
-                            vm.name(), {
-                                'distro':
-                                    vm.distro(),
-                                'root password':
-                                    vm.root_password(),
-                                'status':
-                                    vm.state(),
-                                'snapshots':
-                                    ', '.join(vm._spec['snapshots'].keys()),
-                                'metadata':
-                                    vm.metadata,
-                                'NICs':
-                                    dict(
-                                        (
-                                            'eth%d' % i, {
-                                                'network': nic['net'],
-                                                'ip': nic.get('ip', 'N/A'),
-                                            }
-                                        ) for i, nic in enumerate(vm.nics())
-                                    ),
-                            }
-                        ) for vm in prefix.virt_env.get_vms().values()
-                    ),
-            },
-    }
+    with prefix.virt_env.state_snapshot():
+        info_dict = {
+            'Prefix':
+                {
+                    'Base directory':
+                        prefix.paths.prefix_path(),
+                    'UUID':
+                        uuid,
+                    'Networks':
+                        dict(
+                            (
+                                net.name(), {
+                                    'gateway': net.gw(),
+                                    'status': net.alive() and 'up' or 'down',
+                                    'management': net.is_management(),
+                                }
+                            ) for net in prefix.virt_env.get_nets().values()
+                        ),
+                    'VMs':
+                        dict(
+                            (
+                                vm.name(), {
+                                    'distro':
+                                        vm.distro(),
+                                    'root password':
+                                        vm.root_password(),
+                                    'status':
+                                        vm.state(),
+                                    'snapshots':
+                                        ', '
+                                        .join(vm._spec['snapshots'].keys()),
+                                    'metadata':
+                                        vm.metadata,
+                                    'NICs':
+                                        dict(
+                                            (
+                                                'eth%d' % i, {
+                                                    'network': nic['net'],
+                                                    'ip': nic.get('ip', 'N/A'),
+                                                }
+                                            )
+                                            for i, nic in enumerate(vm.nics())
+                                        ),
+                                }
+                            ) for vm in prefix.virt_env.get_vms().values()
+                        ),
+                },
+        }
 
     print(out_format.format(info_dict))
 
@@ -749,10 +920,33 @@ def do_copy_to_vm(prefix, host, remote_path, local_path, **kwargs):
     help='do not skip missing paths',
     action='store_true',
 )
+@lago.plugins.cli.cli_plugin_add_argument(
+    '--compression',
+    help=(
+        'How to compress the artifacts while they are transferred, auto '
+        'picks the fastest one available'
+    ),
+    choices=lago.plugins.vm.COLLECT_COMPRESSIONS,
+)
+@lago.plugins.cli.cli_plugin_add_argument(
+    '--incremental',
+    help=(
+        'If the output path holds a previous collection, transfer only the '
+        'files that changed since, and hard link the rest from it'
+    ),
+    action='store_true',
+)
 @in_lago_prefix
 @with_logging
-def do_collect(prefix, output, no_skip, **kwargs):
-    prefix.collect_artifacts(output, ignore_nopath=not no_skip)
+def do_collect(
+    prefix, output, no_skip, compression=None, incremental=False, **kwargs
+):
+    prefix.collect_artifacts(
+        output,
+        ignore_nopath=not no_skip,
+        compression=compression,
+        incremental=incremental,
+    )
 
 
 @lago.plugins.cli.cli_plugin(
@@ -885,6 +1079,15 @@ def create_parser(cli_plugins, out_plugins):
         action='store',
         help='Path to store created subnets configurations'
     )
+    parser.add_argument(
+        '--subnet_pools',
+        action='store',
+        help=(
+            'Comma separated supernet:prefix_length pools to lease the '
+            'subnets of the NAT networks from, for example 10.64.0.0/12:26. '
+            'Defaults to the /24 subnets of 192.168.200.0-192.168.255.0'
+        ),
+    )
     parser.add_argument(
         '--reposync-dir',
         action='store',
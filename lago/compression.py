@@ -0,0 +1,413 @@
+"""
+Compression formats that disks can be exported with, and templates can be
+retrieved in.
+
+Each format is handled by a :class:`Codec`, registered in :data:`CODECS` by
+name. Codecs can be looked up by name (as given in the config, and recorded
+in the ``.metadata`` of the exported disks), by file extension, or by the
+magic bytes their streams start with.
+"""
+from __future__ import absolute_import
+
+import functools
+import logging
+import lzma
+import shutil
+import subprocess
+import sys
+import threading
+import zlib
+
+import six
+
+from . import utils
+from .config import config
+
+LOGGER = logging.getLogger(__name__)
+#: Maximum size of the decompressed chunks passed on at once
+CHUNK_SIZE = 1024 * 1024
+
+
+class Codec(object):
+    """
+    Base class for the compression formats
+
+    Attributes:
+        name (str): Name of the format
+        extension (str): File extension of the format, including the dot
+        magic (bytes): Bytes each stream of the format starts with
+    """
+    name = None
+    extension = None
+    magic = None
+
+    def compress_cmd(self, threads=0, block_size=None):
+        """
+        Args:
+            threads (int): How many threads to use, 0 for one per core
+            block_size (int or None): Size of the independently compressed
+                blocks, for the formats that support it
+
+        Returns:
+            list of str: Command that compresses its stdin to its stdout
+        """
+        raise NotImplementedError()
+
+    def decompress_cmd(self):
+        """
+        Returns:
+            list of str: Command that decompresses its stdin to its stdout
+        """
+        raise NotImplementedError()
+
+    def decompressor(self, sink):
+        """
+        Args:
+            sink (callable): Called with each chunk of decompressed data
+
+        Returns:
+            StreamDecompressor or PipeDecompressor: Streaming decompressor
+                for this format
+        """
+        return PipeDecompressor(self.decompress_cmd(), sink)
+
+    def compress(self, src, dst, threads=0, block_size=None):
+        """
+        Compress the given file
+
+        Args:
+            src (str): Path of the file to compress
+            dst (str): Path to write the compressed file to
+            threads (int): How many threads to use, 0 for one per core
+            block_size (int or None): Size of the independently compressed
+                blocks, for the formats that support it
+
+        Raises:
+            RuntimeError: If the compression failed
+        """
+        _run_pipe(self.compress_cmd(threads, block_size), src, dst)
+
+    def decompress(self, src, dst):
+        """
+        Decompress the given file
+
+        Args:
+            src (str): Path of the file to decompress
+            dst (str): Path to write the decompressed file to
+
+        Raises:
+            RuntimeError: If the decompression failed
+        """
+        _run_pipe(self.decompress_cmd(), src, dst)
+
+
+class XzCodec(Codec):
+    name = 'xz'
+    extension = '.xz'
+    magic = b'\xfd7zXZ\x00'
+
+    def compress_cmd(self, threads=0, block_size=None):
+        cmd = [
+            'xz', '--compress', '--threads={}'.format(threads), '--best',
+            '--stdout'
+        ]
+        if block_size:
+            cmd.append('--block-size={}'.format(block_size))
+        return cmd
+
+    def decompress_cmd(self):
+        return ['xz', '--decompress', '--threads=0', '--stdout']
+
+    def decompressor(self, sink):
+        return LZMADecompressor(sink)
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    extension = '.zst'
+    magic = b'\x28\xb5\x2f\xfd'
+
+    def compress_cmd(self, threads=0, block_size=None):
+        return ['zstd', '-q', '-10', '-T{}'.format(threads), '--stdout']
+
+    def decompress_cmd(self):
+        return ['zstd', '-q', '--decompress', '--stdout']
+
+
+class GzipCodec(Codec):
+    """
+    gzip, compressed with pigz, which uses all the cores, if it's installed
+    """
+    name = 'gzip'
+    extension = '.gz'
+    magic = b'\x1f\x8b'
+
+    def compress_cmd(self, threads=0, block_size=None):
+        if shutil.which('pigz'):
+            cmd = ['pigz', '--stdout']
+            if threads:
+                cmd.extend(['--processes', str(threads)])
+            return cmd
+        return ['gzip', '--stdout']
+
+    def decompress_cmd(self):
+        return ['gzip', '--decompress', '--stdout']
+
+    def decompressor(self, sink):
+        return ZlibDecompressor(sink)
+
+
+class StreamDecompressor(object):
+    """
+    Decompresses a stream in process, as its data comes in.
+
+    The stream can be made of several concatenated streams, maybe with some
+    null padding in between. The output of each step is bounded, as a few
+    compressed bytes can expand to a lot of zeros.
+    """
+
+    def __init__(self, sink):
+        """
+        Args:
+            sink (callable): Called with each chunk of decompressed data
+        """
+        self._sink = sink
+        self._decompressor = self._new()
+
+    def _new(self):
+        raise NotImplementedError()
+
+    def _step(self, data):
+        """
+        Decompress the next chunk of data
+
+        Args:
+            data (bytes): Compressed data
+
+        Returns:
+            bytes or None: Data left to decompress, or ``None`` if more input
+                is needed
+        """
+        raise NotImplementedError()
+
+    def write(self, data):
+        """
+        Decompress the next chunk of the stream
+
+        Args:
+            data (bytes): Next chunk of the compressed stream
+        """
+        while data is not None:
+            if self._decompressor.eof:
+                data = self._decompressor.unused_data + data
+                data = data.lstrip(b'\0')
+                if not data:
+                    return
+                self._decompressor = self._new()
+
+            data = self._step(data)
+
+    def close(self):
+        """
+        Raises:
+            RuntimeError: If the stream was truncated
+        """
+        if not self._decompressor.eof:
+            raise RuntimeError('Compressed image stream is truncated')
+
+    def abort(self):
+        pass
+
+
+class LZMADecompressor(StreamDecompressor):
+    def _new(self):
+        return lzma.LZMADecompressor()
+
+    def _step(self, data):
+        self._sink(self._decompressor.decompress(data, max_length=CHUNK_SIZE))
+        if self._decompressor.needs_input and not self._decompressor.eof:
+            return None
+        return b''
+
+
+class ZlibDecompressor(StreamDecompressor):
+    def _new(self):
+        # accept only gzip headers
+        return zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+
+    def _step(self, data):
+        self._sink(self._decompressor.decompress(data, CHUNK_SIZE))
+        data = self._decompressor.unconsumed_tail
+        if not data and not self._decompressor.eof:
+            return None
+        return data
+
+    def close(self):
+        if not self._decompressor.eof:
+            self._sink(self._decompressor.flush())
+        super().close()
+
+
+class PipeDecompressor(object):
+    """
+    Decompresses a stream with an external command, as its data comes in.
+    The decompressed data is passed to the sink from a thread that reads the
+    output of the command.
+    """
+
+    def __init__(self, cmd, sink):
+        """
+        Args:
+            cmd (list of str): Command that decompresses its stdin to its
+                stdout
+            sink (callable): Called with each chunk of decompressed data
+        """
+        self._cmd = cmd
+        self._sink = sink
+        self._exc_info = None
+        self._closed = False
+        self._proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self._reader = threading.Thread(target=self._read)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read(self):
+        try:
+            for chunk in iter(
+                functools.partial(self._proc.stdout.read, CHUNK_SIZE), b''
+            ):
+                self._sink(chunk)
+        except Exception:
+            self._exc_info = sys.exc_info()
+            self._proc.kill()
+
+    def write(self, data):
+        """
+        Pass the next chunk of the stream to the command
+
+        Args:
+            data (bytes): Next chunk of the compressed stream
+
+        Raises:
+            RuntimeError: If the command exited before the end of the stream
+        """
+        try:
+            self._proc.stdin.write(data)
+        except (IOError, OSError, ValueError):
+            self.close()
+            raise RuntimeError(
+                'Command %s exited before the end of the stream' % self._cmd[0]
+            )
+
+    def close(self):
+        """
+        Wait for the command to decompress the rest of the stream
+
+        Raises:
+            RuntimeError: If the command failed
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        self._reader.join()
+        err = self._proc.stderr.read()
+        self._proc.stdout.close()
+        self._proc.stderr.close()
+        self._proc.wait()
+
+        if self._exc_info is not None:
+            six.reraise(*self._exc_info)
+        if self._proc.returncode:
+            raise RuntimeError(
+                'Failed to decompress image stream with %s:\n%s' %
+                (self._cmd[0], err.decode('utf-8', 'replace'))
+            )
+
+    def abort(self):
+        """
+        Stop the command, discarding the rest of the stream
+        """
+        self._proc.kill()
+        try:
+            self.close()
+        except RuntimeError:
+            pass
+
+
+def _run_pipe(cmd, src, dst):
+    with open(src, 'rb') as src_fd, open(dst, 'wb') as dst_fd:
+        result = utils.run_command(cmd, stdin=src_fd, out_pipe=dst_fd)
+    if result:
+        raise RuntimeError(
+            'Failed to run %s on %s:\n%s' % (cmd[0], src, result.err)
+        )
+
+
+#: Registered codecs, by name, in the order the compressed versions of the
+#: remote templates are looked for
+CODECS = {codec.name: codec for codec in (XzCodec(), ZstdCodec(), GzipCodec())}
+#: How many bytes are needed to recognize any of the codecs
+MAGIC_SIZE = max(len(codec.magic) for codec in CODECS.values())
+
+
+def get_codec(name=None):
+    """
+    Args:
+        name (str or None): Name of the codec, defaults to the
+            ``export_compression`` setting
+
+    Returns:
+        Codec: The codec with that name
+
+    Raises:
+        lago.utils.LagoUserException: If there is no such codec
+    """
+    if name is None:
+        name = config.get('export_compression')
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise utils.LagoUserException(
+            'Unknown compression {}, the supported ones are: {}'.format(
+                name, ', '.join(CODECS)
+            )
+        )
+
+
+def get_codec_by_extension(path):
+    """
+    Args:
+        path (str): Path or url of a file
+
+    Returns:
+        Codec or None: The codec of the extension of the given path, if any
+    """
+    for codec in CODECS.values():
+        if path.endswith(codec.extension):
+            return codec
+    return None
+
+
+def sniff_codec(data):
+    """
+    Args:
+        data (bytes): Start of a stream, at least :data:`MAGIC_SIZE` bytes
+            long
+
+    Returns:
+        Codec or None: The codec the stream is compressed with, ``None`` if
+            it's not compressed with any of them
+    """
+    for codec in CODECS.values():
+        if data.startswith(codec.magic):
+            return codec
+    return None
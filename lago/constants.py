@@ -39,12 +39,22 @@ CONFIG_DEFAULTS = {
             'ssh_password': '123456',
             'ssh_tries': 100,
             'ssh_timeout': 10,
+            'ssh_idle_timeout': 300,
             'libvirt_url': 'qemu:///system',
             'default_vm_type': 'default',
             'default_vm_provider': 'local-libvirt',
             'lease_dir': '/var/lib/lago/subnets',
+            'subnet_pools': '',
             'prefix_name': 'current',
             'reposync_dir': '/var/lib/lago',
+            'disk_workers': 4,
+            'template_download_connections': 4,
+            'start_workers': 8,
+            'exec_workers': 16,
+            'collect_compression': 'auto',
+            'export_io_workers': 2,
+            'export_cpu_workers': 2,
+            'export_compression': 'xz',
         },
     'init':
         {
@@ -52,6 +62,12 @@ CONFIG_DEFAULTS = {
                 'http://templates.ovirt.org/repo/repo.metadata',
             'template_store':
                 '/var/lib/lago/store',
+            'template_store_quota':
+                '',
+            'template_store_format':
+                'raw',
+            'template_store_share_layers':
+                False,
             'template_repos':
                 '/var/lib/lago/repos',
         }
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 from abc import ABCMeta, abstractmethod
+import contextlib
 import logging
 import functools
 import copy
@@ -8,14 +9,71 @@ import os
 from os import path
 import time
 import json
-import shutil
+import threading
 
 from six import with_metaclass
 
-from . import log_utils, utils
+from . import chunk_store, log_utils, utils
+from .compression import get_codec
+from .config import config
 
 LOGGER = logging.getLogger(__name__)
 LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
+#: Disk formats that are written with qemu-img convert, others are copied
+QEMU_IMG_FORMATS = ('raw', 'qcow2')
+#: xz block size, taken from the virt-builder page
+XZ_BLOCK_SIZE = 16777216
+
+
+class ExportScheduler(object):
+    """
+    ExportScheduler bounds the stages of all the disks that are exported
+    together, across all the VMs. I/O bound stages (copying, sparsifying and
+    hashing) and CPU bound stages (compressing) have separate budgets, and
+    each disk waits for a free slot of the kind its next stage needs.
+
+    Attributes:
+        io_workers (int): How many I/O bound stages can run at once
+        cpu_workers (int): How many CPU bound stages can run at once
+        compress_threads (int): Threads for each compressor, so that all the
+            CPU bound stages together use each core of the host once
+    """
+
+    def __init__(self, io_workers=None, cpu_workers=None):
+        """
+        Args:
+            io_workers (int): Defaults to the ``export_io_workers`` setting
+            cpu_workers (int): Defaults to the ``export_cpu_workers``
+                setting
+        """
+        if io_workers is None:
+            io_workers = int(config.get('export_io_workers'))
+        if cpu_workers is None:
+            cpu_workers = int(config.get('export_cpu_workers'))
+
+        self.io_workers = max(1, io_workers)
+        self.cpu_workers = max(1, cpu_workers)
+        self.compress_threads = max(
+            1, (os.cpu_count() or 1) // self.cpu_workers
+        )
+        self._io_slots = threading.BoundedSemaphore(self.io_workers)
+        self._cpu_slots = threading.BoundedSemaphore(self.cpu_workers)
+
+    @contextlib.contextmanager
+    def io_stage(self):
+        """
+        Wait for a free I/O slot, and hold it until the context exits
+        """
+        with self._io_slots:
+            yield
+
+    @contextlib.contextmanager
+    def cpu_stage(self):
+        """
+        Wait for a free CPU slot, and hold it until the context exits
+        """
+        with self._cpu_slots:
+            yield
 
 
 class DiskExportManager(with_metaclass(ABCMeta, object)):
@@ -38,9 +96,22 @@ class DiskExportManager(with_metaclass(ABCMeta, object)):
             dict should be updated with new values during the export process.
         do_compress(bool): If true, apply compression to the exported
             disk.
+        scheduler(ExportScheduler): Bounds the stages of this export
+            together with the other exports that share it
+        codec(lago.compression.Codec): Codec to compress the exported disk
+            with
+        compressed_dst(str): The absolute path of the compressed disk
     """
 
-    def __init__(self, dst, disk_type, disk, do_compress):
+    def __init__(
+        self,
+        dst,
+        disk_type,
+        disk,
+        do_compress,
+        scheduler=None,
+        compression=None,
+    ):
         """
         Args:
             dst (str): The absolute path of the exported disk
@@ -50,6 +121,10 @@ class DiskExportManager(with_metaclass(ABCMeta, object)):
                 workdir/current/virt/VM-NAME
             do_compress(bool): If true, apply compression to the
                 exported disk.
+            scheduler(ExportScheduler): If not set, this export gets a
+                scheduler of its own
+            compression(str): Name of the codec to compress the disk with,
+                defaults to the ``export_compression`` setting
         """
         self.src = path.expandvars(disk['path'])
         self.name = path.basename(self.src)
@@ -58,6 +133,10 @@ class DiskExportManager(with_metaclass(ABCMeta, object)):
         self.disk = disk
         self.exported_metadata = copy.deepcopy(disk['metadata'])
         self.do_compress = do_compress
+        self.scheduler = scheduler or ExportScheduler()
+        self.codec = get_codec(compression)
+        self.compressed_dst = self.dst + self.codec.extension
+        self._compressed = False
 
     @staticmethod
     def get_instance_by_type(dst, disk, do_compress, *args, **kwargs):
@@ -75,7 +154,12 @@ class DiskExportManager(with_metaclass(ABCMeta, object)):
             matches the disk type.
         """
         disk_type = disk['type']
-        cls = HANDLERS.get(disk_type)
+        if kwargs.get('since'):
+            cls = DeltaExportManager
+        elif kwargs.get('chunked'):
+            cls = ChunkedExportManager
+        else:
+            cls = HANDLERS.get(disk_type)
         if not cls:
             raise utils.LagoUserException(
                 'Export is not supported for disk type {}'.format(disk_type)
@@ -98,15 +182,32 @@ class DiskExportManager(with_metaclass(ABCMeta, object)):
         Copy the disk using cp in order to preserves the 'sparse'
         structure of the file
         """
-        with LogTask('Copying disk'):
+        with self.scheduler.io_stage(), LogTask('Copying disk'):
             utils.cp(self.src, self.dst)
 
+    def convert(self):
+        """
+        Write the disk with 'qemu-img convert', which merges its layers and
+        skips its zeroed areas in the same pass, so the exported disk is
+        standalone and sparse. Disks that qemu-img can't write are copied.
+        """
+        if self.disk['format'] not in QEMU_IMG_FORMATS:
+            return self.copy()
+
+        with self.scheduler.io_stage(), LogTask('Converting disk'):
+            utils.qemu_convert(
+                source=self.src,
+                target=self.dst,
+                target_format=self.disk['format'],
+                source_format=self.disk['format'],
+            )
+
     def sparse(self):
         """
         Make the exported images more compact by removing unused space.
         Please refer to 'virt-sparsify' for more info.
         """
-        with LogTask('Making disk sparse'):
+        with self.scheduler.io_stage(), LogTask('Making disk sparse'):
             # Removed unused space from the disk
             utils.sparse(self.dst, self.disk['format'])
 
@@ -118,28 +219,78 @@ class DiskExportManager(with_metaclass(ABCMeta, object)):
         Args:
             checksum(str): The type of the checksum
         """
-        with LogTask('Calculating {}'.format(checksum)):
+        with self.scheduler.io_stage(), \
+                LogTask('Calculating {}'.format(checksum)):
             with open(self.dst + '.hash', 'wt') as f:
                 sha = utils.get_hash(self.dst, checksum)
                 f.write(sha)
             self.exported_metadata[checksum] = sha
 
+    def calc_sha_and_compress(self, checksum):
+        """
+        Calculate the checksum of the new exported disk, as
+        :func:`calc_sha` does, and compress it if needed, reading it only
+        once for both. The uncompressed disk is kept for the metadata, and
+        removed by :func:`compress`.
+
+        Args:
+            checksum(str): The type of the checksum
+        """
+        if not self.do_compress:
+            return self.calc_sha(checksum)
+
+        msg = 'Calculating {} and compressing disk'.format(checksum)
+        with self.scheduler.cpu_stage(), LogTask(msg):
+            sha = utils.hash_and_compress(
+                self.dst,
+                checksum,
+                compress_to=self.compressed_dst,
+                compress_cmd=self.codec.compress_cmd(
+                    threads=self.scheduler.compress_threads,
+                    block_size=XZ_BLOCK_SIZE,
+                ),
+            )
+            with open(self.dst + '.hash', 'wt') as f:
+                f.write(sha)
+            self.exported_metadata[checksum] = sha
+            self._compressed = True
+
     def compress(self):
         """
-        Compress the new exported image,
-        Block size was taken from virt-builder page
+        Compress the new exported image, unless it was already compressed
+        by :func:`calc_sha_and_compress`
         """
         if not self.do_compress:
             return
-        with LogTask('Compressing disk'):
-            utils.compress(self.dst, 16777216)
-            os.unlink(self.dst)
+        if not self._compressed:
+            with self.scheduler.cpu_stage(), LogTask('Compressing disk'):
+                self.codec.compress(
+                    self.dst,
+                    self.compressed_dst,
+                    threads=self.scheduler.compress_threads,
+                    block_size=XZ_BLOCK_SIZE,
+                )
+        os.unlink(self.dst)
+
+    def remove_exported(self):
+        """
+        Remove the files of the exported disk
+        """
+        for suffix in ('', self.codec.extension, '.hash', '.metadata'):
+            try:
+                os.unlink(self.dst + suffix)
+            except OSError:
+                pass
 
     def update_lago_metadata(self):
         with LogTask('Updating Lago metadata'):
             self.exported_metadata['size'] = os.stat(self.dst).st_size
             self.exported_metadata['name'] = self.name
             self.exported_metadata['version'] = time.strftime("%Y%m%d.0")
+            if self.do_compress:
+                self.exported_metadata['compression'] = self.codec.name
+            else:
+                self.exported_metadata.pop('compression', None)
 
     def write_lago_metadata(self):
         with LogTask('Writing Lago metadata'):
@@ -156,53 +307,59 @@ class TemplateExportManager(DiskExportManager):
     """
 
     def __init__(self, dst, disk_type, disk, do_compress, *args, **kwargs):
-        super().__init__(dst, disk_type, disk, do_compress)
+        super().__init__(
+            dst,
+            disk_type,
+            disk,
+            do_compress,
+            scheduler=kwargs.get('scheduler'),
+            compression=kwargs.get('compression'),
+        )
         self.standalone = kwargs['standalone']
         self.src_qemu_info = utils.get_qemu_info(self.src, backing_chain=True)
+        if not self.standalone and len(self.src_qemu_info) > 2:
+            raise utils.LagoUserException(
+                'Layered export is currently supported for one '
+                'layer only.  You can try to use Standalone export.'
+            )
+
+    @property
+    def layered(self):
+        """
+        bool: True if the exported disk keeps the base image of the source
+        as its backing file
+        """
+        return not self.standalone and len(self.src_qemu_info) > 1
 
     def rebase(self):
         """
         Change the backing-file entry of the exported disk.
         Please refer to 'qemu-img rebase' manual for more info.
-        """
-        if self.standalone:
-            rebase_msg = 'Merging layered image with base'
-        else:
-            rebase_msg = 'Rebase'
 
-        with LogTask(rebase_msg):
-            if len(self.src_qemu_info) == 1:
-                # Base image (doesn't have predecessors)
-                return
+        Standalone disks were already merged with their base when they were
+        converted, so only layered disks are rebased.
+        """
+        if not self.layered:
+            return
 
-            if self.standalone:
-                # Consolidate the layers and base image
-                utils.qemu_rebase(target=self.dst, backing_file="")
-            else:
-                if len(self.src_qemu_info) > 2:
-                    raise utils.LagoUserException(
-                        'Layered export is currently supported for one '
-                        'layer only.  You can try to use Standalone export.'
-                    )
-                # Put an identifier in the metadata of the copied layer,
-                # this identifier will be used later by Lago in order
-                # to resolve and download the base image
-                parent = self.src_qemu_info[0]['backing-filename']
-
-                # Hack for working with lago images naming convention
-                # For example: /var/lib/lago/store/phx_repo:el7.3-base:v1
-                # Extract only the image name and the version
-                # (in the example el7.3-base:v1)
-                parent = os.path.basename(parent)
-                try:
-                    parent = parent.split(':', 1)[1]
-                except IndexError:
-                    pass
-
-                parent = './{}'.format(parent)
-                utils.qemu_rebase(
-                    target=self.dst, backing_file=parent, safe=False
-                )
+        with LogTask('Rebase'):
+            # Put an identifier in the metadata of the copied layer,
+            # this identifier will be used later by Lago in order
+            # to resolve and download the base image
+            parent = self.src_qemu_info[0]['backing-filename']
+
+            # Hack for working with lago images naming convention
+            # For example: /var/lib/lago/store/phx_repo:el7.3-base:v1
+            # Extract only the image name and the version
+            # (in the example el7.3-base:v1)
+            parent = os.path.basename(parent)
+            try:
+                parent = parent.split(':', 1)[1]
+            except IndexError:
+                pass
+
+            parent = './{}'.format(parent)
+            utils.qemu_rebase(target=self.dst, backing_file=parent, safe=False)
 
     def update_lago_metadata(self):
         super().update_lago_metadata()
@@ -218,13 +375,15 @@ class TemplateExportManager(DiskExportManager):
         """
         with LogTask('Exporting disk {} to {}'.format(self.name, self.dst)):
             with utils.RollbackContext() as rollback:
-                rollback.prependDefer(
-                    shutil.rmtree, self.dst, ignore_errors=True
-                )
-                self.copy()
+                rollback.prependDefer(self.remove_exported)
+                if self.layered:
+                    # Only the top layer is exported
+                    self.copy()
+                else:
+                    self.convert()
                 self.sparse()
                 self.rebase()
-                self.calc_sha('sha1')
+                self.calc_sha_and_compress('sha1')
                 self.update_lago_metadata()
                 self.write_lago_metadata()
                 self.compress()
@@ -242,7 +401,14 @@ class FileExportManager(DiskExportManager):
     """
 
     def __init__(self, dst, disk_type, disk, do_compress, *args, **kwargs):
-        super().__init__(dst, disk_type, disk, do_compress)
+        super().__init__(
+            dst,
+            disk_type,
+            disk,
+            do_compress,
+            scheduler=kwargs.get('scheduler'),
+            compression=kwargs.get('compression'),
+        )
 
     def export(self):
         """
@@ -250,13 +416,219 @@ class FileExportManager(DiskExportManager):
         """
         with LogTask('Exporting disk {} to {}'.format(self.name, self.dst)):
             with utils.RollbackContext() as rollback:
-                rollback.prependDefer(
-                    shutil.rmtree, self.dst, ignore_errors=True
-                )
-                self.copy()
+                rollback.prependDefer(self.remove_exported)
+                self.convert()
                 if not self.disk['format'] == 'iso':
                     self.sparse()
-                self.calc_sha('sha1')
+                self.calc_sha_and_compress('sha1')
+                self.update_lago_metadata()
+                self.write_lago_metadata()
+                self.compress()
+                rollback.clear()
+
+
+class ChunkedExportManager(DiskExportManager):
+    """
+    ChunkedExportManager exports disks of any type into the chunk store of
+    the export dir, shared by all the disks exported there, and a manifest
+    (``name + '.manifest'``) that lists the blocks of the disk, see
+    :mod:`lago.chunk_store`.
+
+    The whole backing chain of the disk is merged, so disks with any number
+    of layers can be exported, and the blocks that the disks share, like the
+    ones of their common base templates, are stored only once.
+
+    Attributes:
+        manifest (str): The absolute path of the manifest of the disk
+        raw (str): The absolute path of the merged raw image, for the disks
+            that are not raw already
+    """
+
+    def __init__(self, dst, disk_type, disk, do_compress, *args, **kwargs):
+        super().__init__(
+            dst,
+            disk_type,
+            disk,
+            do_compress,
+            scheduler=kwargs.get('scheduler'),
+            compression=kwargs.get('compression'),
+        )
+        self.manifest = self.dst + chunk_store.MANIFEST_SUFFIX
+        self.raw = self.dst + '.raw'
+
+    def merge(self):
+        """
+        Merge the backing chain of the disk into a raw image
+
+        Returns:
+            str: Path to the raw image
+        """
+        if self.disk['format'] in chunk_store.RAW_FORMATS:
+            return self.src
+
+        with self.scheduler.io_stage(), LogTask('Merging disk'):
+            utils.qemu_convert(
+                source=self.src,
+                target=self.raw,
+                target_format='raw',
+                source_format=self.disk['format'],
+            )
+        return self.raw
+
+    def store_chunks(self, image, checksum):
+        """
+        Add the blocks of the given image to the chunk store, and write the
+        manifest and the checksum of the disk
+
+        Args:
+            image (str): Path to the raw image
+            checksum(str): The type of the checksum
+        """
+        with self.scheduler.io_stage(), LogTask('Storing chunks'):
+            sha = chunk_store.write_image(
+                image, self.manifest, self.disk['format'], checksum
+            )
+            with open(self.dst + '.hash', 'wt') as f:
+                f.write(sha)
+            self.exported_metadata[checksum] = sha
+
+    def update_lago_metadata(self):
+        with LogTask('Updating Lago metadata'):
+            self.exported_metadata['size'] = chunk_store.read_manifest(
+                self.manifest
+            )['size']
+            self.exported_metadata['name'] = self.name
+            self.exported_metadata['version'] = time.strftime("%Y%m%d.0")
+            self.exported_metadata['base'] = 'None'
+            self.exported_metadata.pop('compression', None)
+
+    def remove_exported(self):
+        """
+        Remove the files of the exported disk, the blocks are left in the
+        store, as other disks might use them
+        """
+        for suffix in (
+            chunk_store.MANIFEST_SUFFIX, '.raw', '.hash', '.metadata'
+        ):
+            try:
+                os.unlink(self.dst + suffix)
+            except OSError:
+                pass
+
+    def export(self):
+        """
+            See DiskExportManager.export
+        """
+        with LogTask(
+            'Exporting disk {} to {}'.format(self.name, self.manifest)
+        ):
+            with utils.RollbackContext() as rollback:
+                rollback.prependDefer(self.remove_exported)
+                image = self.merge()
+                self.store_chunks(image, 'sha1')
+                if image == self.raw:
+                    os.unlink(self.raw)
+                self.update_lago_metadata()
+                self.write_lago_metadata()
+                rollback.clear()
+
+
+class DeltaExportManager(DiskExportManager):
+    """
+    DeltaExportManager exports only the layers that were added to a disk of
+    any type since a snapshot of its VM was taken. The layers are merged into
+    a single qcow2 layer, whose backing file is ``./`` followed by the name
+    of the image the disk had when the snapshot was taken, so the delta can
+    be applied on top of an earlier export of the disk.
+
+    Attributes:
+        since (str): The name of the snapshot
+        base (str): Path to the image of the disk at the snapshot
+        base_format (str): The format of the image at the snapshot
+    """
+
+    def __init__(self, dst, disk_type, disk, do_compress, *args, **kwargs):
+        super().__init__(
+            dst,
+            disk_type,
+            disk,
+            do_compress,
+            scheduler=kwargs.get('scheduler'),
+            compression=kwargs.get('compression'),
+        )
+        self.since = kwargs['since']
+        self.base = path.expandvars(disk['snapshot-base'])
+
+        src_qemu_info = utils.get_qemu_info(self.src, backing_chain=True)
+        for layer in src_qemu_info[1:]:
+            if path.realpath(layer['filename']) == path.realpath(self.base):
+                self.base_format = layer['format']
+                break
+        else:
+            raise utils.LagoUserException(
+                'Disk {} does not descend from its image at snapshot {}, '
+                '{}'.format(self.name, self.since, self.base)
+            )
+        self.parent = src_qemu_info[1]
+
+    def merge_changes(self):
+        """
+        Merge the layers above the image of the snapshot into the copy of
+        the top layer, by rebasing it onto that image. A safe rebase writes
+        to the copy every cluster that differs between its old backing chain
+        and the image of the snapshot, so the changes made in the
+        intermediate layers are kept.
+        """
+        msg = 'Merging changes since snapshot {}'.format(self.since)
+        with self.scheduler.io_stage(), LogTask(msg):
+            # The backing file of the copy might be relative to the source,
+            # point it to the same parent by absolute path first
+            utils.qemu_rebase(
+                target=self.dst,
+                backing_file=path.realpath(self.parent['filename']),
+                safe=False,
+                backing_format=self.parent['format'],
+            )
+            utils.qemu_rebase(
+                target=self.dst,
+                backing_file=self.base,
+                backing_format=self.base_format,
+            )
+
+    def rebase(self):
+        """
+        Point the exported layer to the image of the snapshot, by name only,
+        as it should be placed next to it
+        """
+        with LogTask('Rebase'):
+            utils.qemu_rebase(
+                target=self.dst,
+                backing_file='./{}'.format(path.basename(self.base)),
+                safe=False,
+                backing_format=self.base_format,
+            )
+
+    def update_lago_metadata(self):
+        super().update_lago_metadata()
+
+        self.exported_metadata['base'] = path.basename(self.base)
+        self.exported_metadata['since'] = self.since
+
+    def export(self):
+        """
+            See DiskExportManager.export
+        """
+        with LogTask(
+            'Exporting changes of disk {} since snapshot {} to {}'.format(
+                self.name, self.since, self.dst
+            )
+        ):
+            with utils.RollbackContext() as rollback:
+                rollback.prependDefer(self.remove_exported)
+                self.copy()
+                self.merge_changes()
+                self.rebase()
+                self.calc_sha_and_compress('sha1')
                 self.update_lago_metadata()
                 self.write_lago_metadata()
                 self.compress()
@@ -276,7 +648,12 @@ class VMExportManager(object):
         *args(list): Extra args, will be passed to each
             DiskExportManager
         **kwargs(dict): Extra args, will be passed to each
-            DiskExportManager
+            DiskExportManager. If there is no ``scheduler`` among them, the
+            disks share a new :class:`ExportScheduler`. If ``chunked`` is
+            set, the disks are exported by :class:`ChunkedExportManager`.
+            If ``since`` is set, only the changes since that snapshot are
+            exported, by :class:`DeltaExportManager`, and each disk should
+            have the path of its image at the snapshot in ``snapshot-base``
 
     """
 
@@ -309,8 +686,12 @@ class VMExportManager(object):
         Returns:
             (list of str): The path of the exported disks.
         """
+        suffix = ''
+        if self._kwargs.get('chunked'):
+            suffix = chunk_store.MANIFEST_SUFFIX
+
         return [
-            os.path.join(self._dst, os.path.basename(disk['path']))
+            os.path.join(self._dst, os.path.basename(disk['path'])) + suffix
             for disk in self._collect()
         ]
 
@@ -335,6 +716,9 @@ class VMExportManager(object):
         Returns:
             (list of str): The path of the exported disks.
         """
+        if self._kwargs.get('scheduler') is None:
+            self._kwargs['scheduler'] = ExportScheduler()
+
         if self._with_threads:
             utils.invoke_different_funcs_in_parallel(
                 *[mgr.export for mgr in self._get_export_mgr()]
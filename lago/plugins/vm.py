@@ -31,17 +31,22 @@ for example, using a remote libvirt instance or similar.
 """
 from copy import deepcopy
 import contextlib
-import errno
 import functools
+import json
 import logging
 import os
+import posixpath
 import shutil
-import tempfile
+import socket
+import subprocess
+import tarfile
+import threading
 import warnings
 from abc import (ABCMeta, abstractmethod)
 
 import six
 from six import with_metaclass
+from six.moves import shlex_quote
 from scp import SCPClient, SCPException
 
 from .. import (
@@ -55,6 +60,25 @@ from lago.config import config
 LOGGER = logging.getLogger(__name__)
 LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
 
+GUEST_TOOLS = ('tar', 'gzip', 'zstd')
+COLLECT_COMPRESSIONS = ('auto', 'none', 'gzip', 'zstd')
+TAR_STREAM_BUFSIZE = 1024 * 1024
+# Prefix of the line the exit status of the guest's tar is reported in, on
+# stderr, as it's lost when tar's output is piped to a compressor
+TAR_STATUS_PREFIX = 'lago-tar-status='
+# What tar prints when some of the paths are missing, along with its warnings
+TAR_MISSING_PATH_ERRORS = (
+    ': No such file or directory',
+    'Exiting with failure status due to previous errors',
+    'Removing leading',
+)
+#: Records what an incremental collection transferred, kept in its directory
+COLLECT_MANIFEST = '.lago-collect-manifest.json'
+# Refuse members that would be extracted outside of the destination, where
+# the tarfile module supports it
+TAR_EXTRACT_KWARGS = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') \
+    else {}
+
 
 class VMError(utils.LagoException):
     pass
@@ -98,6 +122,225 @@ class LagoFailedToGetVMStateError(utils.LagoException):
     pass
 
 
+def extract_tar_stream(tar, local_path):
+    """
+    Extract a tar stream whose top level entry is a single file or
+    directory, with scp semantics: into ``local_path`` if it's an existing
+    directory, or as ``local_path`` otherwise.
+
+    Args:
+        tar(tarfile.TarFile): Archive opened in stream mode
+        local_path(str): Where to extract the archive's top level entry
+    """
+    if os.path.isdir(local_path):
+        dest_dir, top = local_path, None
+    else:
+        dest_dir = os.path.dirname(local_path) or '.'
+        top = os.path.basename(local_path)
+
+    def _rename(name):
+        parts = name.split('/', 1)
+        parts[0] = top
+        return '/'.join(parts)
+
+    for member in tar:
+        if top is not None:
+            member.name = _rename(member.name)
+            if member.islnk():
+                member.linkname = _rename(member.linkname)
+        tar.extract(member, dest_dir, **TAR_EXTRACT_KWARGS)
+
+
+def extract_paths_from_tar_stream(tar, paths, found=None):
+    """
+    Extract a tar stream of several guest paths, each one to its own local
+    path, as the stream is read.
+
+    Args:
+        tar(tarfile.TarFile): Archive opened in stream mode, created from
+            the guest paths in the given order, with their leading slash
+            removed as tar does
+        paths(list of tuples): Guest and local paths in
+            `[(guest1, local1), (guest2, local2)...]` format
+        found(set): If given, the guest paths are added to it as they are
+            found, so they are known also if reading the stream fails
+
+    Returns:
+        set of str: The guest paths that were found in the archive
+    """
+    roots = [
+        (
+            posixpath.normpath(guest_path).lstrip('/'), guest_path,
+            os.path.abspath(local_path)
+        ) for guest_path, local_path in paths
+    ]
+    dest_dir = os.path.commonpath(
+        [os.path.dirname(local_path) for _, _, local_path in roots]
+    )
+
+    def _matches(root, name):
+        return name == root or name.startswith(root + '/')
+
+    # tar writes the paths one after the other, in the order they were
+    # given, and the same name showing up again means that the next path
+    # (which is inside the current one) has started
+    current = 0
+    seen = set()
+    if found is None:
+        found = set()
+    # Hard links point to the name of an earlier member
+    extracted = {}
+    for member in tar:
+        name = member.name.rstrip('/')
+        if name in seen or not _matches(roots[current][0], name):
+            for index in range(current + 1, len(roots)):
+                if _matches(roots[index][0], name):
+                    current = index
+                    seen = set()
+                    break
+            else:
+                LOGGER.debug('Skipping unexpected tar member %s', name)
+                continue
+
+        root, guest_path, local_path = roots[current]
+        seen.add(name)
+        found.add(guest_path)
+        local_name = os.path.relpath(local_path + name[len(root):], dest_dir)
+        extracted.setdefault(member.name, local_name)
+        member.name = local_name
+        if member.islnk():
+            if member.linkname not in extracted:
+                LOGGER.debug('Skipping dangling hard link %s', name)
+                continue
+            member.linkname = extracted[member.linkname]
+        tar.extract(member, dest_dir, **TAR_EXTRACT_KWARGS)
+
+    return found
+
+
+def _send_and_shutdown(channel, data):
+    try:
+        channel.sendall(data)
+        channel.shutdown_write()
+    except socket.error as err:
+        LOGGER.debug('Failed sending to the channel: %s', err)
+
+
+def _parse_tar_errors(err):
+    """
+    Split the exit status of tar, reported with :data:`TAR_STATUS_PREFIX`,
+    from its errors
+
+    Args:
+        err(str): stderr of the guest command
+
+    Returns:
+        tuple of int and str: The exit status of tar, None if it was not
+            reported, and the rest of stderr
+    """
+    status = None
+    lines = []
+    for line in err.splitlines():
+        if line.startswith(TAR_STATUS_PREFIX):
+            status = int(line[len(TAR_STATUS_PREFIX):])
+        else:
+            lines.append(line)
+    return status, '\n'.join(lines)
+
+
+def _tar_failed(status, errors):
+    """
+    Args:
+        status(int or None): Exit status of tar
+        errors(str): Errors of tar
+
+    Returns:
+        bool: True if tar failed for any reason other than missing paths,
+            which the callers handle
+    """
+    if status is None:
+        return True
+    if status <= 1:
+        # 1 means that some files changed while they were read
+        return False
+    lines = errors.splitlines()
+    if not any(TAR_MISSING_PATH_ERRORS[0] in line for line in lines):
+        return True
+    return any(
+        not any(ignored in line for ignored in TAR_MISSING_PATH_ERRORS)
+        for line in lines
+    )
+
+
+def _link_or_copy(src, dst):
+    """
+    Hard link src to dst, copying it if they are on different file systems
+    """
+    dst_dir = os.path.dirname(dst)
+    if not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+@contextlib.contextmanager
+def _decompressed(stream, compression):
+    """
+    Decompress a stream as it's read
+
+    Args:
+        stream(file): Compressed stream
+        compression(str): 'none', 'gzip' or 'zstd'
+
+    Yields:
+        tuple of file and str: The stream to read, and the mode tarfile
+            should read it with
+    """
+    if compression == 'none':
+        yield stream, 'r|'
+        return
+    if compression == 'gzip':
+        yield stream, 'r|gz'
+        return
+
+    proc = subprocess.Popen(
+        ['zstd', '-d', '-c', '-q'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+
+    def _feed():
+        try:
+            shutil.copyfileobj(stream, proc.stdin, TAR_STREAM_BUFSIZE)
+        except (IOError, OSError):
+            # zstd exited, e.g. the reader stopped early
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    feeder = threading.Thread(target=_feed)
+    feeder.daemon = True
+    feeder.start()
+    try:
+        yield proc.stdout, 'r|'
+        # Read the padding after the end of the archive, so zstd exits on
+        # its own, and its status tells if the stream was complete
+        while proc.stdout.read(TAR_STREAM_BUFSIZE):
+            pass
+    finally:
+        proc.stdout.close()
+        proc.wait()
+        feeder.join()
+
+    if proc.returncode:
+        raise tarfile.ReadError('zstd failed to decompress the archive')
+
+
 def check_running(func):
     @functools.wraps(func)
     def wrapper(self, *args, **kwargs):
@@ -120,6 +363,7 @@ class VMProviderPlugin(plugins.Plugin):
 
     def __init__(self, vm):
         self.vm = vm
+        self._guest_tools = None
 
     @abstractmethod
     def start(self, *args, **kwargs):
@@ -239,12 +483,15 @@ class VMProviderPlugin(plugins.Plugin):
     def name(self):
         return self.vm.name()
 
-    def extract_paths(self, paths, ignore_nopath):
+    def extract_paths(self, paths, ignore_nopath, compression=None):
         """
         Extract the given paths from the domain
         Args:
             paths(list of str): paths to extract
             ignore_nopath(boolean): if True will ignore none existing paths.
+            compression(str): How to compress the files while they are
+                transferred, one of :data:`COLLECT_COMPRESSIONS`, defaults
+                to the ``collect_compression`` setting
         Returns:
             None
         Raises:
@@ -253,8 +500,8 @@ class VMProviderPlugin(plugins.Plugin):
             :exc:`~lago.plugins.vm.ExtractPathError`: on all other failures.
         """
         try:
-            if self._has_tar_and_gzip():
-                self._extract_paths_tar_gz(paths, ignore_nopath)
+            if self._has_tar():
+                self._extract_paths_tar(paths, ignore_nopath, compression)
             else:
                 self._extract_paths_scp(paths, ignore_nopath)
         except (ssh.LagoSSHTimeoutException, LagoVMNotRunningError):
@@ -264,87 +511,193 @@ class VMProviderPlugin(plugins.Plugin):
             )
 
     @check_running
-    def _has_tar_and_gzip(self):
-        with self.vm._ssh() as client:
-            _, stdout, _ = client.exec_command("ls /usr/bin/tar")
-            if stdout.read().strip() != "/usr/bin/tar":
-                return False
-            _, stdout, _ = client.exec_command("ls /usr/bin/gzip")
-            if stdout.read().strip() != "/usr/bin/gzip":
-                return False
-        return True
+    def list_paths(self, paths):
+        """
+        List the files under the given paths in the domain, with a single
+        command. Symlinks are followed, the same way they are when the paths
+        are extracted.
 
-    @staticmethod
-    def _prepare_tar_gz_command(remote_paths, compression_level):
-        cmd = "tar --dereference -c {} | gzip -f -{}"
-        remote_paths_arg = " ".join(remote_paths)
-        return cmd.format(remote_paths_arg, compression_level)
+        Args:
+            paths(list of str): paths to list
 
-    def _pipe_ssh_cmd_output_to_file(self, cmd, out_file):
+        Returns:
+            dict: Maps each of the paths that exist to a dict with its
+            directories under 'dirs', and its files, mapped to their
+            ``[size, mtime]``, under 'files'
+        """
+        roots = [(posixpath.normpath(path), path) for path in paths]
+        cmd = 'find -L {} -printf {}'.format(
+            ' '.join(shlex_quote(root) for root, _ in roots),
+            shlex_quote(r'%Y %s %T@ %p\0'),
+        )
         with self.vm._ssh() as client:
-            _, stdout, _ = client.exec_command(cmd)
-            out_file.write(stdout.read())
-            out_file.flush()
-            os.fsync(out_file.fileno())
+            channel = client.get_transport().open_session()
+            try:
+                channel.exec_command(cmd)
+                out = channel.makefile('rb').read()
+                channel.recv_exit_status()
+            finally:
+                channel.close()
+
+        listing = {}
+        for record in out.split(b'\0'):
+            if not record:
+                continue
+            kind, size, mtime, name = record.decode(
+                'utf-8', 'surrogateescape'
+            ).split(' ', 3)
+            for root, path in roots:
+                if name != root and not name.startswith(root + '/'):
+                    continue
+                entry = listing.setdefault(path, {'dirs': [], 'files': {}})
+                if kind == 'd':
+                    entry['dirs'].append(name)
+                elif kind == 'f':
+                    entry['files'][name] = [int(size), mtime]
+
+        return listing
 
-    @contextlib.contextmanager
-    def _tar_gz_archive_from(self, remote_paths, compression_level=5):
-        with tempfile.NamedTemporaryFile() as archive_file:
-            tar_gz_cmd = self._prepare_tar_gz_command(
-                remote_paths, compression_level
+    @check_running
+    def _has_tar(self):
+        return 'tar' in self._get_guest_tools()
+
+    def _get_guest_tools(self):
+        """
+        Find which of the archiving tools Lago can use are installed in the
+        guest. The tools are looked up in a single command, and the result
+        is cached.
+
+        Returns:
+            set of str: The names of the available tools
+        """
+        if self._guest_tools is None:
+            with self.vm._ssh() as client:
+                _, stdout, _ = client.exec_command(
+                    'command -v {}'.format(' '.join(GUEST_TOOLS))
+                )
+                found = stdout.read().decode('utf-8', 'replace').split()
+            self._guest_tools = set(os.path.basename(path) for path in found)
+
+        return self._guest_tools
+
+    def _get_collect_compression(self, compression=None):
+        """
+        Resolve the compression to use when extracting files
+
+        Args:
+            compression(str): One of :data:`COLLECT_COMPRESSIONS`, defaults
+                to the ``collect_compression`` setting. 'auto' picks the
+                fastest one that is available both in the guest and locally.
+
+        Returns:
+            str: 'none', 'gzip' or 'zstd'
+
+        Raises:
+            :exc:`~lago.utils.LagoUserException`: If the compression is
+                unknown, or not available
+        """
+        if compression is None:
+            compression = config.get('collect_compression')
+        if compression not in COLLECT_COMPRESSIONS:
+            raise utils.LagoUserException(
+                'Unknown compression {}, should be one of: {}'.format(
+                    compression, ', '.join(COLLECT_COMPRESSIONS)
+                )
             )
-            self._pipe_ssh_cmd_output_to_file(tar_gz_cmd, archive_file)
-            LOGGER.debug(
-                "Created %s archive with collected paths", archive_file.name
+
+        tools = self._get_guest_tools()
+        if compression == 'auto':
+            if 'zstd' in tools and shutil.which('zstd'):
+                return 'zstd'
+            return 'gzip' if 'gzip' in tools else 'none'
+
+        if compression != 'none' and compression not in tools:
+            raise utils.LagoUserException(
+                '{} is not installed in {}'.format(compression, self.name())
             )
-            yield archive_file
+        if compression == 'zstd' and not shutil.which('zstd'):
+            raise utils.LagoUserException('zstd is not installed locally')
 
-    @contextlib.contextmanager
-    def _remote_paths_extracted_to_temp_dir(self, remote_paths):
-        with self._tar_gz_archive_from(remote_paths) as archive_file:
-            with utils.TemporaryDirectory() as tmpdir_path:
-                LOGGER.debug(
-                    "Extracting archive %s to temporary directory: %s",
-                    archive_file.name, tmpdir_path
-                )
-                args = ["tar", "-xf", archive_file.name, "-C", tmpdir_path]
-                cmd_status = utils.run_command(args)
-                if cmd_status.code != 0:
-                    LOGGER.error("'tar' command failed: %s", cmd_status.err)
-                yield tmpdir_path
+        return compression
 
     @check_running
-    def _extract_paths_tar_gz(self, paths, ignore_nopath):
-        remote_paths = tuple(p[0] for p in paths)
+    def _extract_paths_tar(self, paths, ignore_nopath, compression=None):
+        if not paths:
+            return
+
+        compression = self._get_collect_compression(compression)
+        # The paths are sent on stdin, there may be too many of them for the
+        # command line
+        cmd = 'tar --dereference -cf - --null -T -'
+        # The exit status of tar is lost in the pipe, report it on stderr
+        cmd = '{{ {}; echo {}$? >&2; }}'.format(cmd, TAR_STATUS_PREFIX)
+        if compression != 'none':
+            cmd += ' | {} -c'.format(compression)
+        names = b''.join(
+            posixpath.normpath(remote_path).encode('utf-8') + b'\0'
+            for remote_path, _ in paths
+        )
+
+        found = set()
+        read_error = None
+        with self.vm._ssh() as client:
+            channel = client.get_transport().open_session()
+            try:
+                channel.exec_command(cmd)
+                # Sent from another thread, as tar starts writing the
+                # archive, which has to be read, before it reads all of them
+                sender = threading.Thread(
+                    target=_send_and_shutdown, args=(channel, names)
+                )
+                sender.daemon = True
+                sender.start()
+                try:
+                    with _decompressed(channel.makefile('rb'),
+                                       compression) as (stream, mode):
+                        with tarfile.open(
+                            fileobj=stream,
+                            mode=mode,
+                            bufsize=TAR_STREAM_BUFSIZE,
+                        ) as tar:
+                            extract_paths_from_tar_stream(tar, paths, found)
+                except tarfile.ReadError as err:
+                    read_error = err
+                err = channel.makefile_stderr('rb').read()
+                code = channel.recv_exit_status()
+                sender.join()
+            finally:
+                channel.close()
+
+        tar_status, errors = _parse_tar_errors(err.decode('utf-8', 'replace'))
+        if errors:
+            LOGGER.debug('%s: tar errors:\n%s', self.vm.name(), errors)
+        if code != 0:
+            raise ExtractPathError(
+                'Failed to compress the archive with {}:\n{}'.format(
+                    compression, errors
+                )
+            )
+        if _tar_failed(tar_status, errors):
+            raise ExtractPathError(
+                'Failed to archive the paths:\n{}'.format(errors)
+            )
+        # tar outputs an archive with no members, which is read as an error,
+        # only if none of the paths exist
+        if read_error is not None and (found or tar_status == 0):
+            raise ExtractPathError(
+                'Failed to read the archive: {}'.format(read_error)
+            )
 
-        with self._remote_paths_extracted_to_temp_dir(
-            remote_paths
-        ) as tmpdir_path:
-            for remote_path, desired_local_path in paths:
+        for remote_path, _ in paths:
+            if remote_path in found:
+                continue
+            if ignore_nopath:
                 LOGGER.debug(
-                    'Moving %s to %s',
+                    '%s: ignoring since ignore_nopath was set to True',
                     remote_path,
-                    desired_local_path,
                 )
-                try:
-                    # we need to strip first slash from absolute
-                    # 'remote_path' to make 'os.path.join' work
-                    current_local_path = os.path.join(
-                        tmpdir_path, remote_path[1:]
-                    )
-                    shutil.move(current_local_path, desired_local_path)
-                except IOError as e:
-                    if e.errno == errno.ENOENT:
-                        if ignore_nopath:
-                            msg = (
-                                '%s: ignoring since ignore_nopath '
-                                'was set to True'
-                            )
-                            LOGGER.debug(msg, remote_path)
-                        else:
-                            raise ExtractPathNoPathError(remote_path)
-                    else:
-                        raise
+            else:
+                raise ExtractPathNoPathError(remote_path)
 
     @check_running
     def _extract_paths_scp(self, paths, ignore_nopath):
@@ -494,11 +847,26 @@ class VMPlugin(with_metaclass(ABCMeta, plugins.Plugin)):
             **kwargs
         )
 
-    def copy_to(self, local_path, remote_path, recursive=True):
+    def copy_to(self, local_path, remote_path, recursive=True, compress=False):
+        """
+        Copy files to the VM, with scp semantics. Directories are streamed
+        as a tar archive over a single channel, if the VM has tar.
+
+        Args:
+            local_path(str): File or directory to copy
+            remote_path(str): Where to copy it to
+            recursive(bool): Whether to copy directories
+            compress(bool): Whether to gzip the tar archive
+        """
         with LogTask(
             'Copy %s to %s:%s' % (local_path, self.name(), remote_path),
         ):
             try:
+                if recursive and os.path.isdir(local_path) and \
+                        self._use_tar(compress):
+                    self._tar_copy_to(local_path, remote_path, compress)
+                    return
+
                 with self._scp() as scp:
                     scp.put(
                         files=local_path,
@@ -509,12 +877,38 @@ class VMPlugin(with_metaclass(ABCMeta, plugins.Plugin)):
                 raise LagoCopyFilesToVMError(local_path, str(err))
 
     def copy_from(
-        self, remote_path, local_path, recursive=True, propagate_fail=True
+        self,
+        remote_path,
+        local_path,
+        recursive=True,
+        propagate_fail=True,
+        compress=False,
     ):
+        """
+        Copy files from the VM, with scp semantics. If recursive, and the
+        VM has tar, they are streamed as a tar archive over a single
+        channel.
+
+        Args:
+            remote_path(str): File or directory to copy
+            local_path(str): Where to copy it to
+            recursive(bool): Whether to copy directories
+            propagate_fail(bool): If set to true, a failure will be in the
+                log and fail the outer stage
+            compress(bool): Whether to gzip the tar archive
+        """
         with LogTask(
             'Copy from %s:%s to %s' % (self.name(), remote_path, local_path),
             propagate_fail=propagate_fail
         ):
+            if recursive and posixpath.basename(
+                posixpath.normpath(remote_path)
+            ) not in ('', '/', '.', '..') and self._use_tar(compress):
+                self._tar_copy_from(
+                    remote_path, local_path, compress, propagate_fail
+                )
+                return
+
             try:
                 with self._scp(propagate_fail=propagate_fail) as scp:
                     scp.get(
@@ -537,6 +931,93 @@ class VMPlugin(with_metaclass(ABCMeta, plugins.Plugin)):
                         remote_path, local_path, err.args[0]
                     )
 
+    def _use_tar(self, compress):
+        tools = self.provider._get_guest_tools()
+        return 'tar' in tools and (not compress or 'gzip' in tools)
+
+    def _tar_copy_to(self, local_path, remote_path, compress):
+        local_path = os.path.normpath(local_path)
+        untar = 'tar -x{}f -'.format('z' if compress else '')
+        # Like scp, copy into the destination if it's a directory, or
+        # create the destination from the source otherwise
+        cmd = (
+            'if [ -d {dest} ]; then cd {dest} && {untar}; '
+            'else mkdir -p {dest} && cd {dest} && '
+            '{untar} --strip-components=1; fi'
+        ).format(
+            dest=shlex_quote(remote_path), untar=untar
+        )
+
+        with self._ssh() as client:
+            channel = client.get_transport().open_session()
+            try:
+                channel.exec_command(cmd)
+                try:
+                    with tarfile.open(
+                        fileobj=channel.makefile('wb'),
+                        mode='w|gz' if compress else 'w|',
+                        bufsize=TAR_STREAM_BUFSIZE,
+                    ) as tar:
+                        tar.add(
+                            local_path, arcname=os.path.basename(local_path)
+                        )
+                except socket.error:
+                    # The remote tar exited early, its errors tell why
+                    pass
+                channel.shutdown_write()
+                err = channel.makefile_stderr('rb').read()
+                code = channel.recv_exit_status()
+            finally:
+                channel.close()
+
+        if code != 0:
+            raise LagoCopyFilesToVMError(
+                local_path, err.decode('utf-8', 'replace')
+            )
+
+    def _tar_copy_from(
+        self, remote_path, local_path, compress, propagate_fail
+    ):
+        remote_path = posixpath.normpath(remote_path)
+        cmd = 'cd {parent} && tar -c{z}f - {name}'.format(
+            parent=shlex_quote(posixpath.dirname(remote_path) or '.'),
+            name=shlex_quote(posixpath.basename(remote_path)),
+            z='z' if compress else '',
+        )
+
+        with self._ssh(propagate_fail=propagate_fail) as client:
+            channel = client.get_transport().open_session()
+            try:
+                channel.exec_command(cmd)
+                channel.shutdown_write()
+                try:
+                    with tarfile.open(
+                        fileobj=channel.makefile('rb'),
+                        mode='r|gz' if compress else 'r|',
+                        bufsize=TAR_STREAM_BUFSIZE,
+                    ) as tar:
+                        extract_tar_stream(tar, local_path)
+                except tarfile.ReadError as err:
+                    # An empty stream when the remote tar failed, its exit
+                    # code and errors are checked below
+                    read_error = err
+                else:
+                    read_error = None
+                err = channel.makefile_stderr('rb').read()
+                code = channel.recv_exit_status()
+            finally:
+                channel.close()
+
+        err = err.decode('utf-8', 'replace')
+        if code != 0:
+            if ': No such file or directory' in err:
+                raise ExtractPathNoPathError(err)
+            raise LagoCopyFilesFromVMError(remote_path, local_path, err)
+        if read_error is not None:
+            raise LagoCopyFilesFromVMError(
+                remote_path, local_path, str(read_error)
+            )
+
     @property
     def metadata(self):
         return self._spec['metadata'].copy()
@@ -621,6 +1102,9 @@ class VMPlugin(with_metaclass(ABCMeta, plugins.Plugin)):
         show_output=True,
         propagate_fail=True,
         tries=None,
+        stdout=None,
+        stderr=None,
+        timeout=None,
     ):
         if not self.running():
             raise RuntimeError('Attempt to ssh into a not running host')
@@ -629,26 +1113,42 @@ class VMPlugin(with_metaclass(ABCMeta, plugins.Plugin)):
             ip_addr=self.ip(),
             host_name=self.name(),
             command=command,
-            data=None,
-            show_output=True,
-            propagate_fail=True,
-            tries=None,
+            data=data,
+            show_output=show_output,
+            propagate_fail=propagate_fail,
+            tries=tries,
             ssh_key=self.virt_env.prefix.paths.ssh_id_rsa(),
             username=self._spec.get('ssh-user'),
             password=self._spec.get('ssh-password'),
+            pool=self.virt_env.ssh_pool,
+            stdout=stdout,
+            stderr=stderr,
+            timeout=timeout,
         )
 
-    def wait_for_ssh(self):
+    def wait_for_ssh(self, probe_banner=True):
         return ssh.wait_for_ssh(
             ip_addr=self.ip(),
             host_name=self.name(),
-            connect_timeout=self._spec.get('boot_time_sec', 600),
+            connect_timeout=self.boot_time_sec(),
             ssh_key=self.virt_env.prefix.paths.ssh_id_rsa(),
             username=self._spec.get('ssh-user'),
             password=self._spec.get('ssh-password'),
+            pool=self.virt_env.ssh_pool,
+            probe_banner=probe_banner,
         )
 
-    def ssh_script(self, path, show_output=True):
+    def boot_time_sec(self):
+        return self._spec.get('boot_time_sec', 600)
+
+    def ssh_script(
+        self,
+        path,
+        show_output=True,
+        stdout=None,
+        stderr=None,
+        timeout=None,
+    ):
         return ssh.ssh_script(
             ip_addr=self.ip(),
             host_name=self.name(),
@@ -657,6 +1157,10 @@ class VMPlugin(with_metaclass(ABCMeta, plugins.Plugin)):
             show_output=show_output,
             username=self._spec.get('ssh-user'),
             password=self._spec.get('ssh-password'),
+            pool=self.virt_env.ssh_pool,
+            stdout=stdout,
+            stderr=stderr,
+            timeout=timeout,
         )
 
     def ssh_reachable(self, tries=None, propagate_fail=True):
@@ -674,7 +1178,7 @@ class VMPlugin(with_metaclass(ABCMeta, plugins.Plugin)):
             return False
 
         try:
-            ssh.get_ssh_client(
+            with self.virt_env.ssh_pool.client(
                 ip_addr=self.ip(),
                 host_name=self.name(),
                 ssh_tries=tries,
@@ -682,12 +1186,23 @@ class VMPlugin(with_metaclass(ABCMeta, plugins.Plugin)):
                 ssh_key=self.virt_env.prefix.paths.ssh_id_rsa(),
                 username=self._spec.get('ssh-user'),
                 password=self._spec.get('ssh-password'),
-            )
+            ):
+                pass
         except ssh.LagoSSHTimeoutException:
             return False
 
         return True
 
+    def discard_ssh_connection(self):
+        """
+        Drop the pooled SSH connection to the VM, if there is one
+        """
+        self.virt_env.ssh_pool.discard(
+            ip_addr=self.ip(),
+            username=self._spec.get('ssh-user'),
+            ssh_key=self.virt_env.prefix.paths.ssh_id_rsa(),
+        )
+
     def save(self, path=None):
         if path is None:
             path = self.virt_env.virt_path('vm-%s' % self.name())
@@ -718,6 +1233,7 @@ class VMPlugin(with_metaclass(ABCMeta, plugins.Plugin)):
             command=command,
             username=self._spec.get('ssh-user'),
             password=self._spec.get('ssh-password'),
+            pool=self.virt_env.ssh_pool,
         )
 
     def nics(self):
@@ -740,16 +1256,123 @@ class VMPlugin(with_metaclass(ABCMeta, plugins.Plugin)):
 
         return root_password
 
-    def collect_artifacts(self, host_path, ignore_nopath):
-        self.extract_paths(
-            [
-                (
+    def collect_artifacts(
+        self,
+        host_path,
+        ignore_nopath,
+        compression=None,
+        incremental=False,
+        previous_path=None,
+    ):
+        """
+        Collect the artifacts of the VM into host_path
+
+        Args:
+            host_path(str): Directory to put the artifacts in
+            ignore_nopath(bool): Whether to ignore missing artifacts
+            compression(str): How to compress the artifacts on the wire, see
+                :func:`VMProviderPlugin.extract_paths`
+            incremental(bool): If True, transfer only the files that were
+                added or changed since the collection in previous_path, and
+                hard link the rest from there
+            previous_path(str): Directory of the previous collection of
+                this VM
+
+        Returns:
+            None
+        """
+        paths = [
+            (
+                guest_path,
+                os.path.join(host_path, guest_path.replace('/', '_')),
+            ) for guest_path in self._artifact_paths()
+        ]
+        listing = None
+        if incremental:
+            try:
+                if self.provider._has_tar():
+                    listing = self.provider.list_paths(
+                        [path for path, _ in paths]
+                    )
+            except (ssh.LagoSSHTimeoutException, LagoVMNotRunningError):
+                LOGGER.debug(
+                    '%s: unreachable with SSH, collecting all the artifacts',
+                    self.name(),
+                )
+
+        if listing is not None:
+            self._collect_artifacts_incremental(
+                paths, listing, host_path, ignore_nopath, compression,
+                previous_path
+            )
+        else:
+            self.extract_paths(
+                paths,
+                ignore_nopath=ignore_nopath,
+                compression=compression,
+            )
+
+    def _collect_artifacts_incremental(
+        self, paths, listing, host_path, ignore_nopath, compression,
+        previous_path
+    ):
+        previous = {}
+        if previous_path:
+            try:
+                with open(os.path.join(previous_path, COLLECT_MANIFEST)) as f:
+                    previous = json.load(f)
+            except (IOError, ValueError) as err:
+                LOGGER.debug(
+                    '%s: no usable manifest in %s, collecting everything: %s',
+                    self.name(),
+                    previous_path,
+                    err,
+                )
+
+        manifest = {}
+        to_extract = []
+        for guest_path, local_path in paths:
+            entry = listing.get(guest_path)
+            if entry is None:
+                if not ignore_nopath:
+                    raise ExtractPathNoPathError(guest_path)
+                LOGGER.debug(
+                    '%s: ignoring since ignore_nopath was set to True',
                     guest_path,
-                    os.path.join(host_path, guest_path.replace('/', '_')),
-                ) for guest_path in self._artifact_paths()
-            ],
-            ignore_nopath=ignore_nopath
+                )
+                continue
+
+            root = posixpath.normpath(guest_path)
+            for guest_dir in entry['dirs']:
+                local_dir = local_path + guest_dir[len(root):]
+                if not os.path.isdir(local_dir):
+                    os.makedirs(local_dir)
+
+            for guest_file, stat in entry['files'].items():
+                local_file = local_path + guest_file[len(root):]
+                name = os.path.relpath(local_file, host_path)
+                manifest[name] = stat
+                if previous_path and previous.get(name) == stat:
+                    previous_file = os.path.join(previous_path, name)
+                    if os.path.isfile(previous_file):
+                        _link_or_copy(previous_file, local_file)
+                        continue
+                to_extract.append((guest_file, local_file))
+
+        LOGGER.debug(
+            '%s: %d of %d files changed since the previous collection',
+            self.name(),
+            len(to_extract),
+            len(manifest),
         )
+        # Files may be gone by now, those were listed but are not required
+        self.extract_paths(
+            to_extract,
+            ignore_nopath=True,
+            compression=compression,
+        )
+        with open(os.path.join(host_path, COLLECT_MANIFEST), 'w') as f:
+            json.dump(manifest, f)
 
     def guest_agent(self):
         if 'guest-agent' not in self._spec:
@@ -802,18 +1425,15 @@ class VMPlugin(with_metaclass(ABCMeta, plugins.Plugin)):
 
     @contextlib.contextmanager
     def _ssh(self, propagate_fail=True):
-        client = ssh.get_ssh_client(
+        with self.virt_env.ssh_pool.client(
             propagate_fail=propagate_fail,
             ip_addr=self.ip(),
             host_name=self.name(),
             ssh_key=self.virt_env.prefix.paths.ssh_id_rsa(),
             username=self._spec.get('ssh-user'),
             password=self._spec.get('ssh-password'),
-        )
-        try:
+        ) as client:
             yield client
-        finally:
-            client.close()
 
     @contextlib.contextmanager
     def _scp(self, propagate_fail=True):
@@ -20,6 +20,7 @@
 
 from __future__ import absolute_import
 
+from concurrent import futures
 import copy
 import functools
 import glob
@@ -29,7 +30,6 @@ import os
 import shutil
 import subprocess
 from textwrap import dedent
-import time
 import uuid
 import warnings
 import pkg_resources
@@ -39,10 +39,12 @@ from lago.plugins.output import YAMLOutFormatPlugin
 import xmltodict
 
 import six
+from netaddr import IPAddress, IPNetwork
 from six.moves.urllib import request as urllib
 from six.moves import urllib_parse as urlparse
 
 import lago.build as build
+import lago.chunk_store as chunk_store
 import lago.log_utils as log_utils
 import lago.paths as paths
 import lago.sdk_utils as sdk_utils
@@ -50,6 +52,7 @@ import lago.subnet_lease as subnet_lease
 import lago.utils as utils
 import lago.virt as virt
 
+from lago.config import config
 from lago.utils import LagoInitException, LagoException
 
 LOGGER = logging.getLogger(__name__)
@@ -57,41 +60,78 @@ LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
 log_task = functools.partial(log_utils.log_task, logger=LOGGER)
 
 
+def _to_network(subnet):
+    """
+    Args:
+        subnet (str): Subnet in CIDR notation, or a full ip (X.Y.Z.A) or the
+            three first elements of the decimal representation of a subnet
+            (X.Y.Z), which are taken as a 255.255.255.0 mask subnet
+
+    Returns:
+        netaddr.IPNetwork: The subnet
+    """
+    if '/' not in subnet:
+        subnet = '.'.join(subnet.split('.')[:3] + ['0']) + '/24'
+    return IPNetwork(subnet).cidr
+
+
+def _net_subnet(net_spec):
+    """
+    Args:
+        net_spec (dict): Network spec
+
+    Returns:
+        str: The subnet of the network in CIDR notation, specs without a
+            subnet are of 255.255.255.0 mask subnets
+    """
+    return net_spec.get('subnet') or str(_to_network(net_spec['gw']))
+
+
 def _create_ip(subnet, index):
     """
-    Given a subnet or an ip and an index returns the ip with that lower index
-    from the subnet (255.255.255.0 mask only subnets)
+    Given a subnet or an ip and an index returns the ip with that index in
+    the subnet
 
     Args:
-        subnet (str): Strign containing the three first elements of the decimal
-            representation of a subnet (X.Y.Z) or a full ip (X.Y.Z.A)
-        index (int or str): Last element of a decimal ip representation, for
-            example, 123 for the ip 1.2.3.123
+        subnet (str): Subnet, see :func:`_to_network` for the accepted forms
+        index (int or str): Offset of the ip in the subnet, for example, 123
+            for the ip 1.2.3.123 in 1.2.3.0/24
 
     Returns:
         str: The dotted decimal representation of the ip
     """
-    return '.'.join(subnet.split('.')[:3] + [str(index)])
+    network = _to_network(subnet)
+    return str(IPAddress(network.first + int(index), network.version))
 
 
-def _ip_in_subnet(subnet, ip):
+def _ip_index(subnet, ip):
+    """
+    Args:
+        subnet (str): Subnet, see :func:`_to_network` for the accepted forms
+        ip (str): Decimal ip representation
+
+    Returns:
+        int: The offset of the ip in the subnet, for example, 123 for the ip
+            1.2.3.123 in 1.2.3.0/24
     """
-    Checks if an ip is included in a subnet.
+    return int(IPAddress(ip)) & int(_to_network(subnet).hostmask)
+
 
-    Note:
-        only 255.255.255.0 masks allowed
+def _ip_in_subnet(subnet, ip):
+    """
+    Checks if an ip is included in a subnet, or is only an offset in it
+    (for example 0.0.0.5)
 
     Args:
-        subnet (str): Strign containing the three first elements of the decimal
-            representation of a subnet (X.Y.Z) or a full ip (X.Y.Z.A)
+        subnet (str): Subnet, see :func:`_to_network` for the accepted forms
         ip (str or int): Decimal ip representation
 
     Returns:
         bool: ``True`` if ip is in subnet, ``False`` otherwise
     """
     return (
-        _create_ip(subnet, 1) == _create_ip(ip, 1)
-        or '0.0.0.1' == _create_ip(ip, 1)
+        IPAddress(ip) in _to_network(subnet)
+        or int(IPAddress(ip)) == _ip_index(subnet, ip)
     )
 
 
@@ -274,27 +314,22 @@ class Prefix(object):
         Returns:
             tuple(list, dict): allocated subnets and modified conf
         """
-        allocated_subnets = []
-        try:
-            for net_spec in six.itervalues(conf.get('nets', {})):
-                if net_spec['type'] != 'nat':
-                    continue
-
-                gateway = net_spec.get('gw')
-                if gateway:
-                    allocated_subnet = self._subnet_store.acquire(
-                        self.paths.uuid(), gateway
-                    )
-                else:
-                    allocated_subnet = self._subnet_store.acquire(
-                        self.paths.uuid()
-                    )
-                    net_spec['gw'] = str(next(allocated_subnet.iter_hosts()))
+        nat_specs = [
+            net_spec for net_spec in six.itervalues(conf.get('nets', {}))
+            if net_spec['type'] == 'nat'
+        ]
+        requested = [spec for spec in nat_specs if spec.get('gw')]
+        free = [spec for spec in nat_specs if not spec.get('gw')]
+        allocated_subnets = self._subnet_store.acquire_many(
+            self.paths.uuid(),
+            count=len(free),
+            requested=[spec['gw'] for spec in requested],
+        )
+        for net_spec, subnet in zip(free, allocated_subnets[len(requested):]):
+            net_spec['gw'] = str(next(subnet.iter_hosts()))
+        for net_spec, subnet in zip(requested + free, allocated_subnets):
+            net_spec['subnet'] = str(subnet.cidr)
 
-                allocated_subnets.append(allocated_subnet)
-        except:
-            self._subnet_store.release(allocated_subnets)
-            raise
         return allocated_subnets, conf
 
     def _add_nic_to_mapping(self, net, dom, nic):
@@ -434,13 +469,14 @@ class Prefix(object):
                     continue
 
                 net = conf['nets'][nic['net']]
-                if self._subnet_store.is_leasable_subnet(net['gw']):
+                subnet = _net_subnet(net)
+                if self._subnet_store.is_leasable_subnet(subnet):
                     nic['ip'] = _create_ip(
-                        net['gw'], int(nic['ip'].split('.')[-1])
+                        subnet, _ip_index(subnet, nic['ip'])
                     )
 
                 dom_name = dom_spec['name']
-                if not _ip_in_subnet(net['gw'], nic['ip']):
+                if not _ip_in_subnet(subnet, nic['ip']):
                     raise RuntimeError(
                         "%s:nic%d's IP [%s] is outside the subnet [%s]" % (
                             dom_name,
@@ -503,14 +539,16 @@ class Prefix(object):
                 if net['type'] != 'nat':
                     continue
 
-                allocated = net['mapping'].values()
-                vacant = _create_ip(
-                    net['gw'],
-                    set(range(2, 255)).difference(
-                        set([int(ip.split('.')[-1]) for ip in allocated])
-                    ).pop()
+                subnet = _net_subnet(net)
+                allocated = set(
+                    _ip_index(subnet, ip) for ip in net['mapping'].values()
+                )
+                vacant = next(
+                    index for index in range(2,
+                                             IPNetwork(subnet).size - 1)
+                    if index not in allocated
                 )
-                nic['ip'] = vacant
+                nic['ip'] = _create_ip(subnet, vacant)
                 self._add_nic_to_mapping(net, dom_spec, nic)
 
     def _set_mtu_to_nics(self, conf):
@@ -700,6 +738,8 @@ class Prefix(object):
 
         if url:
             disk_spec['path'] = self._retrieve_disk_url(url, disk_path)
+        elif chunk_store.is_manifest(disk_path):
+            disk_spec['path'] = self._rebuild_from_manifest(disk_path)
         else:
             # Create a copy of the file or use the original
             if disk_spec.get('make_a_copy'):
@@ -717,6 +757,30 @@ class Prefix(object):
         disk_path = disk_spec['path']
         return disk_path, disk_metadata
 
+    def _rebuild_from_manifest(self, manifest_path, image_format=None):
+        """
+        Rebuild an image exported to a chunk store into the images dir of
+        this prefix
+
+        Args:
+            manifest_path (str): Path to the manifest of the image
+            image_format (str or None): Format to rebuild the image in, the
+                one in the manifest if not passed
+
+        Returns:
+            str: Path to the rebuilt image
+        """
+        manifest_path = os.path.expandvars(manifest_path)
+        name = os.path.basename(manifest_path
+                                )[:-len(chunk_store.MANIFEST_SUFFIX)]
+        if image_format is not None:
+            name = '%s.%s' % (name, image_format)
+        dest_path = self._generate_disk_path(name)
+        chunk_store.rebuild_image(manifest_path, dest_path, image_format)
+        # To avoid losing access to the file
+        os.chmod(dest_path, 0o666)
+        return dest_path
+
     def _retrieve_disk_url(self, disk_url, disk_dst_path=None):
         disk_in_prefix = self.fetch_url(disk_url)
         if disk_dst_path is None:
@@ -842,10 +906,17 @@ class Prefix(object):
         if not base_path:
             raise RuntimeError('Partial drive spec %s' % str(template_spec))
 
-        self.resolve_parent(base_path, template_store, template_repo)
+        if chunk_store.is_manifest(base_path):
+            # The whole chain was merged into the chunks, so the rebuilt
+            # image is the only base
+            base_path = self._rebuild_from_manifest(base_path, 'raw')
+            base_format = 'raw'
+        else:
+            self.resolve_parent(base_path, template_store, template_repo)
+            base_format = 'qcow2'
 
         qemu_cmd = [
-            'qemu-img', 'create', '-f', 'qcow2', '-F', 'qcow2', '-b',
+            'qemu-img', 'create', '-f', 'qcow2', '-F', base_format, '-b',
             base_path, disk_path
         ]
         disk_metadata = template_spec.get('metadata', {})
@@ -937,6 +1008,9 @@ class Prefix(object):
         template_version = template.get_version(
             template_spec.get('template_version', None)
         )
+        # Register as a user before downloading, so the template can't be
+        # evicted from the store while this prefix exists
+        template_store.mark_used(template_version, self.paths.uuid())
         if template_version not in template_store:
             LOGGER.info(
                 log_utils.log_always("Template %s not in cache, downloading") %
@@ -950,9 +1024,10 @@ class Prefix(object):
             ),
         )
         base = template_store.get_path(template_version)
+        base_format = template_store.get_stored_format(template_version)
         qemu_cmd = [
             'qemu-img', 'create', '-f', 'qcow2', '-o', 'lazy_refcounts=on',
-            '-b', base, disk_path
+            '-F', base_format, '-b', base, disk_path
         ]
         return qemu_cmd, disk_metadata, base
 
@@ -1139,15 +1214,18 @@ class Prefix(object):
             conf['domains'][dom_name] = self._prepare_domain_image(
                 domain_spec=dom_spec,
                 prototypes=conf.get('prototypes', {}),
+            )
+
+        with LogTask('Create disks'):
+            self._create_domains_disks(
+                domains_specs=list(conf['domains'].values()),
                 template_repo=template_repo,
                 template_store=template_store,
             )
 
         return conf
 
-    def _prepare_domain_image(
-        self, domain_spec, prototypes, template_repo, template_store
-    ):
+    def _prepare_domain_image(self, domain_spec, prototypes):
         if 'based-on' in domain_spec:
             domain_spec = self._use_prototype(
                 spec=domain_spec,
@@ -1157,14 +1235,6 @@ class Prefix(object):
         if domain_spec.get('type', '') == 'ova':
             domain_spec = self._handle_ova_image(domain_spec=domain_spec)
 
-        with LogTask('Create disks for VM %s' % domain_spec['name']):
-            domain_spec['disks'] = self._create_disks(
-                domain_name=domain_spec['name'],
-                disks_specs=domain_spec.get('disks', []),
-                template_repo=template_repo,
-                template_store=template_store,
-            )
-
         return domain_spec
 
     def _handle_ova_image(self, domain_spec):
@@ -1181,23 +1251,62 @@ class Prefix(object):
 
         return domain_spec
 
-    def _create_disks(
-        self, domain_name, disks_specs, template_repo, template_store
+    def _create_domains_disks(
+        self, domains_specs, template_repo, template_store
     ):
-        new_disks = []
-        for disk in disks_specs:
+        """
+        Creates the disks of all the given domains, using a bounded pool of
+        workers (see the ``disk_workers`` config option). Templates are
+        downloaded only once, as the template store serializes the
+        downloads of the same template version
+
+        Args:
+            domains_specs (list of dict): domain specs, their ``disks``
+                entries will be replaced with the created disks
+            template_repo (TemplateRepository or None): template repo instance
+                to use
+            template_store (TemplateStore or None): template store instance to
+                use
+
+        Returns:
+            None
+
+        Raises:
+            RuntimeError: If any of the disks failed to be created, after
+                waiting for all the other disks to finish
+        """
+        disks_jobs = [
+            (domain_spec, disk_spec)
+            for domain_spec in domains_specs
+            for disk_spec in domain_spec.get('disks', [])
+        ]
+
+        def create_disk(domain_spec, disk_spec):
             path, metadata = self._create_disk(
-                name=domain_name,
-                spec=disk,
+                name=domain_spec['name'],
+                spec=disk_spec,
                 template_repo=template_repo,
                 template_store=template_store,
             )
-            new_disk = copy.deepcopy(disk)
+            new_disk = copy.deepcopy(disk_spec)
             new_disk['path'] = path
             new_disk['metadata'] = metadata
-            new_disks.append(new_disk)
+            return new_disk
 
-        return new_disks
+        if not disks_jobs:
+            return
+
+        new_disks = iter(
+            utils.invoke_in_parallel(
+                create_disk,
+                *zip(*disks_jobs),
+                max_workers=int(config.get('disk_workers'))
+            )
+        )
+        for domain_spec in domains_specs:
+            domain_spec['disks'] = [
+                next(new_disks) for _ in domain_spec.get('disks', [])
+            ]
 
     def virt_conf(
         self,
@@ -1287,6 +1396,9 @@ class Prefix(object):
         out_format=YAMLOutFormatPlugin(),
         collect_only=False,
         with_threads=True,
+        compression=None,
+        chunked=False,
+        since=None,
     ):
         """
         Export vm images disks and init file.
@@ -1299,8 +1411,7 @@ class Prefix(object):
             standalone(bool): If false, export a layered image
                 (default=False)
             export_dir(str): Dir to place the exported images and init file
-            compress(bool): If True compress the images with xz
-                  (default=False)
+            compress(bool): If True compress the images (default=False)
             init_file_name(str): The name of the exported init file
                 (default='LagoInitfile')
             out_format(:class:`lago.plugins.output.OutFormatPlugin`):
@@ -1309,6 +1420,17 @@ class Prefix(object):
                 to the disks that will be exported. (default=False)
             with_threads(bool): If True, run the export in parallel
                 (default=True)
+            compression(str): Codec to compress the images with, one of
+                :data:`lago.compression.CODECS`, defaults to the
+                ``export_compression`` setting
+            chunked(bool): If True, export the disks into a chunk store
+                shared by all of them, with a manifest for each disk, see
+                :class:`lago.export.ChunkedExportManager`. The disks are
+                always standalone and not compressed then
+            since(str): If given, export only the changes made to the disks
+                since the snapshot with this name was taken, as qcow2 layers
+                on top of the images the disks had then, see
+                :class:`lago.export.DeltaExportManager`
 
         Returns
             Unless collect_only == True, a mapping between vms' disks.
@@ -1316,7 +1438,7 @@ class Prefix(object):
         """
         return self.virt_env.export_vms(
             vms_names, standalone, export_dir, compress, init_file_name,
-            out_format, collect_only, with_threads
+            out_format, collect_only, with_threads, compression, chunked, since
         )
 
     @sdk_utils.expose
@@ -1523,9 +1645,26 @@ class Prefix(object):
 
     @sdk_utils.expose
     @log_task('Collect artifacts')
-    def collect_artifacts(self, output_dir, ignore_nopath):
+    def collect_artifacts(
+        self, output_dir, ignore_nopath, compression=None, incremental=False
+    ):
+        """
+        Collect the artifacts of all the VMs, each VM's are streamed
+        straight into their place, concurrently with the other VMs.
+
+        Args:
+            output_dir(str): Where to put the artifacts, the VMs get a
+                sub directory each
+            ignore_nopath(bool): Whether to ignore missing artifacts
+            compression(str): How to compress the artifacts on the wire, see
+                :func:`lago.plugins.vm.VMProviderPlugin.extract_paths`
+            incremental(bool): If True, and a previous collection exists in
+                output_dir, only the files that were added or changed since
+                are transferred, the rest are hard linked from it
+        """
+        previous_dir = None
         if os.path.exists(output_dir):
-            utils.rotate_dir(output_dir)
+            previous_dir = utils.rotate_dir(output_dir)
 
         os.makedirs(output_dir)
 
@@ -1533,7 +1672,16 @@ class Prefix(object):
             with LogTask('%s' % vm.name()):
                 path = os.path.join(output_dir, vm.name())
                 os.makedirs(path)
-                vm.collect_artifacts(path, ignore_nopath)
+                previous_path = None
+                if previous_dir:
+                    previous_path = os.path.join(previous_dir, vm.name())
+                vm.collect_artifacts(
+                    path,
+                    ignore_nopath,
+                    compression,
+                    incremental=incremental,
+                    previous_path=previous_path,
+                )
 
         utils.invoke_in_parallel(
             _collect_artifacts,
@@ -1648,16 +1796,7 @@ class Prefix(object):
 
     def _deploy_host(self, host):
         with LogTask('Deploy VM %s' % host.name()):
-            deploy_scripts = self._get_scripts(host.metadata)
-            if not deploy_scripts:
-                return
-
-            with LogTask('Wait for ssh connectivity'):
-                if not host.ssh_reachable(tries=1, propagate_fail=False):
-                    time.sleep(10)
-                    host.wait_for_ssh()
-
-            for script in deploy_scripts:
+            for script in self._get_scripts(host.metadata):
                 script = os.path.expanduser(os.path.expandvars(script))
                 with LogTask('Run script %s' % os.path.basename(script)):
                     ret, out, err = host.ssh_script(script, show_output=False)
@@ -1673,12 +1812,79 @@ class Prefix(object):
                         ),
                     )
 
+    @sdk_utils.expose
+    def exec_on_vms(
+        self,
+        command=None,
+        script=None,
+        names=None,
+        groups=None,
+        vm_types=None,
+        max_workers=None,
+        timeout=None,
+    ):
+        """
+        Run a command or a script on several VMs concurrently, see
+        :meth:`lago.virt.VirtEnv.select_vms` for how the VMs are selected.
+
+        Args:
+            command (list of str): Command to run
+            script (str): Path to a script to run, instead of ``command``
+            names (list of str): Names of VMs to run on
+            groups (list of str): Run on the VMs in these groups
+            vm_types (list of str): Run on the VMs of these types
+            max_workers (int): Maximal number of VMs to run on at once,
+                defaults to the ``exec_workers`` setting
+            timeout (int): Seconds each VM has to complete the command
+
+        Yields:
+            tuple of str and lago.utils.CommandStatus: The name of each VM
+                and its result, as soon as it completes. If the command
+                could not be run, or timed out, the code is -1 and the
+                errors hold the reason.
+        """
+        if (command is None) == (script is None):
+            raise utils.LagoUserException(
+                'Exactly one of a command or a script should be given'
+            )
+
+        vms = self.virt_env.select_vms(names, groups, vm_types)
+        if max_workers is None:
+            max_workers = int(config.get('exec_workers'))
+
+        def _exec(vm):
+            try:
+                if script is not None:
+                    return vm.ssh_script(
+                        script, show_output=False, timeout=timeout
+                    )
+                return vm.ssh(command, show_output=False, timeout=timeout)
+            except Exception as err:
+                LOGGER.debug('Failed to run on %s', vm.name(), exc_info=True)
+                return utils.CommandStatus(-1, b'', str(err).encode())
+
+        if not vms:
+            return
+
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = {pool.submit(_exec, vm): vm.name() for vm in vms}
+            for result in futures.as_completed(results):
+                yield results[result], result.result()
+
     @sdk_utils.expose
     @log_task('Deploy environment')
     def deploy(self):
-        utils.invoke_in_parallel(
-            self._deploy_host, list(self.virt_env.get_vms().values())
-        )
+        hosts = [
+            host for host in self.virt_env.get_vms().values()
+            if self._get_scripts(host.metadata)
+        ]
+        if not hosts:
+            return
+
+        with LogTask('Wait for ssh connectivity'):
+            self.virt_env.wait_for_ssh(hosts)
+
+        utils.invoke_in_parallel(self._deploy_host, hosts)
 
 
 class LagoDeployError(LagoException):
@@ -27,11 +27,11 @@ import time
 from copy import deepcopy
 
 import six
+from netaddr import IPAddress, IPNetwork
 
 from lxml import etree as ET
 import lago.providers.libvirt.utils as libvirt_utils
 from lago import brctl, log_utils, utils
-import libvirt
 
 LOGGER = logging.getLogger(__name__)
 LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
@@ -40,15 +40,13 @@ LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
 class Network(object):
     def __init__(self, env, spec, compat):
         self._env = env
-        self.libvirt_con = libvirt_utils.get_libvirt_connection(
-            name=env.uuid,
-        )
+        self._libvirt = libvirt_utils.get_shared_connection()
         self._spec = spec
         self.compat = compat
 
-    def __del__(self):
-        if self.libvirt_con is not None:
-            self.libvirt_con.close()
+    @property
+    def libvirt_con(self):
+        return self._libvirt.con
 
     def name(self):
         return self._spec['name']
@@ -56,8 +54,16 @@ class Network(object):
     def gw(self):
         return self._spec.get('gw')
 
+    def subnet(self):
+        """
+        Returns:
+            netaddr.IPNetwork: The subnet of the network, specs that predate
+                subnet pools are all /24
+        """
+        return IPNetwork(self._spec.get('subnet') or self.gw() + '/24').cidr
+
     def mtu(self):
-        if self.libvirt_con.getLibVersion() > 3001001:
+        if self._libvirt.lib_version > 3001001:
             return self._spec.get('mtu', '1500')
         else:
             return '1500'
@@ -90,10 +96,14 @@ class Network(object):
         )
 
     def alive(self):
-        flags = libvirt.VIR_CONNECT_LIST_NETWORKS_TRANSIENT \
-            | libvirt.VIR_CONNECT_LIST_NETWORKS_ACTIVE
+        snapshot = self._env.current_state_snapshot
+        if snapshot is not None:
+            return self._libvirt_name() in snapshot.networks
+
         net_names = [
-            net.name() for net in self.libvirt_con.listAllNetworks(flags)
+            net.name()
+            for net in self.libvirt_con.
+            listAllNetworks(libvirt_utils.ACTIVE_NETWORKS_FLAGS)
         ]
         return self._libvirt_name() in net_names
 
@@ -139,6 +149,9 @@ class Network(object):
                 self.libvirt_con.networkLookupByName(
                     self._libvirt_name(),
                 ).destroy()
+            snapshot = self._env.current_state_snapshot
+            if snapshot is not None:
+                snapshot.remove_network(self._libvirt_name())
 
     def save(self):
         with open(self._env.virt_path('net-%s' % self.name()), 'w') as f:
@@ -159,10 +172,10 @@ class NATNetwork(Network):
         dns = ET.Element('dns', enable='no')
         return dns
 
-    def _generate_main_dns(self, records, subnet, forward_plain='no'):
+    def _generate_main_dns(self, records, forward_plain='no'):
         dns = ET.Element('dns', forwardPlainNames=forward_plain)
         reverse_records = defaultdict(list)
-        ipv6_prefix = self._ipv6_prefix(subnet=subnet)
+        ipv6_prefix = self._ipv6_prefix()
         for hostname, ip in six.iteritems(records):
             reverse_records[ip] = reverse_records[ip] + [hostname]
         for ip, hostnames in six.iteritems(reverse_records):
@@ -178,21 +191,29 @@ class NATNetwork(Network):
 
         return dns
 
-    def _ipv6_prefix(self, subnet, const='fd8f:1391:3a82:'):
-        return '{0}{1}::'.format(const, subnet)
+    def _ipv6_prefix(self, const='fd8f:1391:3a82:'):
+        subnet = self.subnet()
+        if subnet.prefixlen == 24:
+            return '{0}{1}::'.format(const, str(subnet.ip).split('.')[2])
+        # Made of the whole IPv4 subnet address, as the third octet does not
+        # identify other subnets
+        return 'fd8f:1391:{0:x}:{1:x}::'.format(
+            subnet.first >> 16, subnet.first & 0xffff
+        )
 
     def _libvirt_xml(self):
         net_raw_xml = libvirt_utils.get_template('net_nat_template.xml')
 
-        subnet = self.gw().split('.')[2]
-        ipv6_prefix = self._ipv6_prefix(subnet=subnet)
+        subnet = self.subnet()
+        ipv6_prefix = self._ipv6_prefix()
         mtu = self.mtu()
 
         replacements = {
             '@NAME@': self._libvirt_name(),
             '@BR_NAME@': ('%s-nic' % self._libvirt_name())[:12],
             '@GW_ADDR@': self.gw(),
-            '@SUBNET@': subnet
+            '@NETMASK@': str(subnet.netmask),
+            '@IPV6_PREFIX@': ipv6_prefix,
         }
         for k, v in replacements.items():
             net_raw_xml = net_raw_xml.replace(k, v, 1)
@@ -210,7 +231,7 @@ class NATNetwork(Network):
             ipv6 = net_xml.xpath('/network/ip')[1]
 
             def make_ipv4(last):
-                return '.'.join(self.gw().split('.')[:-1] + [str(last)])
+                return str(IPAddress(subnet.first + int(last)))
 
             dhcp = ET.Element('dhcp')
             dhcpv6 = ET.Element('dhcp')
@@ -265,10 +286,10 @@ class NATNetwork(Network):
                 )
                 net_xml.append(domain_xml)
                 net_xml.append(
-                    self._generate_main_dns(self._spec['dns_records'], subnet)
+                    self._generate_main_dns(self._spec['dns_records'])
                 )
             else:
-                if self.libvirt_con.getLibVersion() < 2002000:
+                if self._libvirt.lib_version < 2002000:
                     net_xml.append(
                         self._generate_dns_forward(self._spec['dns_forward'])
                     )
@@ -292,7 +313,7 @@ class NATNetwork(Network):
 
                 net_xml.append(
                     self._generate_main_dns(
-                        self._spec['mapping'], subnet, forward_plain='yes'
+                        self._spec['mapping'], forward_plain='yes'
                     )
                 )
             else:
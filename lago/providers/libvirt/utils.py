@@ -27,6 +27,7 @@ import xmltodict
 import lxml.etree
 import logging
 import pkg_resources
+import threading
 from jinja2 import Environment, PackageLoader, TemplateNotFound
 from lago.config import config
 
@@ -49,6 +50,10 @@ DOMAIN_RUNNING_STATES = {
     libvirt.VIR_DOMAIN_RUNNING,
 }
 
+#: Flags to list the networks that are up
+ACTIVE_NETWORKS_FLAGS = libvirt.VIR_CONNECT_LIST_NETWORKS_TRANSIENT \
+    | libvirt.VIR_CONNECT_LIST_NETWORKS_ACTIVE
+
 
 class Domain(object):
     """
@@ -85,17 +90,174 @@ def auth_callback(credentials, user_data):
     return 0
 
 
-def get_libvirt_connection(name):
+def _open_connection(libvirt_url):
     auth = [
         [libvirt.VIR_CRED_AUTHNAME, libvirt.VIR_CRED_PASSPHRASE],
         auth_callback, None
     ]
-    libvirt_url = config.get('libvirt_url', 'qemu:///system')
 
     libvirt.registerErrorHandler(f=libvirt_callback, ctx=None)
     return libvirt.openAuth(libvirt_url, auth)
 
 
+def get_libvirt_connection(name):
+    return _open_connection(config.get('libvirt_url', 'qemu:///system'))
+
+
+class SharedConnection(object):
+    """
+    A libvirt connection that is shared by all the users of the same URL in
+    the process, see :func:`get_shared_connection`.
+
+    The connection is reopened if it was lost (for example, when libvirtd
+    was restarted), and the host capabilities and libvirt version are
+    fetched only once for each opened connection.
+
+    Attributes:
+        url(str): libvirt URL of the connection
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self._lock = threading.RLock()
+        self._con = None
+        self._caps = None
+        self._host_cpu = None
+        self._lib_version = None
+
+    @property
+    def con(self):
+        """
+        Returns:
+            libvirt.virConnect: The connection, reopened if it was lost
+        """
+        with self._lock:
+            if self._con is None or not _is_alive(self._con):
+                self._connect()
+            return self._con
+
+    def _connect(self):
+        if self._con is not None:
+            LOGGER.debug(
+                'Lost the libvirt connection to %s, reconnecting', self.url
+            )
+            self._close()
+
+        self._con = _open_connection(self.url)
+        self._caps = None
+        self._host_cpu = None
+        self._lib_version = None
+
+    @property
+    def caps(self):
+        """
+        Returns:
+            lxml.etree.Element: The capabilities of the host
+        """
+        with self._lock:
+            con = self.con
+            if self._caps is None:
+                self._caps = lxml.etree.fromstring(con.getCapabilities())
+            return self._caps
+
+    @property
+    def host_cpu(self):
+        """
+        Returns:
+            lxml.etree.Element: The CPU element of the host capabilities
+        """
+        with self._lock:
+            caps = self.caps
+            if self._host_cpu is None:
+                self._host_cpu = caps.xpath('host/cpu')[0]
+            return self._host_cpu
+
+    @property
+    def lib_version(self):
+        """
+        Returns:
+            int: The version of libvirt
+        """
+        with self._lock:
+            con = self.con
+            if self._lib_version is None:
+                self._lib_version = con.getLibVersion()
+            return self._lib_version
+
+    def _close(self):
+        try:
+            self._con.close()
+        except libvirt.libvirtError as err:
+            LOGGER.debug('Failed closing libvirt connection: %s', err)
+        self._con = None
+
+    def close(self):
+        with self._lock:
+            if self._con is not None:
+                self._close()
+
+
+class StateSnapshot(object):
+    """
+    The states of all the domains, and the names of the active networks, of
+    a libvirt connection, each fetched with a single call.
+
+    Domains and networks that are destroyed while the snapshot is in use
+    should be removed from it with :func:`remove_domain` and
+    :func:`remove_network`.
+
+    Attributes:
+        domains(dict of str: list of int): The state and its reason, as
+            returned by :func:`libvirt.virDomain.state`, of each domain
+        networks(set of str): Names of the active networks
+    """
+
+    def __init__(self, con):
+        self.domains = dict(
+            (dom.name(), [stats['state.state'], stats['state.reason']])
+            for dom, stats in
+            con.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE)
+        )
+        self.networks = set(
+            net.name() for net in con.listAllNetworks(ACTIVE_NETWORKS_FLAGS)
+        )
+
+    def remove_domain(self, name):
+        self.domains.pop(name, None)
+
+    def remove_network(self, name):
+        self.networks.discard(name)
+
+
+def _is_alive(con):
+    try:
+        return con.isAlive() == 1
+    except libvirt.libvirtError:
+        return False
+
+
+_shared_connections = {}
+_shared_connections_lock = threading.Lock()
+
+
+def get_shared_connection(url=None):
+    """
+    Get the libvirt connection that is shared across the process for the
+    given URL
+
+    Args:
+        url(str): libvirt URL, defaults to the ``libvirt_url`` setting
+
+    Returns:
+        SharedConnection: The shared connection to ``url``
+    """
+    url = url or config.get('libvirt_url', 'qemu:///system')
+    with _shared_connections_lock:
+        if url not in _shared_connections:
+            _shared_connections[url] = SharedConnection(url)
+        return _shared_connections[url]
+
+
 def get_template(basename):
     """
     Load a file as a string from the templates directory
@@ -55,36 +55,28 @@ class LocalLibvirtVMProvider(vm_plugin.VMProviderPlugin):
     def __init__(self, vm):
         super().__init__(vm)
         self._has_guestfs = 'lago.guestfs_tools' in sys.modules
-        self.libvirt_con = libvirt_utils.get_libvirt_connection(
-            name=self.vm.virt_env.uuid,
-        )
-        self._caps = None
+        self._libvirt = libvirt_utils.get_shared_connection()
         self._cpu = None
-        self._libvirt_ver = None
 
-    def __del__(self):
-        if self.libvirt_con is not None:
-            self.libvirt_con.close()
+    @property
+    def libvirt_con(self):
+        return self._libvirt.con
 
     @property
     def cpu(self):
         if self._cpu is None:
-            host_cpu = self.caps.xpath('host/cpu')[0]
-            self._cpu = cpu.CPU(spec=self.vm._spec, host_cpu=host_cpu)
+            self._cpu = cpu.CPU(
+                spec=self.vm._spec, host_cpu=self._libvirt.host_cpu
+            )
         return self._cpu
 
     @property
     def caps(self):
-        if self._caps is None:
-            caps_raw_xml = self.libvirt_con.getCapabilities()
-            self._caps = ET.fromstring(caps_raw_xml)
-        return self._caps
+        return self._libvirt.caps
 
     @property
     def libvirt_ver(self):
-        if self._libvirt_ver is None:
-            self._libvirt_ver = self.libvirt_con.getLibVersion()
-        return self._libvirt_ver
+        return self._libvirt.lib_version
 
     def start(self):
         super().start()
@@ -172,6 +164,9 @@ class LocalLibvirtVMProvider(vm_plugin.VMProviderPlugin):
             self.vm._ssh_client = None
             with LogTask('Destroying VM %s' % self.vm.name()):
                 self.libvirt_con.lookupByName(self._libvirt_name(), ).destroy()
+            snapshot = self.vm.virt_env.current_state_snapshot
+            if snapshot is not None:
+                snapshot.remove_domain(self._libvirt_name())
 
     def shutdown(self, *args, **kwargs):
         super().shutdown(*args, **kwargs)
@@ -240,6 +235,11 @@ class LocalLibvirtVMProvider(vm_plugin.VMProviderPlugin):
                 libvirt_cmd(dom)
 
     def alive(self):
+        snapshot = self.vm.virt_env.current_state_snapshot
+        if snapshot is not None:
+            state = snapshot.domains.get(self._libvirt_name())
+            return state is not None and state[0] != libvirt.VIR_DOMAIN_SHUTOFF
+
         try:
             return bool(self._get_domain().isActive())
         except vm_plugin.LagoVMDoesNotExistError:
@@ -305,6 +305,15 @@ class LocalLibvirtVMProvider(vm_plugin.VMProviderPlugin):
             :exc:`~lago.plugins.vm.LagoFailedToGetVMStateError:
                 If the VM exist, but the query returned an error.
         """
+        snapshot = self.vm.virt_env.current_state_snapshot
+        if snapshot is not None:
+            try:
+                return snapshot.domains[self._libvirt_name()]
+            except KeyError:
+                raise vm_plugin.LagoVMDoesNotExistError(
+                    'Domain {} does not exist'.format(self._libvirt_name())
+                )
+
         try:
             return self._get_domain().state()
         except libvirt.libvirtError as e:
@@ -371,7 +380,7 @@ class LocalLibvirtVMProvider(vm_plugin.VMProviderPlugin):
             if was_alive:
                 self.start()
 
-    def extract_paths(self, paths, ignore_nopath):
+    def extract_paths(self, paths, ignore_nopath, compression=None):
         """
         Extract the given paths from the domain
 
@@ -384,6 +393,8 @@ class LocalLibvirtVMProvider(vm_plugin.VMProviderPlugin):
             paths(list of tuples): files to extract in
                 `[(src1, dst1), (src2, dst2)...]` format.
             ignore_nopath(boolean): if True will ignore none existing paths.
+            compression(str): See
+                :func:`~lago.plugins.vm.VMProviderPlugin.extract_paths`
 
         Returns:
             None
@@ -399,6 +410,7 @@ class LocalLibvirtVMProvider(vm_plugin.VMProviderPlugin):
             super().extract_paths(
                 paths=paths,
                 ignore_nopath=ignore_nopath,
+                compression=compression,
             )
         except ExtractPathError as err:
             LOGGER.debug(
@@ -471,13 +483,19 @@ class LocalLibvirtVMProvider(vm_plugin.VMProviderPlugin):
                 the name of the vm to the paths of the disks that will be
                 exported (don't export anything).
             with_threads(bool): If True, export disks in parallel
+            since(str): If given, export only the changes made to the disks
+                since the snapshot with this name was taken
 
         Returns:
             (dict): which maps between the name of the vm to the paths of
             the disks that will be exported
         """
+        disks = self.vm.disks
+        if kwargs.get('since'):
+            disks = self._disks_since_snapshot(kwargs['since'])
+
         vm_export_mgr = export.VMExportManager(
-            disks=self.vm.disks,
+            disks=disks,
             dst=dst_dir,
             compress=compress,
             with_threads=with_threads,
@@ -713,6 +731,33 @@ class LocalLibvirtVMProvider(vm_plugin.VMProviderPlugin):
 
         return ET.tostring(dom_xml, pretty_print=True)
 
+    def _disks_since_snapshot(self, name):
+        """
+        Args:
+            name (str): Name of the snapshot
+
+        Returns:
+            list of dict: The disks of the VM, each with the path of its
+                image at the snapshot in ``snapshot-base``
+
+        Raises:
+            lago.utils.LagoUserException: If the VM has no such snapshot
+        """
+        try:
+            snap_info = self.vm._spec['snapshots'][name]
+        except KeyError:
+            raise utils.LagoUserException(
+                'No snapshot {} for {}'.format(name, self.vm.name())
+            )
+
+        disks = []
+        for disk, snap_disk in zip(self.vm.disks, snap_info):
+            disk = disk.copy()
+            disk['snapshot-base'] = snap_disk['path']
+            disks.append(disk)
+
+        return disks
+
     def _create_dead_snapshot(self, name):
         raise RuntimeError('Dead snapshots are not implemented yet')
 
@@ -1,12 +1,18 @@
 from __future__ import absolute_import
 
 import array
+import codecs
+import contextlib
+import errno
 import fcntl
 import functools
+import os
 import select
+import selectors
 import socket
 import sys
 import termios
+import threading
 import time
 import tty
 import uuid
@@ -25,6 +31,15 @@ LOGGER = logging.getLogger(__name__)
 LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
 log_task = functools.partial(log_utils.log_task, logger=LOGGER)
 
+DRAIN_CHUNK_SIZE = 1024 * 1024
+SELECT_TIMEOUT = 1
+AUTH_MIN_BACKOFF = 0.5
+AUTH_MAX_BACKOFF = 10
+PROBE_MIN_BACKOFF = 0.25
+PROBE_MAX_BACKOFF = 5
+PROBE_ATTEMPT_TIMEOUT = 5
+BANNER_MAX_SIZE = 8192
+
 
 def ssh(
     ip_addr,
@@ -37,9 +52,31 @@ def ssh(
     ssh_key=None,
     username='root',
     password='123456',
+    pool=None,
+    stdout=None,
+    stderr=None,
+    timeout=None,
 ):
+    """
+    Run a command over ssh
+
+    ``stdout`` and ``stderr`` can be given to stream the command's output
+    and errors to a file or callback (see :func:`drain_ssh_channel`), in
+    which case they are not kept in memory nor returned, and
+    ``show_output`` is ignored. If only one of them is given, the other
+    stream is still kept and returned.
+
+    If ``timeout`` is given and the command runs for longer, its channel is
+    closed and :exc:`~LagoSSHTimeoutException` is raised.
+
+    Returns:
+        lago.utils.CommandStatus: The result of the command
+    """
     host_name = host_name or ip_addr
-    client = get_ssh_client(
+    joined_command = ' '.join(command)
+    command_id = _gen_ssh_command_id()
+    with _session(
+        pool=pool,
         ip_addr=ip_addr,
         host_name=host_name,
         propagate_fail=propagate_fail,
@@ -47,35 +84,38 @@ def ssh(
         ssh_key=ssh_key,
         username=username,
         password=password,
-    )
-    transport = client.get_transport()
-    channel = transport.open_session()
-
-    joined_command = ' '.join(command)
-    command_id = _gen_ssh_command_id()
-    LOGGER.debug(
-        'Running %s on %s: %s%s',
-        command_id,
-        host_name,
-        joined_command,
-        data is not None and (' < "%s"' % data) or '',
-    )
-
-    channel.exec_command(joined_command)
-    if data is not None:
-        channel.send(data)
-
-    channel.shutdown_write()
-    return_code, out, err = drain_ssh_channel(
-        channel, **(show_output and {} or {
-            'stdout': None,
-            'stderr': None
-        })
-    )
+    ) as channel:
+        LOGGER.debug(
+            'Running %s on %s: %s%s',
+            command_id,
+            host_name,
+            joined_command,
+            data is not None and (' < "%s"' % data) or '',
+        )
 
-    channel.close()
-    transport.close()
-    client.close()
+        channel.exec_command(joined_command)
+        if data is not None:
+            channel.sendall(data)
+
+        channel.shutdown_write()
+        if stdout is not None or stderr is not None:
+            kept_out = bytearray()
+            kept_err = bytearray()
+            return_code, _, _ = drain_ssh_channel(
+                channel,
+                stdout=kept_out.extend if stdout is None else stdout,
+                stderr=kept_err.extend if stderr is None else stderr,
+                keep_output=False,
+                timeout=timeout,
+            )
+            out, err = bytes(kept_out), bytes(kept_err)
+        else:
+            drain_kwargs = {}
+            if not show_output:
+                drain_kwargs = {'stdout': None, 'stderr': None}
+            return_code, out, err = drain_ssh_channel(
+                channel, timeout=timeout, **drain_kwargs
+            )
 
     LOGGER.debug(
         'Command %s on %s returned with %d',
@@ -108,9 +148,26 @@ def wait_for_ssh(
     ssh_key=None,
     username='root',
     password='123456',
+    pool=None,
+    probe_banner=True,
 ):
+    """
+    Wait until it's possible to run commands on the host over ssh
+
+    Authenticating is expensive, so unless ``probe_banner`` is False, this
+    first waits for the ssh server to greet us with its banner (see
+    :func:`wait_for_banners`), and only then tries to run a command,
+    backing off exponentially between the attempts.
+
+    Raises:
+        RuntimeError: If the host could not be reached until the timeout
+    """
     host_name = host_name or ip_addr
     start_time = time.time()
+    if probe_banner and not wait_for_banners([ip_addr], connect_timeout):
+        LOGGER.debug('No ssh banner from %s', host_name)
+
+    delay = AUTH_MIN_BACKOFF
     while (time.time() - start_time) < connect_timeout:
         try:
             ret, _, _ = ssh(
@@ -122,6 +179,7 @@ def wait_for_ssh(
                 ssh_key=ssh_key,
                 username=username,
                 password=password,
+                pool=pool,
             )
         except Exception as err:
             ret = -1
@@ -136,7 +194,9 @@ def wait_for_ssh(
         if ret == 0:
             break
 
-        time.sleep(1)
+        remaining = connect_timeout - (time.time() - start_time)
+        time.sleep(max(0, min(delay, remaining)))
+        delay = min(delay * 2, AUTH_MAX_BACKOFF)
     else:
         # Try one last time, using the ssh default timeout values, as we
         # already waited for boot_time_sec for sure
@@ -147,6 +207,7 @@ def wait_for_ssh(
             ssh_key=ssh_key,
             username=username,
             password=password,
+            pool=pool,
         )
         if ret != 0:
             raise RuntimeError(
@@ -157,6 +218,162 @@ def wait_for_ssh(
     LOGGER.debug('Wait succeeded for ssh to %s', host_name)
 
 
+class _BannerProbe(object):
+    """
+    Connection attempts to a single ssh server, driven by
+    :func:`wait_for_banners`
+    """
+
+    def __init__(self, ip_addr, port):
+        self.ip_addr = ip_addr
+        self.port = port
+        self.sock = None
+        self.connected = False
+        self.received = b''
+        self.backoff = PROBE_MIN_BACKOFF
+        # When idle, the time of the next attempt, otherwise the time the
+        # current attempt is given up
+        self.deadline = 0
+
+    def poll(self, now, selector):
+        """
+        Start a new attempt, or give up the current one, if it's time to
+        """
+        if now < self.deadline:
+            return
+        if self.sock is not None:
+            self.fail(now, selector, 'timed out')
+        else:
+            self.connect(now, selector)
+
+    def connect(self, now, selector):
+        try:
+            family, socktype, proto, _, addr = socket.getaddrinfo(
+                self.ip_addr, self.port, 0, socket.SOCK_STREAM
+            )[0]
+            sock = socket.socket(family, socktype, proto)
+        except socket.error as err:
+            self.fail(now, selector, err)
+            return
+
+        sock.setblocking(False)
+        err = sock.connect_ex(addr)
+        if err not in (0, errno.EINPROGRESS):
+            sock.close()
+            self.fail(now, selector, os.strerror(err))
+            return
+
+        self.sock = sock
+        self.connected = False
+        self.received = b''
+        self.deadline = now + PROBE_ATTEMPT_TIMEOUT
+        selector.register(sock, selectors.EVENT_WRITE, self)
+
+    def handle(self, now, selector):
+        """
+        Handle an event on the socket
+
+        Returns:
+            bool: True if the banner was received
+        """
+        if not self.connected:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self.fail(now, selector, os.strerror(err))
+                return False
+            self.connected = True
+            selector.modify(self.sock, selectors.EVENT_READ, self)
+            return False
+
+        try:
+            data = self.sock.recv(BANNER_MAX_SIZE)
+        except socket.error as err:
+            self.fail(now, selector, err)
+            return False
+
+        if not data:
+            self.fail(now, selector, 'connection closed')
+            return False
+
+        # The server may send other lines before its version line
+        self.received += data
+        if b'SSH-' in self.received:
+            self.close(selector)
+            return True
+        if len(self.received) > BANNER_MAX_SIZE:
+            self.fail(now, selector, 'no banner')
+        return False
+
+    def fail(self, now, selector, reason):
+        LOGGER.debug(
+            'ssh probe of %s failed (%s), retrying in %.2fs',
+            self.ip_addr,
+            reason,
+            self.backoff,
+        )
+        self.close(selector)
+        self.deadline = now + self.backoff
+        self.backoff = min(self.backoff * 2, PROBE_MAX_BACKOFF)
+
+    def close(self, selector):
+        if self.sock is not None:
+            selector.unregister(self.sock)
+            self.sock.close()
+            self.sock = None
+
+
+def wait_for_banners(ip_addrs, timeout, port=22):
+    """
+    Wait for the ssh servers on the given hosts to send their banner. All
+    the hosts are probed at once with non blocking sockets, and each one is
+    retried with an exponential backoff.
+
+    Seeing the banner means the server is up and accepts connections, it's
+    a much cheaper check than a full key exchange and authentication.
+
+    Args:
+        ip_addrs(list of str): Addresses of the hosts
+        timeout(int): Seconds to wait for all the hosts
+        port(int): Port the ssh servers listen on
+
+    Returns:
+        set of str: The addresses that sent a banner until the timeout
+    """
+    deadline = time.time() + timeout
+    pending = {ip_addr: _BannerProbe(ip_addr, port) for ip_addr in ip_addrs}
+    ready = set()
+    selector = selectors.DefaultSelector()
+    try:
+        while pending:
+            now = time.time()
+            if now >= deadline:
+                break
+
+            for probe in list(pending.values()):
+                probe.poll(now, selector)
+
+            wait = min(
+                [deadline - now] +
+                [probe.deadline - now for probe in pending.values()]
+            )
+            wait = max(0, wait)
+            if not selector.get_map():
+                time.sleep(wait)
+                continue
+
+            for key, _ in selector.select(wait):
+                probe = key.data
+                if probe.handle(time.time(), selector):
+                    ready.add(probe.ip_addr)
+                    del pending[probe.ip_addr]
+    finally:
+        for probe in pending.values():
+            probe.close(selector)
+        selector.close()
+
+    return ready
+
+
 def ssh_script(
     ip_addr,
     path,
@@ -165,6 +382,10 @@ def ssh_script(
     ssh_key=None,
     username='root',
     password='123456',
+    pool=None,
+    stdout=None,
+    stderr=None,
+    timeout=None,
 ):
     host_name = host_name or ip_addr
     LOGGER.debug('Running %s on host %s', path, host_name)
@@ -178,6 +399,10 @@ def ssh_script(
             ssh_key=ssh_key,
             username=username,
             password=password,
+            pool=pool,
+            stdout=stdout,
+            stderr=stderr,
+            timeout=timeout,
         )
 
 
@@ -188,33 +413,121 @@ def interactive_ssh(
     ssh_key=None,
     username='root',
     password='123456',
+    pool=None,
 ):
     if command is None:
         command = ['bash']
 
-    client = get_ssh_client(
+    with _session(
+        pool=pool,
         ip_addr=ip_addr,
         host_name=host_name,
         ssh_key=ssh_key,
         username=username,
         password=password,
-    )
+    ) as channel:
+        return interactive_ssh_channel(channel, ' '.join(command))
+
+
+@contextlib.contextmanager
+def _session(pool=None, **kwargs):
+    """
+    Open a session channel, either on a pooled connection or on a
+    dedicated one which is closed with the channel
+
+    Args:
+        pool(SSHConnectionPool): Pool to take the connection from, if None
+            a dedicated client is created
+        **kwargs: Passed to :func:`get_ssh_client`
+
+    Yields:
+        paramiko.Channel: The new channel
+    """
+    if pool is not None:
+        with pool.session(**kwargs) as channel:
+            yield channel
+        return
+
+    client = get_ssh_client(**kwargs)
     transport = client.get_transport()
-    channel = transport.open_session()
     try:
-        return interactive_ssh_channel(channel, ' '.join(command))
+        channel = transport.open_session()
+        try:
+            yield channel
+        finally:
+            channel.close()
     finally:
-        channel.close()
         transport.close()
         client.close()
 
 
-def drain_ssh_channel(chan, stdin=None, stdout=sys.stdout, stderr=sys.stderr):
+def _output_writer(stream):
+    """
+    Get a function that writes the chunks read from a channel to the given
+    output
+
+    Args:
+        stream(file or callable): A file, opened in either binary or text
+            mode, or a function which is called with every chunk read
+
+    Returns:
+        callable: Function accepting a chunk of bytes, or None if ``stream``
+            is None
+    """
+    if stream is None or not hasattr(stream, 'write'):
+        return stream
+
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def _write(chunk):
+        try:
+            stream.write(chunk)
+        except TypeError:
+            stream.write(decoder.decode(chunk))
+        stream.flush()
+
+    return _write
+
+
+def drain_ssh_channel(
+    chan,
+    stdin=None,
+    stdout=sys.stdout,
+    stderr=sys.stderr,
+    keep_output=True,
+    timeout=None,
+):
+    """
+    Pump data between a channel and the local streams until the channel
+    is closed. The loop sleeps until the channel or ``stdin`` have data,
+    and reads whatever is buffered in large chunks, so big outputs are
+    moved at network speed.
+
+    Args:
+        chan(paramiko.Channel): Channel to drain
+        stdin(file): If given, its content is sent to the channel
+        stdout(file or callable): Where to send the channel's output, see
+            :func:`_output_writer`, None to discard it
+        stderr(file or callable): Where to send the channel's errors, see
+            :func:`_output_writer`, None to discard them
+        keep_output(bool): If False, the output and errors are not
+            accumulated in memory, and empty ones are returned
+        timeout(int): Seconds to wait for the channel to be closed, None to
+            wait forever
+
+    Returns:
+        tuple: The exit status, output and errors of the channel
+
+    Raises:
+        :exc:`~LagoSSHTimeoutException`: If the timeout passed before the
+            channel was closed
+    """
     chan.settimeout(0)
-    out_queue = []
-    out_all = []
-    err_queue = []
-    err_all = []
+    deadline = None if timeout is None else time.time() + timeout
+    out_all = bytearray()
+    err_all = bytearray()
+    write_out = _output_writer(stdout)
+    write_err = _output_writer(stderr)
 
     try:
         stdout_is_tty = stdout.isatty()
@@ -222,8 +535,12 @@ def drain_ssh_channel(chan, stdin=None, stdout=sys.stdout, stderr=sys.stderr):
     except AttributeError:
         stdout_is_tty = False
 
-    done = False
-    while not done:
+    readers = (
+        (chan.recv_ready, chan.recv, write_out, out_all),
+        (chan.recv_stderr_ready, chan.recv_stderr, write_err, err_all),
+    )
+
+    while True:
         if stdout_is_tty:
             arr = array.array('h', range(4))
             if not fcntl.ioctl(stdout.fileno(), termios.TIOCGWINSZ, arr):
@@ -231,67 +548,52 @@ def drain_ssh_channel(chan, stdin=None, stdout=sys.stdout, stderr=sys.stderr):
                     tty_h, tty_w = arr[:2]
                     chan.resize_pty(width=tty_w, height=tty_h)
 
-        read_streams = []
-        if not chan.closed:
-            read_streams.append(chan)
+        # Checked before reading, so that whatever arrived before the
+        # channel was closed is still read in this iteration
+        closed = chan.closed
+
+        for ready, recv, write, collected in readers:
+            try:
+                while ready():
+                    chunk = recv(DRAIN_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if write is not None:
+                        write(chunk)
+                    if keep_output:
+                        collected.extend(chunk)
+            except socket.error:
+                pass
+
+        if closed:
+            break
 
-            if stdin and not stdin.closed:
-                read_streams.append(stdin)
+        wait = SELECT_TIMEOUT
+        if deadline is not None:
+            wait = min(wait, deadline - time.time())
+            if wait <= 0:
+                raise LagoSSHTimeoutException(
+                    'Command did not finish in %d seconds' % timeout
+                )
 
-        write_streams = []
-        if stdout and out_queue:
-            write_streams.append(stdout)
-        if stderr and err_queue:
-            write_streams.append(stderr)
+        read_streams = [chan]
+        if stdin is not None and not stdin.closed:
+            read_streams.append(stdin)
 
-        read, write, _ = select.select(
-            read_streams,
-            write_streams,
-            [],
-            0.1,
-        )
+        # The channel's file descriptor becomes readable as soon as there
+        # is data or it's closed, the timeout is only there to catch
+        # terminal resizes
+        read, _, _ = select.select(read_streams, [], [], wait)
 
-        if stdin in read:
+        if stdin is not None and stdin in read:
             chunk = utils.read_nonblocking(stdin)
             if chunk:
-                chan.send(chunk)
+                chan.sendall(chunk)
             else:
                 chan.shutdown_write()
+                stdin = None
 
-        try:
-            if chan.recv_ready():
-                chunk = chan.recv(1024)
-                if stdout:
-                    out_queue.append(chunk)
-                out_all.append(chunk)
-
-            if chan.recv_stderr_ready():
-                chunk = chan.recv_stderr(1024)
-                if stderr:
-                    err_queue.append(chunk)
-                err_all.append(chunk)
-        except socket.error:
-            pass
-
-        if stdout in write:
-            out = out_queue.pop(0)
-            try:
-                stdout.write(out)
-            except TypeError:
-                stdout.write(out.decode('utf-8'))
-            stdout.flush()
-        if stderr in write:
-            err = err_queue.pop(0)
-            try:
-                stderr.write()
-            except TypeError:
-                stderr.write(err.decode('utf-8'))
-            stderr.flush()
-
-        if chan.closed and not out_queue and not err_queue:
-            done = True
-
-    return (chan.exit_status, b''.join(out_all), b''.join(err_all))
+    return (chan.exit_status, bytes(out_all), bytes(err_all))
 
 
 def interactive_ssh_channel(chan, command=None, stdin=sys.stdin):
@@ -403,5 +705,194 @@ def get_ssh_client(
     return client
 
 
+class SSHConnectionPool(object):
+    """
+    Keeps authenticated SSH connections around, so that consecutive and
+    concurrent commands to the same host share one transport (each command
+    gets its own channel on it) instead of doing a key exchange and
+    authentication every time.
+
+    Connections are keyed by (ip, username, key), checked for liveness
+    before being handed out and closed once nobody uses them for longer
+    than ``idle_timeout`` seconds.
+
+    Attributes:
+        idle_timeout(int): Seconds a connection can be unused before it is
+            closed, None to keep connections until :meth:`close`
+    """
+
+    def __init__(self, idle_timeout=None):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._connect_locks = {}
+
+    @staticmethod
+    def _key(ip_addr, username, ssh_key):
+        if isinstance(ssh_key, list):
+            ssh_key = tuple(ssh_key)
+        return ip_addr, username, ssh_key
+
+    def _reap(self):
+        """
+        Pop the connections that are dead, or unused and idle for too long.
+        Must be called with the pool lock held.
+
+        Returns:
+            list of paramiko.SSHClient: The connections to close
+        """
+        now = time.time()
+        stale = []
+        for key, conn in self._connections.items():
+            idle = (
+                self.idle_timeout is not None and not conn['users']
+                and now - conn['last_used'] > self.idle_timeout
+            )
+            if idle or not _is_alive(conn['client']):
+                stale.append(key)
+
+        return [self._connections.pop(key)['client'] for key in stale]
+
+    def _acquire(self, key, **kwargs):
+        with self._lock:
+            stale = self._reap()
+            connect_lock = self._connect_locks.setdefault(
+                key, threading.Lock()
+            )
+        for client in stale:
+            client.close()
+
+        # Only one thread connects to a given host, the others wait for it
+        # and then share its connection
+        with connect_lock:
+            with self._lock:
+                conn = self._connections.get(key)
+                if conn is not None:
+                    conn['users'] += 1
+                    return conn['client']
+
+            client = get_ssh_client(**kwargs)
+            with self._lock:
+                self._connections[key] = {
+                    'client': client,
+                    'users': 1,
+                    'last_used': time.time(),
+                }
+
+        return client
+
+    def _release(self, key, client):
+        with self._lock:
+            conn = self._connections.get(key)
+            if conn is not None and conn['client'] is client:
+                conn['users'] -= 1
+                conn['last_used'] = time.time()
+
+    @contextlib.contextmanager
+    def client(
+        self,
+        ip_addr,
+        ssh_key=None,
+        host_name=None,
+        ssh_tries=None,
+        propagate_fail=True,
+        username='root',
+        password='123456',
+    ):
+        """
+        Get a connected SSH client, reusing a pooled connection if there is
+        a live one. The client is owned by the pool and must not be closed
+        by the caller.
+
+        Args:
+            See :func:`get_ssh_client`
+
+        Yields:
+            paramiko.SSHClient: The connected client
+
+        Raises:
+            :exc:`~LagoSSHTimeoutException`: If there was no pooled
+                connection and a new one could not be made
+        """
+        key = self._key(ip_addr, username, ssh_key)
+        client = self._acquire(
+            key,
+            ip_addr=ip_addr,
+            ssh_key=ssh_key,
+            host_name=host_name,
+            ssh_tries=ssh_tries,
+            propagate_fail=propagate_fail,
+            username=username,
+            password=password,
+        )
+        try:
+            yield client
+        finally:
+            self._release(key, client)
+
+    @contextlib.contextmanager
+    def session(self, ip_addr, username='root', ssh_key=None, **kwargs):
+        """
+        Open a session channel on a pooled connection. If the connection
+        turns out to be broken, it is replaced by a new one once.
+
+        Args:
+            See :func:`get_ssh_client`
+
+        Yields:
+            paramiko.Channel: The new channel, closed on exit
+        """
+        kwargs.update(ip_addr=ip_addr, username=username, ssh_key=ssh_key)
+        for retry in (True, False):
+            with self.client(**kwargs) as client:
+                try:
+                    channel = client.get_transport().open_session()
+                except (
+                    paramiko.ssh_exception.SSHException, EOFError, socket.error
+                ) as err:
+                    if not retry:
+                        raise
+                    LOGGER.debug(
+                        'Pooled ssh connection to %s is broken, '
+                        'reconnecting: %s',
+                        kwargs.get('host_name') or ip_addr,
+                        err,
+                    )
+                    self.discard(ip_addr, username, ssh_key)
+                    continue
+
+                try:
+                    yield channel
+                finally:
+                    channel.close()
+                return
+
+    def discard(self, ip_addr, username='root', ssh_key=None):
+        """
+        Close the pooled connection to the given host, if any
+        """
+        with self._lock:
+            conn = self._connections.pop(
+                self._key(ip_addr, username, ssh_key), None
+            )
+        if conn is not None:
+            conn['client'].close()
+
+    def close(self):
+        """
+        Close all the pooled connections
+        """
+        with self._lock:
+            clients = [conn['client'] for conn in self._connections.values()]
+            self._connections.clear()
+        for client in clients:
+            client.close()
+
+
+def _is_alive(client):
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
+
+
 class LagoSSHTimeoutException(utils.LagoException):
     pass
@@ -21,10 +21,11 @@
 from __future__ import absolute_import
 
 import functools
+import itertools
 import json
 import os
 import logging
-from netaddr import IPNetwork, AddrFormatError
+from netaddr import IPAddress, IPNetwork, IPRange, AddrFormatError
 from textwrap import dedent
 
 import six
@@ -35,6 +36,8 @@ from . import utils, log_utils
 LOGGER = logging.getLogger(__name__)
 LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
 LOCK_NAME = 'subnet-lease.lock'
+#: Leases of /24 subnets in it are named by their third octet
+LEGACY_SUPERNET = IPNetwork('192.168.0.0/16')
 
 
 class SubnetStore(object):
@@ -42,8 +45,13 @@ class SubnetStore(object):
     SubnetStore object represents a store of subnets used by lago for network
     bridges.
 
-    .. note:: Currently only /24 ranges are handled, and all of them under the
-        192.168._min_third_octet to 192.168._max_third_octet ranges.
+    The subnets are leased out of one or more pools, each pool is a supernet
+    that is split into subnets of a fixed prefix length. The pools are taken
+    from the `subnet_pools` config option, a comma separated list of
+    ``supernet:prefix_length`` items (for example
+    ``10.64.0.0/12:26,192.168.0.0/16:24``). If it is not set, the /24 subnets
+    in the 192.168._min_third_octet to 192.168._max_third_octet range are
+    used.
 
     The leases are stored under the store's directory (which is specified
     with the `path` argument) as json files with the form::
@@ -60,23 +68,19 @@ class SubnetStore(object):
     the lease files in the store (each file will be represented with a Lease
     object).
 
-    Cleanup of stale leases is done in a lazy manner during a request for a
-    lease. The store will remove at most 1 stale lease in each request (see
-    SubnetStore._lease_valid for more info).
+    Stale leases, which their prefix no longer exists, are considered free,
+    and are overwritten when their subnet is leased again.
 
     Attributes:
         _path (str): Path to the store, if not specified defaults to the value
             of `lease_dir` in the config
-        _cidr (int): Number of bits dedicated for the network address.
-            Has a fixed value of 24.
-        _subnet_template (str): A template for creating ip address.
-            Has a fixed value of `192.168.{}.0`
-        _min_third_octet (int): The minimum value of the subnets' last octet.
-        _max_third_octet (int): The maximum value of the subnets' last octet.
-        _min_subnet (netaddr.IPNetwork): The lowest subnet in the range of
-            the store.
-        _max_subnet (netaddr.IPNetwork): The highest subnet in the range of
-            the store.
+        _min_third_octet (int): The minimum value of the subnets' third octet,
+            when no pools are configured.
+        _max_third_octet (int): The maximum value of the subnets' third octet,
+            when no pools are configured.
+        _pools (list of tuple): The pools of the store, each is a
+            netaddr.IPNetwork supernet and the prefix length of the subnets
+            it is split into.
     """
 
     def __init__(
@@ -84,19 +88,24 @@ class SubnetStore(object):
         path=None,
         min_third_octet=200,
         max_third_octet=255,
+        pools=None,
     ):
 
         self._path = path or config['lease_dir']
-        self._cidr = 24
-        self._subnet_template = '{}/{}'.format('192.168.{}.0', self._cidr)
         self._min_third_octet = min_third_octet
         self._max_third_octet = max_third_octet
-        self._min_subnet = IPNetwork(
-            self._subnet_template.format(min_third_octet)
-        )
-        self._max_subnet = IPNetwork(
-            self._subnet_template.format(max_third_octet)
-        )
+        if pools is None:
+            pools = config.get('subnet_pools')
+        if pools:
+            self._pools = _parse_pools(pools)
+        else:
+            self._pools = [
+                (supernet, 24)
+                for supernet in IPRange(
+                    '192.168.{}.0'.format(min_third_octet),
+                    '192.168.{}.255'.format(max_third_octet),
+                ).cidrs()
+            ]
         self._validate_lease_dir()
 
     def _create_lock(self):
@@ -137,111 +146,176 @@ class SubnetStore(object):
             LagoSubnetLeaseLockException:
                 If the lock to self.path can't be acquired.
         """
-        try:
-            with self._create_lock():
-                if subnet:
-                    LOGGER.debug('Trying to acquire subnet {}'.format(subnet))
-                    acquired_subnet = self._acquire_given_subnet(
-                        uuid_path, subnet
-                    )
-                else:
-                    LOGGER.debug('Trying to acquire a free subnet')
-                    acquired_subnet = self._acquire(uuid_path)
+        if subnet:
+            return self.acquire_many(uuid_path, requested=[subnet])[0]
+        return self.acquire_many(uuid_path, count=1)[0]
 
-                return acquired_subnet
-        except (utils.TimerException, IOError):
-            raise LagoSubnetLeaseLockException(self.path)
-
-    def _acquire(self, uuid_path):
+    def acquire_many(self, uuid_path, count=0, requested=None):
         """
-        Lease a free network for the given uuid path
+        Lease several subnets for the given uuid path at once.
+        The store is locked, and its leases are read, only once for all of
+        them, and either all the subnets are leased or none of them is.
 
         Args:
             uuid_path (str): Path to the uuid file of a :class:`lago.Prefix`
+            count (int): Number of free subnets to lease
+            requested (list of str): Specific subnets to lease
 
         Returns:
-            netaddr.IPNetwork: Which represents the selected subnet
+            list of netaddr.IPNetwork: The requested subnets, in the given
+                order, followed by the free subnets that were selected.
 
         Raises:
-            LagoSubnetLeaseException: If the store is full
+            LagoSubnetLeaseException:
+                1. If there are not enough free subnets in this store
+                2. If one of the requested subnets is already taken.
+            LagoSubnetLeaseLockException:
+                If the lock to self.path can't be acquired.
         """
-        for index in range(self._min_third_octet, self._max_third_octet + 1):
-            lease = self.create_lease_object_from_idx(index)
-            if self._lease_valid(lease):
-                continue
-            self._take_lease(lease, uuid_path, safe=False)
-            return lease.to_ip_network()
-
-        raise LagoSubnetLeaseStoreFullException(self.get_allowed_range())
+        requested = requested or []
+        try:
+            with self._create_lock():
+                LOGGER.debug(
+                    'Trying to acquire {} free subnets and {}'.format(
+                        count, requested
+                    )
+                )
+                return self._acquire_many(uuid_path, count, requested)
+        except (utils.TimerException, IOError):
+            raise LagoSubnetLeaseLockException(self.path)
 
-    def _acquire_given_subnet(self, uuid_path, subnet):
+    def _acquire_many(self, uuid_path, count, requested):
         """
-        Try to create a lease for subnet
-
-        Args:
-            uuid_path (str): Path to the uuid file of a :class:`lago.Prefix`
-            subnet (str): dotted ipv4 subnet
-                (for example ```192.168.200.0```)
-
-        Returns:
-            netaddr.IPNetwork: Which represents the selected subnet
-
-        Raises:
-            LagoSubnetLeaseException: If the requested subnet is not in the
-                range of this store or its already been taken
+        See :func:`acquire_many`, the store should be locked
         """
-        lease = self.create_lease_object_from_subnet(subnet)
-        self._take_lease(lease, uuid_path)
+        taken = self._read_valid_leases()
+        owned = set(
+            path for path, owner in six.iteritems(taken) if owner == uuid_path
+        )
 
-        return lease.to_ip_network()
+        leases = []
+        for subnet in requested:
+            lease = self.create_lease_object_from_subnet(subnet)
+            lease_taken_by = taken.get(lease.path)
+            if not lease_taken_by:
+                # a lease of another prefix length might overlap it
+                lease_taken_by = _overlapping_lease_owner(lease, taken)
+            if lease_taken_by and lease_taken_by != uuid_path:
+                raise LagoSubnetLeaseTakenException(
+                    lease.subnet, lease_taken_by
+                )
+            taken[lease.path] = uuid_path
+            leases.append(lease)
+
+        needed = len(leases) + count
+        if count:
+            taken_subnets = [
+                _lease_file_subnet(os.path.basename(path)) for path in taken
+            ]
+            free = self._free_subnets(taken_subnets)
+            for subnet in itertools.islice(free, count):
+                leases.append(Lease(store_path=self.path, subnet=str(subnet)))
+        if len(leases) < needed:
+            raise LagoSubnetLeaseStoreFullException(self.get_allowed_range())
 
-    def _lease_valid(self, lease):
+        with open(uuid_path) as f:
+            uuid = f.read()
+        written = []
+        try:
+            for lease in leases:
+                if lease.path not in owned:
+                    self._write_lease(lease, uuid_path, uuid)
+                    written.append(lease)
+        except:
+            for lease in written:
+                self._release(lease)
+            raise
+
+        return [lease.to_ip_network() for lease in leases]
+
+    def _free_subnets(self, taken_subnets):
         """
-        Check if the given lease exist and still has a prefix that owns it.
-        If the lease exist but its prefix isn't, remove the lease from this
-        store.
+        Generate the free subnets of the store, lowest first. The free
+        subnets are found from the gaps between the taken ones, so this does
+        not depend on the size of the pools. A subnet is not free if it
+        overlaps any of the taken ones, whatever their prefix length is.
 
         Args:
-            lease (lago.subnet_lease.Lease): Object representation of the
-                lease
+            taken_subnets (list of str): Subnets that are leased
 
         Returns:
-            str or None: If the lease and its prefix exists, return the path
-                to the uuid of the prefix, else return None.
+            generator of netaddr.IPNetwork: The free subnets
         """
-        if not lease.exist:
-            return None
-
-        if lease.has_env:
-            return lease.uuid_path
-        else:
-            self._release(lease)
-            return None
+        taken = [IPNetwork(subnet).cidr for subnet in taken_subnets]
+        for supernet, prefixlen in self._pools:
+            block = 2**(_address_width(supernet) - prefixlen)
+            # ranges of the indices of the blocks each taken subnet overlaps
+            used = []
+            for subnet in taken:
+                if _overlaps(subnet, supernet):
+                    first = max(subnet.first, supernet.first) - supernet.first
+                    last = min(subnet.last, supernet.last) - supernet.first
+                    used.append((first // block, last // block))
+            used.sort()
+            start = 0
+            for first, last in used + [(supernet.size // block, None)]:
+                for free_index in range(start, first):
+                    yield IPNetwork(
+                        '{}/{}'.format(
+                            IPAddress(
+                                supernet.first + free_index * block,
+                                supernet.version,
+                            ),
+                            prefixlen,
+                        )
+                    )
+                if last is not None:
+                    start = max(start, last + 1)
 
-    def _take_lease(self, lease, uuid_path, safe=True):
+    def _read_valid_leases(self):
         """
-        Persist the given lease to the store and make the prefix in uuid_path
-        his owner
-
-        Args:
-            lease(lago.subnet_lease.Lease): Object representation of the lease
-            uuid_path (str): Path to the prefix uuid
-            safe (bool): If true (the default), validate the the lease
-                isn't taken.
+        Read all the leases in the store, checking each prefix uuid file
+        only once
 
-        Raises:
-            LagoSubnetLeaseException: If safe == True and the lease is already
-                taken.
+        Returns:
+            dict: Maps the path of each lease whose prefix still exists, to
+                the path of that prefix's uuid file
         """
-        if safe:
-            lease_taken_by = self._lease_valid(lease)
-            if lease_taken_by and lease_taken_by != uuid_path:
-                raise LagoSubnetLeaseTakenException(
-                    lease.subnet, lease_taken_by
+        try:
+            lease_files = os.listdir(self.path)
+        except OSError as e:
+            six.raise_from(
+                LagoSubnetLeaseBadPermissionsException(self.path, e.strerror),
+                e
+            )
+
+        uuids = {}
+        valid = {}
+        for lease_file in lease_files:
+            if not lease_file.endswith('.lease'):
+                continue
+            lease_path = os.path.join(self.path, lease_file)
+            try:
+                with open(lease_path) as f:
+                    uuid_path, uuid = json.load(f)
+            except (IOError, ValueError) as err:
+                LOGGER.debug(
+                    'Ignoring unreadable lease {}: {}'.format(lease_path, err)
                 )
+                continue
 
-        with open(uuid_path) as f:
-            uuid = f.read()
+            if uuid_path not in uuids:
+                try:
+                    with open(uuid_path, mode='rt') as f:
+                        uuids[uuid_path] = f.read()
+                except IOError:
+                    uuids[uuid_path] = None
+            if uuids[uuid_path] == uuid:
+                valid[lease_path] = uuid_path
+
+        return valid
+
+    def _write_lease(self, lease, uuid_path, uuid):
         with open(lease.path, 'wt') as f:
             utils.json_dump((uuid_path, uuid), f)
 
@@ -269,8 +343,8 @@ class SubnetStore(object):
             )
 
         leases = [
-            self.create_lease_object_from_idx(lease_file.split('.')[0])
-            for lease_file in lease_files if lease_file != LOCK_NAME
+            Lease(store_path=self.path, subnet=subnet)
+            for subnet in map(_lease_file_subnet, lease_files) if subnet
         ]
         if not uuid:
             return leases
@@ -345,8 +419,7 @@ class SubnetStore(object):
 
     def create_lease_object_from_idx(self, idx):
         """
-        Create a lease from self._subnet_template and put idx as its third
-        octet.
+        Create a lease for the 192.168.idx.0/24 subnet
 
         Args:
             idx (str): The value of the third octet
@@ -360,17 +433,17 @@ class SubnetStore(object):
         """
 
         return self.create_lease_object_from_subnet(
-            self._subnet_template.format(idx)
+            '192.168.{}.0/24'.format(idx)
         )
 
     def create_lease_object_from_subnet(self, subnet):
         """
         Create a lease from ip in a dotted decimal format,
-        (for example `192.168.200.0/24`). the _cidr will be added if not exist
-        in `subnet`.
+        (for example `192.168.200.0/24`). If `subnet` has no prefix length,
+        the prefix length of the pool it belongs to is added.
 
         Args:
-            subnet (str): The value of the third octet
+            subnet (str): The subnet, or an address in it
 
         Returns:
             Lease: Lease object which represents the requested subnet.
@@ -379,26 +452,36 @@ class SubnetStore(object):
             LagoSubnetLeaseOutOfRangeException: If the resultant subnet is
             malformed or out of the range of the store.
         """
-        if '/' not in subnet:
-            subnet = '{}/{}'.format(subnet, self._cidr)
-
         try:
             if not self.is_leasable_subnet(subnet):
                 raise LagoSubnetLeaseOutOfRangeException(
                     subnet, self.get_allowed_range()
                 )
-        except AddrFormatError:
+            subnet = self._with_prefixlen(subnet)
+        except (AddrFormatError, ValueError):
             raise LagoSubnetLeaseMalformedAddrException(subnet)
 
         return Lease(store_path=self.path, subnet=subnet)
 
+    def _with_prefixlen(self, subnet):
+        if '/' in subnet:
+            return subnet
+
+        address = IPAddress(subnet)
+        for supernet, prefixlen in self._pools:
+            if address in supernet:
+                return '{}/{}'.format(subnet, prefixlen)
+
+        return subnet
+
     def is_leasable_subnet(self, subnet):
         """
-        Checks if a given subnet is inside the defined provision-able range
+        Checks if a given subnet is one of the subnets of the store's pools
 
         Args:
-            subnet (str): Ip in dotted decimal format with _cidr notation
-                (for example `192.168.200.0/24`)
+            subnet (str): Ip in dotted decimal format with its prefix length
+                (for example `192.168.200.0/24`), or an address, which is
+                checked with the prefix length of the pool it belongs to
 
         Returns:
             bool: True if subnet can be parsed into IPNetwork object and is
@@ -407,19 +490,22 @@ class SubnetStore(object):
         Raises:
             netaddr.AddrFormatError: If subnet can not be parsed into an ip.
         """
-
-        return \
-            self._min_subnet <= \
-            IPNetwork(subnet) <= \
-            self._max_subnet
+        network = IPNetwork(self._with_prefixlen(subnet))
+        return any(
+            network.prefixlen == prefixlen and network in supernet
+            for supernet, prefixlen in self._pools
+        )
 
     def get_allowed_range(self):
         """
         Returns:
-            str: The range of the store (with lowest and highest subnets as
-                the bounds).
+            str: The pools of the store, with the prefix length each of them
+                is split into.
         """
-        return '{} - {}'.format(self._min_subnet, self._max_subnet)
+        return ', '.join(
+            '{} (/{} subnets)'.format(supernet, prefixlen)
+            for supernet, prefixlen in self._pools
+        )
 
     @property
     def path(self):
@@ -443,9 +529,13 @@ class Lease(object):
         self._realise_lease_path()
 
     def _realise_lease_path(self):
-        ip = self.subnet.split('/')[0]
-        idx = ip.split('.')[2]
-        self._path = os.path.join(self._store_path, '{}.lease'.format(idx))
+        network = IPNetwork(self.subnet).cidr
+        if network.prefixlen == 24 and network in LEGACY_SUPERNET:
+            # Named by the third octet, as they were before subnet pools
+            name = str(network.ip).split('.')[2]
+        else:
+            name = '{}_{}'.format(network.ip, network.prefixlen)
+        self._path = os.path.join(self._store_path, '{}.lease'.format(name))
 
     def to_ip_network(self):
         return IPNetwork(self.subnet)
@@ -513,6 +603,90 @@ class Lease(object):
         return self.subnet
 
 
+def _parse_pools(pools):
+    """
+    Parse the `subnet_pools` config option
+
+    Args:
+        pools (str): Comma separated ``supernet:prefix_length`` items
+
+    Returns:
+        list of tuple: netaddr.IPNetwork supernet and prefix length pairs
+
+    Raises:
+        LagoSubnetLeaseException: If the pools are malformed
+    """
+    parsed = []
+    for pool in pools.split(','):
+        try:
+            supernet, prefixlen = pool.strip().rsplit(':', 1)
+            supernet, prefixlen = IPNetwork(supernet).cidr, int(prefixlen)
+        except (AddrFormatError, ValueError):
+            raise LagoSubnetLeaseException(
+                'Malformed subnet pool {}, should be of the form '
+                'supernet:prefix_length, for example 10.64.0.0/12:26'.
+                format(pool)
+            )
+        width = _address_width(supernet)
+        if not supernet.prefixlen <= prefixlen <= width - 2:
+            raise LagoSubnetLeaseException(
+                'Subnet pool {} can not be split into /{} subnets'.format(
+                    supernet, prefixlen
+                )
+            )
+        parsed.append((supernet, prefixlen))
+
+    return parsed
+
+
+def _overlaps(network, other):
+    return (
+        network.version == other.version and network.first <= other.last
+        and other.first <= network.last
+    )
+
+
+def _overlapping_lease_owner(lease, taken):
+    """
+    Args:
+        lease (Lease): A lease to check
+        taken (dict): Maps the path of each taken lease to its owner
+
+    Returns:
+        str or None: The owner of a taken lease whose subnet overlaps the
+            subnet of the given lease, if there is one
+    """
+    network = lease.to_ip_network()
+    for path, owner in six.iteritems(taken):
+        subnet = IPNetwork(_lease_file_subnet(os.path.basename(path)))
+        if _overlaps(network, subnet):
+            return owner
+    return None
+
+
+def _address_width(network):
+    return 32 if network.version == 4 else 128
+
+
+def _lease_file_subnet(lease_file):
+    """
+    Get the subnet a lease file is for from its name, see
+    :func:`Lease._realise_lease_path`
+
+    Args:
+        lease_file (str): Name of the lease file
+
+    Returns:
+        str or None: The subnet, or None if it's not a lease file
+    """
+    name, ext = os.path.splitext(lease_file)
+    if ext != '.lease':
+        return None
+    if '_' in name:
+        return '{}/{}'.format(*name.split('_', 1))
+    return '192.168.{}.0/24'.format(name)
+
+
 class LagoSubnetLeaseException(utils.LagoException):
     def __init__(self, msg, prv_msg=None):
         if prv_msg is not None:
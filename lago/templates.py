@@ -21,23 +21,593 @@ definitions:
         having to change the template name everywhere
 
 """
+import contextlib
 import errno
+import hashlib
 import json
 import logging
 import os
 import posixpath
-import shutil
+import re
 import sys
+import threading
+import time
+from concurrent import futures
 
 from six.moves.urllib import request as urllib
 from six.moves.urllib.error import HTTPError
+from xdg import BaseDirectory as base_dirs
 
 import lago.utils as utils
 from . import log_utils
+from .compression import (
+    CODECS, MAGIC_SIZE, get_codec, get_codec_by_extension, sniff_codec
+)
 from .config import config
 
 LOGGER = logging.getLogger(__name__)
 
+#: Size of the chunks read from the template sources
+CHUNK_SIZE = 1024 * 1024
+#: Bytes to download between resumable download checkpoints
+CHECKPOINT_INTERVAL = 64 * CHUNK_SIZE
+#: Minimum size of each segment of a segmented download
+SEGMENT_MIN_SIZE = 8 * CHUNK_SIZE
+#: Name of the template store index file
+INDEX_FILE = 'index.json'
+#: Name of the repository names index file, in the repos cache dir
+NAMES_INDEX_FILE = 'names.json'
+#: Supported template store formats, with the qemu-img format and convert
+#: options for each
+STORE_FORMATS = {
+    'raw': ('raw', ['-S', '4k']),
+    'qcow2': ('qcow2', []),
+    'qcow2-compressed': ('qcow2', ['-c']),
+}
+
+
+class ImageStreamWriter(object):
+    """
+    Writes a disk image to a file as its data comes in, decompressing it on
+    the fly if it's compressed with any of :data:`lago.compression.CODECS`,
+    and calculating the sha1 of the decompressed data, so the image is
+    written to disk only once.
+
+    Blocks of zeros are skipped instead of written, so the resulting file is
+    sparse.
+
+    Can be used as a context manager, that will close it on exit.
+    """
+
+    def __init__(self, dest):
+        """
+        Args:
+            dest (str): path to write the decompressed image to
+        """
+        self._dest = open(dest, 'wb')
+        self._decompressor = None
+        self.reset()
+
+    def reset(self):
+        """
+        Discard anything written so far, and start the image from scratch
+
+        Returns:
+            None
+        """
+        if self._decompressor is not None:
+            self._decompressor.abort()
+        self._dest.seek(0)
+        self._dest.truncate()
+        self._header = b''
+        self._sniffed = False
+        self._decompressor = None
+        self._sha1 = hashlib.sha1()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.close()
+        else:
+            if self._decompressor is not None:
+                self._decompressor.abort()
+            self._dest.close()
+
+    def write(self, data):
+        """
+        Process the next chunk of the image
+
+        Args:
+            data (bytes): next chunk of the (maybe compressed) image
+
+        Returns:
+            None
+        """
+        if not self._sniffed:
+            self._header += data
+            if len(self._header) < MAGIC_SIZE:
+                return
+
+            data, self._header = self._header, b''
+            self._sniffed = True
+            codec = sniff_codec(data)
+            if codec is not None:
+                self._decompressor = codec.decompressor(self._write_plain)
+
+        if self._decompressor is None:
+            self._write_plain(data)
+        else:
+            self._decompressor.write(data)
+
+    def _write_plain(self, chunk):
+        if not chunk:
+            return
+
+        self._sha1.update(chunk)
+        if chunk.count(b'\0') == len(chunk):
+            self._dest.seek(len(chunk), os.SEEK_CUR)
+        else:
+            self._dest.write(chunk)
+
+    def close(self):
+        """
+        Finish writing the image
+
+        Returns:
+            str: hex sha1 digest of the decompressed image
+
+        Raises:
+            RuntimeError: if the compressed stream was truncated
+        """
+        if self._dest.closed:
+            return self.hexdigest()
+
+        try:
+            if not self._sniffed:
+                self._write_plain(self._header)
+            elif self._decompressor is not None:
+                self._decompressor.close()
+
+            # make sure any skipped zeros at the end are accounted for
+            self._dest.truncate()
+        finally:
+            self._dest.close()
+
+        return self.hexdigest()
+
+    def hexdigest(self):
+        """
+        Returns:
+            str: hex sha1 digest of the data decompressed so far
+        """
+        return self._sha1.hexdigest()
+
+
+def _report_progress(done, total):
+    if total:
+        percent = done * 100 / float(total)
+        sys.stdout.write(
+            "\r% 3.1f%%" % percent + " complete (%d " %
+            (done // 1024) + "Kilobytes)"
+        )
+        sys.stdout.flush()
+
+
+class PartialDownload(object):
+    """
+    Keeps the raw data of a download in a partial file, next to a checkpoint
+    sidecar (``path + '.checkpoint'``) that records the source url and
+    validator (ETag or Last-Modified), the offset that was safely written and
+    the sha1 of the data up to that offset.
+
+    All the data is forwarded to the given sink (usually an
+    :class:`ImageStreamWriter`). When resuming, the partial data is verified
+    against the checkpoint and replayed into the sink, as the decompressor
+    and hash states can't be serialized, and then the download can continue
+    from the checkpoint offset.
+
+    When used as a context manager, the partial file and the checkpoint are
+    removed if the download finished, and checkpointed otherwise.
+    """
+
+    def __init__(self, path, sink):
+        """
+        Args:
+            path (str): path to the partial file
+            sink (ImageStreamWriter): object to pass the data to
+        """
+        self.path = path
+        self.checkpoint_path = '%s.checkpoint' % path
+        self.url = None
+        self.validator = None
+        self.offset = 0
+        self._sink = sink
+        self._fd = None
+        self._sha1 = hashlib.sha1()
+        self._checkpointed_offset = 0
+
+    def __enter__(self):
+        self.resume()
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.close()
+
+    def resume(self):
+        """
+        Load the checkpoint, if any, and replay the verified partial data into
+        the sink, if it does not match the checkpoint, the download is
+        restarted
+
+        Returns:
+            int: offset to continue the download from
+        """
+        try:
+            with open(self.checkpoint_path) as checkpoint_fd:
+                checkpoint = json.load(checkpoint_fd)
+            with open(self.path, 'rb') as part_fd:
+                self._replay(part_fd, checkpoint['offset'])
+        except (IOError, OSError, ValueError, KeyError):
+            self.restart()
+            return self.offset
+
+        if self._sha1.hexdigest() != checkpoint['sha1']:
+            LOGGER.debug('Partial download %s is corrupted', self.path)
+            self.restart()
+            return self.offset
+
+        self.url = checkpoint['url']
+        self.validator = checkpoint['validator']
+        self._checkpointed_offset = self.offset
+        self._fd = open(self.path, 'r+b')
+        self._fd.truncate(self.offset)
+        self._fd.seek(self.offset)
+        LOGGER.debug(
+            'Resuming download of %s from byte %d', self.url, self.offset
+        )
+        return self.offset
+
+    def _replay(self, part_fd, size):
+        while self.offset < size:
+            chunk = part_fd.read(min(CHUNK_SIZE, size - self.offset))
+            if not chunk:
+                raise ValueError('Partial download %s is short' % self.path)
+            self._sha1.update(chunk)
+            self._sink.write(chunk)
+            self.offset += len(chunk)
+
+    def restart(self, url=None, validator=None):
+        """
+        Discard any data downloaded so far
+
+        Args:
+            url (str or None): url the data will be downloaded from
+            validator (str or None): ETag or Last-Modified header of the url
+
+        Returns:
+            None
+        """
+        if self._fd is not None:
+            self._fd.close()
+        self._sink.reset()
+        self._fd = open(self.path, 'wb')
+        self._sha1 = hashlib.sha1()
+        self.offset = self._checkpointed_offset = 0
+        self.url = url
+        self.validator = validator
+        self._remove(self.checkpoint_path)
+
+    def write(self, data):
+        """
+        Append the given data to the download, checkpointing every
+        :data:`CHECKPOINT_INTERVAL` bytes
+
+        Args:
+            data (bytes): next chunk of the download
+
+        Returns:
+            None
+        """
+        self._fd.write(data)
+        self._sha1.update(data)
+        self._sink.write(data)
+        self.offset += len(data)
+        if self.offset - self._checkpointed_offset >= CHECKPOINT_INTERVAL:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Persist the current state, so the download can be resumed later
+
+        Returns:
+            None
+        """
+        if self._fd is None or self._fd.closed or not self.url:
+            return
+
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+        tmp_path = '%s.tmp' % self.checkpoint_path
+        with open(tmp_path, 'w') as checkpoint_fd:
+            json.dump(
+                {
+                    'url': self.url,
+                    'validator': self.validator,
+                    'offset': self.offset,
+                    'sha1': self._sha1.hexdigest(),
+                },
+                checkpoint_fd,
+            )
+            checkpoint_fd.flush()
+            os.fsync(checkpoint_fd.fileno())
+        os.rename(tmp_path, self.checkpoint_path)
+        self._checkpointed_offset = self.offset
+
+    def close(self):
+        """
+        Checkpoint and close the partial file, to resume it later
+
+        Returns:
+            None
+        """
+        try:
+            self.checkpoint()
+        except (IOError, OSError):
+            LOGGER.debug(
+                'Failed to checkpoint %s', self.checkpoint_path, exc_info=True
+            )
+        finally:
+            if self._fd is not None:
+                self._fd.close()
+
+    def finish(self):
+        """
+        Remove the partial file and its checkpoint, once the download is done
+
+        Returns:
+            None
+        """
+        if self._fd is not None:
+            self._fd.close()
+        self._remove(self.checkpoint_path)
+        self._remove(self.path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class SegmentedDownload(object):
+    """
+    Downloads an url using several connections at the same time, each of them
+    fetching a different byte range into a preallocated sparse file. Once all
+    the segments are there, the file is decompressed and hashed in a single
+    local pass to the final destination.
+
+    The progress of each segment is saved in a checkpoint sidecar
+    (``path + '.checkpoint'``) every :data:`CHECKPOINT_INTERVAL` bytes and
+    when the download is interrupted, so it can be resumed later. The first
+    segment that fails stops all the others. As the segments are not hashed
+    while downloading, the resulting image must be verified against the
+    expected hash, as :class:`TemplateStore` does.
+    """
+
+    def __init__(self, path, dest, url, size, validator, connections):
+        """
+        Args:
+            path (str): path to store the raw data to
+            dest (str): path to write the decompressed image to
+            url (str): absolute url to download
+            size (int): size of the data to download
+            validator (str or None): ETag or Last-Modified header of the url
+            connections (int): number of connections to use
+        """
+        self.path = path
+        self.checkpoint_path = '%s.checkpoint' % path
+        self.dest = dest
+        self.url = url
+        self.size = size
+        self.validator = validator
+        self.connections = connections
+        self.segments = self._load_segments()
+        self._lock = threading.Lock()
+        self._checkpoint_lock = threading.Lock()
+        self._checkpointed = self._downloaded()
+        self._stop = threading.Event()
+        self._fd = None
+
+    def _load_segments(self):
+        """
+        Returns:
+            list of list: ``[position, end]`` for each segment, where position
+                is the next byte to download and end the last byte of the
+                segment. Taken from the checkpoint if it matches this
+                download.
+        """
+        try:
+            with open(self.checkpoint_path) as checkpoint_fd:
+                checkpoint = json.load(checkpoint_fd)
+            if (
+                os.path.getsize(self.path) == self.size
+                and checkpoint['url'] == self.url
+                and checkpoint['validator'] == self.validator
+                and checkpoint['size'] == self.size
+            ):
+                LOGGER.debug('Resuming segmented download of %s', self.url)
+                return checkpoint['segments']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        segment_size = max(
+            -(-self.size // self.connections),
+            SEGMENT_MIN_SIZE,
+        )
+        return [
+            [start, min(start + segment_size, self.size) - 1]
+            for start in range(0, self.size, segment_size)
+        ]
+
+    def run(self):
+        """
+        Download all the segments and decompress the result
+
+        Returns:
+            str: sha1 hex digest of the decompressed image
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._fd = fd
+        try:
+            # Preallocate the sparse file, so every segment can be written
+            # in place
+            os.ftruncate(fd, self.size)
+            self._download_segments()
+            sys.stdout.write("\n")
+        except BaseException:
+            self._stop.set()
+            self.checkpoint()
+            raise
+        finally:
+            self._fd = None
+            os.close(fd)
+
+        with open(self.path, 'rb') as src, \
+                ImageStreamWriter(self.dest) as image:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                image.write(chunk)
+
+        PartialDownload._remove(self.checkpoint_path)
+        PartialDownload._remove(self.path)
+        return image.hexdigest()
+
+    def _download_segments(self):
+        """
+        Download every segment in its own thread, stopping the rest of them
+        as soon as one fails
+
+        Returns:
+            None
+
+        Raises:
+            Exception: the error of the first segment that failed
+        """
+        pool = futures.ThreadPoolExecutor(max_workers=self.connections)
+        try:
+            pending = [
+                pool.submit(self._download_segment, segment)
+                for segment in self.segments
+            ]
+            done, _ = futures.wait(
+                pending, return_when=futures.FIRST_EXCEPTION
+            )
+            for future in done:
+                future.result()
+        finally:
+            self._stop.set()
+            pool.shutdown(wait=True)
+
+    def _download_segment(self, segment):
+        position, end = segment
+        if position > end or self._stop.is_set():
+            return
+
+        headers = {'Range': 'bytes=%d-%d' % (position, end)}
+        if self.validator:
+            headers['If-Range'] = self.validator
+
+        response = urllib.urlopen(urllib.Request(self.url, headers=headers))
+        try:
+            if _get_range_start(response) != position:
+                raise RuntimeError(
+                    'Server did not return the range %d-%d of %s' %
+                    (position, end, self.url)
+                )
+
+            while position <= end and not self._stop.is_set():
+                chunk = response.read(min(CHUNK_SIZE, end - position + 1))
+                if not chunk:
+                    raise RuntimeError(
+                        'Download of %s was interrupted at byte %d' %
+                        (self.url, position)
+                    )
+                os.pwrite(self._fd, chunk, position)
+                position += len(chunk)
+                with self._lock:
+                    segment[0] = position
+                    downloaded = self._downloaded()
+                    _report_progress(downloaded, self.size)
+                if downloaded - self._checkpointed >= CHECKPOINT_INTERVAL:
+                    self.checkpoint()
+        finally:
+            response.close()
+
+    def _downloaded(self):
+        return self.size - sum(
+            end - position + 1 for position, end in self.segments
+        )
+
+    def checkpoint(self):
+        """
+        Persist the progress of every segment, so the download can be
+        resumed later
+
+        Returns:
+            None
+        """
+        try:
+            with self._checkpoint_lock:
+                with self._lock:
+                    segments = [list(segment) for segment in self.segments]
+                self._checkpointed = self.size - sum(
+                    end - position + 1 for position, end in segments
+                )
+                if self._fd is not None:
+                    os.fsync(self._fd)
+                tmp_path = '%s.tmp' % self.checkpoint_path
+                with open(tmp_path, 'w') as checkpoint_fd:
+                    json.dump(
+                        {
+                            'url': self.url,
+                            'validator': self.validator,
+                            'size': self.size,
+                            'segments': segments,
+                        },
+                        checkpoint_fd,
+                    )
+                    checkpoint_fd.flush()
+                    os.fsync(checkpoint_fd.fileno())
+                os.rename(tmp_path, self.checkpoint_path)
+        except (IOError, OSError):
+            LOGGER.debug(
+                'Failed to checkpoint %s', self.checkpoint_path, exc_info=True
+            )
+
+
+def _get_range_start(response):
+    """
+    Get the offset a partial content response starts at
+
+    Args:
+        response (urllib.addinfourl): response to check
+
+    Returns:
+        int or None: the offset of the first byte in the response, or
+            ``None`` if it's not a partial content response
+    """
+    if response.getcode() != 206:
+        return None
+
+    match = re.match(r'bytes (\d+)-', response.info().get('Content-Range', ''))
+    return int(match.group(1)) if match else None
+
 
 class FileSystemTemplateProvider:
     """
@@ -66,18 +636,25 @@ class FileSystemTemplateProvider:
         """
         return os.path.join(self._root, *path)
 
-    def download_image(self, handle, dest):
+    def download_image(self, handle, dest, compression=None):
         """
-        Copies over the handl to the destination
+        Copies over the handl to the destination, decompressing it if needed
 
         Args:
             handle (str): path to copy over
             dest (str): path to copy to
+            compression (str or None): unused, the compression of the image
+                is detected from its data
 
         Returns:
-            None
+            str: sha1 hex digest of the copied image
         """
-        shutil.copyfile(self._prefixed(handle), dest)
+        with open(self._prefixed(handle), 'rb') as src, \
+                ImageStreamWriter(dest) as image:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                image.write(chunk)
+
+        return image.hexdigest()
 
     def get_hash(self, handle):
         """
@@ -115,19 +692,31 @@ class HttpTemplateProvider:
     This provider allows the usage of http urls for templates
     """
 
-    def __init__(self, baseurl):
+    def __init__(self, baseurl, connections=None):
         """
         Args:
            baseurl (str): Url to prepend to every handle
+           connections (int or None): Number of connections to download each
+               image with, if the server supports range requests. If not
+               passed, the ``template_download_connections`` config value
+               is used
         """
         self.baseurl = baseurl
+        if connections is None:
+            connections = config.get('template_download_connections')
+        self.connections = int(connections)
 
-    def open_url(self, url, suffix='', dest=None):
+    def open_url(
+        self, url, suffix='', dest=None, headers=None, compression=None
+    ):
         """
-        Opens the given url, trying the compressed version first.
-        The compressed version url is generated adding the ``.xz`` extension
-        to the ``url`` and adding the given suffix **after** that ``.xz``
-        extension.
+        Opens the given url, trying the compressed versions first.
+        The compressed version urls are generated adding the extension of
+        each codec in :data:`lago.compression.CODECS` (``.xz`` first) to the
+        ``url`` and adding the given suffix **after** that extension. When a
+        suffix is given, only the ``.xz`` version is tried, as the sidecar
+        files of the other codecs are never named after the compressed
+        image.
         If dest passed, it will download the data to that path if able
 
         Args:
@@ -135,6 +724,10 @@ class HttpTemplateProvider:
             suffix (str): optional suffix to append to the url after adding
                 the compressed extension to the path
             dest (str or None): Path to save the data to
+            headers (dict or None): extra headers to send in the request
+            compression (str or None): name of the codec the url is known to
+                be compressed with, if any, then only that compressed
+                version is tried
 
         Returns:
             urllib.addinfourl: response object to read from (lazy read), closed
@@ -143,18 +736,29 @@ class HttpTemplateProvider:
         Raises:
             RuntimeError: if the url gave http error when retrieving it
         """
-        if not url.endswith('.xz'):
-            try:
-                return self.open_url(
-                    url=url + '.xz',
-                    suffix=suffix,
-                    dest=dest,
-                )
-            except RuntimeError:
-                pass
+        if get_codec_by_extension(url) is None:
+            if compression:
+                codecs = [get_codec(compression)]
+            elif suffix:
+                codecs = [get_codec('xz')]
+            else:
+                codecs = CODECS.values()
+
+            for codec in codecs:
+                try:
+                    return self.open_url(
+                        url=url + codec.extension,
+                        suffix=suffix,
+                        dest=dest,
+                        headers=headers,
+                    )
+                except RuntimeError:
+                    pass
         full_url = posixpath.join(self.baseurl, url) + suffix
         try:
-            response = urllib.urlopen(full_url)
+            response = urllib.urlopen(
+                urllib.Request(full_url, headers=headers or {})
+            )
         except HTTPError as e:
             if e.code >= 300:
                 raise RuntimeError(
@@ -163,7 +767,7 @@ class HttpTemplateProvider:
                 )
 
         meta = response.info()
-        file_size_kb = int(meta.get("Content-Length")[0]) // 1024
+        file_size_kb = int(meta.get("Content-Length", 0)) // 1024
         if file_size_kb > 0:
             sys.stdout.write(
                 "Downloading %s Kilobytes from %s \n" %
@@ -171,12 +775,7 @@ class HttpTemplateProvider:
             )
 
         def report(count, block_size, total_size):
-            percent = (count * block_size * 100 / float(total_size))
-            sys.stdout.write(
-                "\r% 3.1f%%" % percent + " complete (%d " %
-                (count * block_size // 1024) + "Kilobytes)"
-            )
-            sys.stdout.flush()
+            _report_progress(count * block_size, total_size)
 
         if dest:
             response.close()
@@ -184,36 +783,204 @@ class HttpTemplateProvider:
             sys.stdout.write("\n")
         return response
 
-    def download_image(self, handle, dest):
+    def download_image(self, handle, dest, compression=None):
         """
-        Downloads the image from the http server
+        Downloads the image from the http server.
+
+        If more than one connection is configured and the server accepts
+        range requests, the image is downloaded in segments, see
+        :class:`SegmentedDownload`, otherwise it's downloaded as a single
+        stream, see :func:`HttpTemplateProvider.stream_image`
 
         Args:
             handle (str): url from the `self.baseurl` to the remote template
             dest (str): Path to store the downloaded url to, must be a file
                 path
+            compression (str or None): name of the codec the image is
+                compressed with, as found in its metadata, if known
 
         Returns:
-            None
+            str: sha1 hex digest of the decompressed image
         """
         with log_utils.LogTask('Download image %s' % handle, logger=LOGGER):
-            self.open_url(url=handle, dest=dest)
+            if self.connections > 1:
+                download = self._get_segmented_download(
+                    handle, dest, compression
+                )
+                if download is not None:
+                    return download.run()
+
+            return self.stream_image(handle, dest, compression)
+
+    def stream_image(self, handle, dest, compression=None):
+        """
+        Downloads the image from the http server in a single stream, the data
+        is decompressed and hashed as it's received, so the image is written
+        only once.
+
+        The raw data is kept in a partial file (``dest + '.part'``) while
+        downloading, so an interrupted download will be resumed from the last
+        checkpoint the next time, see :class:`PartialDownload`
+
+        Args:
+            handle (str): url from the `self.baseurl` to the remote template
+            dest (str): Path to store the downloaded url to, must be a file
+                path
+            compression (str or None): name of the codec the image is
+                compressed with, if known
+
+        Returns:
+            str: sha1 hex digest of the decompressed image
+        """
+        with ImageStreamWriter(dest) as image, \
+                PartialDownload('%s.part' % dest, image) as download:
+            response = self._open_download(handle, download, compression)
+            try:
+                total = download.offset + int(
+                    response.info().get('Content-Length', 0)
+                )
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                    download.write(chunk)
+                    _report_progress(download.offset, total)
+                sys.stdout.write("\n")
+                # a dropped connection might look like the end of data
+                if total and download.offset != total:
+                    raise RuntimeError(
+                        'Download of %s was interrupted at byte %d of %d' %
+                        (handle, download.offset, total)
+                    )
+            finally:
+                response.close()
+
+        return image.hexdigest()
 
-        self.extract_image_xz(dest)
+    def _get_segmented_download(self, handle, dest, compression=None):
+        """
+        Probe the server to see if the given handle can be downloaded in
+        segments
+
+        Args:
+            handle (str): url from the `self.baseurl` to the remote template
+            dest (str): Path the image will be stored to
+            compression (str or None): name of the codec the image is
+                compressed with, if known
+
+        Returns:
+            SegmentedDownload or None: the download, or ``None`` if the server
+                does not advertise range requests support, or the image is too
+                small to be worth splitting
+        """
+        response = self.open_url(
+            url=handle,
+            headers={'Range': 'bytes=0-0'},
+            compression=compression,
+        )
+        try:
+            meta = response.info()
+            if meta.get('Accept-Ranges', '').lower() != 'bytes':
+                LOGGER.debug('%s does not accept range requests', handle)
+                return None
+
+            content_range = meta.get('Content-Range', '')
+            if response.getcode() == 206 and '/' in content_range:
+                size = content_range.rsplit('/', 1)[1]
+            else:
+                size = meta.get('Content-Length', '')
+            if not size.isdigit() or int(size) < 2 * SEGMENT_MIN_SIZE:
+                return None
+
+            return SegmentedDownload(
+                path='%s.segments' % dest,
+                dest=dest,
+                url=response.geturl(),
+                size=int(size),
+                validator=meta.get('ETag') or meta.get('Last-Modified'),
+                connections=self.connections,
+            )
+        finally:
+            response.close()
+
+    def _open_download(self, handle, download, compression=None):
+        """
+        Open the given handle to continue the given download, if the download
+        can't be resumed from where it was left, it's restarted
+
+        Args:
+            handle (str): url from the `self.baseurl` to the remote template
+            download (PartialDownload): download to continue
+            compression (str or None): name of the codec the image is
+                compressed with, if known
+
+        Returns:
+            urllib.addinfourl: response object to read the rest of the data
+                from
+        """
+        if download.offset:
+            headers = {'Range': 'bytes=%d-' % download.offset}
+            if download.validator:
+                headers['If-Range'] = download.validator
+
+            try:
+                response = self.open_url(
+                    url=handle, headers=headers, compression=compression
+                )
+            except RuntimeError:
+                response = None
+
+            if response is not None:
+                if (
+                    response.geturl() == download.url
+                    and _get_range_start(response) == download.offset
+                ):
+                    return response
+                response.close()
+
+            LOGGER.info('Unable to resume download of %s, restarting', handle)
+
+        response = self.open_url(url=handle, compression=compression)
+        meta = response.info()
+        download.restart(
+            url=response.geturl(),
+            validator=meta.get('ETag') or meta.get('Last-Modified'),
+        )
+        return response
 
     @staticmethod
-    def extract_image_xz(path):
-        if not path.endswith('.xz'):
-            os.rename(path, path + '.xz')
-            path = path + '.xz'
+    def extract_image(path, compression=None):
+        """
+        Decompress the given local image in place, the compressed file is
+        removed
+
+        Args:
+            path (str): Path to the image, without the extension of the codec
+                or with it
+            compression (str or None): name of the codec the image is
+                compressed with, detected from the extension of the path if
+                not passed
+
+        Raises:
+            RuntimeError: if the compression is unknown, or the decompression
+                failed
+        """
+        if compression:
+            codec = get_codec(compression)
+        else:
+            codec = get_codec_by_extension(path)
+            if codec is None:
+                raise RuntimeError('Unknown compression of %s' % path)
+
+        if not path.endswith(codec.extension):
+            os.rename(path, path + codec.extension)
+            path = path + codec.extension
 
         with log_utils.LogTask('Decompress local image', logger=LOGGER):
-            ret = utils.run_command(
-                ['xz', '--threads=0', '--decompress', path],
-            )
+            codec.decompress(path, path[:-len(codec.extension)])
+
+        os.unlink(path)
 
-        if ret:
-            raise RuntimeError('Failed to decompress %s' % path)
+    @staticmethod
+    def extract_image_xz(path):
+        HttpTemplateProvider.extract_image(path, 'xz')
 
     def get_hash(self, handle):
         """
@@ -258,6 +1025,126 @@ _PROVIDERS = {
     'http': HttpTemplateProvider,
 }
 
+#: Parsed repositories, by path or url, with the validator of the data they
+#: were parsed from
+_REPOS_CACHE = {}
+
+
+def _repos_cache_dir():
+    """
+    Returns:
+        str: path to the dir where the downloaded repositories and the repo
+            names index are cached
+    """
+    return base_dirs.save_cache_path('lago', 'repos')
+
+
+def _write_json_atomic(path, data):
+    with open(path + '.tmp', 'w') as f:
+        utils.json_dump(data, f)
+    os.rename(path + '.tmp', path)
+
+
+def _load_repo_file(path):
+    """
+    Load the given repository file, parsing it only if it changed since it
+    was last loaded by this process
+
+    Args:
+        path (str): path to the repository json file
+
+    Returns:
+        dict: the repository spec
+    """
+    path_stat = os.stat(path)
+    validator = (path_stat.st_mtime_ns, path_stat.st_size)
+    cached = _REPOS_CACHE.get(path)
+    if cached is None or cached[0] != validator:
+        with open(path) as fd:
+            cached = (validator, json.load(fd))
+        _REPOS_CACHE[path] = cached
+
+    return cached[1]
+
+
+def _load_repo_url(url):
+    """
+    Load the repository in the given url, it is cached on disk with its ETag
+    and Last-Modified headers, and revalidated with a conditional request, so
+    it's only downloaded and parsed if it changed. If the url can't be
+    reached, the cached copy is used, if any.
+
+    Args:
+        url (str): url of the repository json
+
+    Returns:
+        dict: the repository spec
+
+    Raises:
+        RuntimeError: if the repository could not be retrieved
+    """
+    cache_path = os.path.join(
+        _repos_cache_dir(),
+        '%s.json' % hashlib.sha1(url.encode('utf-8')).hexdigest(),
+    )
+    cached = _REPOS_CACHE.get(url)
+    if cached is None:
+        try:
+            with open(cache_path) as f:
+                on_disk = json.load(f)
+            cached = (
+                {
+                    'etag': on_disk['etag'],
+                    'last_modified': on_disk['last_modified'],
+                },
+                on_disk['dom'],
+            )
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    headers = {}
+    if cached is not None:
+        if cached[0]['etag']:
+            headers['If-None-Match'] = cached[0]['etag']
+        if cached[0]['last_modified']:
+            headers['If-Modified-Since'] = cached[0]['last_modified']
+
+    try:
+        response = urllib.urlopen(urllib.Request(url, headers=headers))
+        try:
+            data = response.read()
+            meta = response.info()
+        finally:
+            response.close()
+    except HTTPError as e:
+        if e.code == 304 and cached is not None:
+            LOGGER.debug('Using cached repo for %s', url)
+            _REPOS_CACHE[url] = cached
+            return cached[1]
+        raise RuntimeError('Unable to load repo from %s' % url)
+    except IOError:
+        if cached is not None:
+            LOGGER.warning('Unable to reach %s, using cached repo', url)
+            return cached[1]
+        raise RuntimeError('Unable to load repo from %s (IO error)' % url)
+
+    validator = {
+        'etag': meta.get('ETag'),
+        'last_modified': meta.get('Last-Modified'),
+    }
+    dom = json.loads(data)
+    _REPOS_CACHE[url] = (validator, dom)
+    if validator['etag'] or validator['last_modified']:
+        try:
+            _write_json_atomic(
+                cache_path,
+                dict(validator, url=url, dom=dom),
+            )
+        except (IOError, OSError):
+            LOGGER.debug('Failed to cache repo %s', url, exc_info=True)
+
+    return dom
+
 
 def find_repo_by_name(name, repo_dir=None):
     """
@@ -265,35 +1152,62 @@ def find_repo_by_name(name, repo_dir=None):
     'template_repos' if no repo dir passed), will rise an exception if not
     found
 
+    The names of the repos found are kept in an index, along with the mtime
+    and size of their files, so only new or modified repo files have to be
+    parsed to find the repo.
+
     Args:
         name (str): Name of the repo to search
         repo_dir (str): Directory where to search the repo
 
     Return:
-        str: path to the repo
+        TemplateRepository: the repo
 
     Raises:
         RuntimeError: if not found
     """
     if repo_dir is None:
-        repo_dir = config.get('template_repos')
-
-    ret, out, _ = utils.run_command([
-        'find',
-        repo_dir,
-        '-name',
-        '*.json',
-    ], )
+        repo_dir = config.get_section('init', {}).get('template_repos')
+
+    index_path = os.path.join(_repos_cache_dir(), NAMES_INDEX_FILE)
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (IOError, OSError, ValueError):
+        index = {}
+
+    index_changed = False
+    found = None
+    for dirpath, _, filenames in os.walk(repo_dir):
+        for filename in filenames:
+            if not filename.endswith('.json'):
+                continue
+
+            path = os.path.join(dirpath, filename)
+            path_stat = os.stat(path)
+            validator = [path_stat.st_mtime_ns, path_stat.st_size]
+            entry = index.get(path)
+            if entry is None or entry['validator'] != validator:
+                entry = {
+                    'validator': validator,
+                    'name': _load_repo_file(path)['name'],
+                }
+                index[path] = entry
+                index_changed = True
+
+            if found is None and entry['name'] == name:
+                found = path
+
+    if index_changed:
+        try:
+            _write_json_atomic(index_path, index)
+        except (IOError, OSError):
+            LOGGER.debug('Failed to save the repos index', exc_info=True)
 
-    repos = [
-        TemplateRepository.from_url(line.strip()) for line in out.split('\n')
-        if len(line.strip())
-    ]
+    if found is None:
+        raise RuntimeError('Could not find repo %s' % name)
 
-    for repo in repos:
-        if repo.name == name:
-            return repo
-    raise RuntimeError('Could not find repo %s' % name)
+    return TemplateRepository.from_url(found)
 
 
 class TemplateRepository:
@@ -330,7 +1244,8 @@ class TemplateRepository:
     def from_url(cls, path):
         """
         Instantiate a :class:`TemplateRepository` instance from the data in a
-        file or url
+        file or url, the parsed data is cached, see :func:`_load_repo_file`
+        and :func:`_load_repo_url`
 
         Args:
             path (str): Path or url to the json file to load
@@ -339,22 +1254,11 @@ class TemplateRepository:
             TemplateRepository: A new instance
         """
         if os.path.isfile(path):
-            with open(path) as fd:
-                data = fd.read()
+            dom = _load_repo_file(path)
         else:
-            try:
-                response = urllib.urlopen(path)
-                if response.code >= 300:
-                    raise RuntimeError('Unable to load repo from %s' % path)
+            dom = _load_repo_url(path)
 
-                data = response.read()
-                response.close()
-            except IOError:
-                raise RuntimeError(
-                    'Unable to load repo from %s (IO error)' % path
-                )
-
-        return cls(json.loads(data), path)
+        return cls(dom, path)
 
     def _get_provider(self, spec):
         """
@@ -527,13 +1431,18 @@ class TemplateVersion:
             destination (str): file path to write this template to
 
         Returns:
-            None
+            str or None: sha1 hex digest of the retrieved image, if the
+                source calculated it while retrieving
         """
-        self._source.download_image(self._handle, destination)
+        return self._source.download_image(
+            self._handle,
+            destination,
+            compression=self.get_metadata().get('compression'),
+        )
 
 
 class TemplateStore:
-    """
+    r"""
     Local cache to store templates
 
     The store uses various files to keep track of the templates cached, access
@@ -541,13 +1450,13 @@ class TemplateStore:
 
         $ tree /var/lib/lago/store/
         /var/lib/lago/store/
+        ├── index.json
         ├── in_office_repo:centos6_engine:v2.tmp
         ├── in_office_repo:centos7_engine:v5.tmp
         ├── in_office_repo:fedora22_host:v2.tmp
         ├── phx_repo:centos6_engine:v2
         ├── phx_repo:centos6_engine:v2.hash
         ├── phx_repo:centos6_engine:v2.metadata
-        ├── phx_repo:centos6_engine:v2.users
         ├── phx_repo:centos7_engine:v4.tmp
         ├── phx_repo:centos7_host:v4.tmp
         └── phx_repo:storage-nfs:v1.tmp
@@ -558,6 +1467,10 @@ class TemplateStore:
         Temporary file created while downloading the template from the
         repository (depends on the provider)
 
+    * \*.tmp.part, \*.tmp.segments and their \*.checkpoint files
+        Raw data of an unfinished download, and the state needed to resume it
+        (only for http providers)
+
     * ${repo_name}:${template_name}:${template_version}
         This file is the actual disk image template
 
@@ -567,15 +1480,47 @@ class TemplateStore:
     * \*.metadata
         Metadata for this template image in json format, usually this includes
         the `distro` and `root-password`
+
+    * index.json
+        Index of the stored templates, with their path, size, hash, metadata,
+        last access time and users, see :func:`TemplateStore._edit_index`.
+        Templates with no live users are evicted, least recently used first,
+        when the store grows over its quota, see :func:`TemplateStore.gc`
+
+    The ``.hash`` and ``.metadata`` files are still written, so older lago
+    versions can share the store, and the index is rebuilt from them if
+    missing.
     """
 
-    def __init__(self, path):
+    def __init__(
+        self, path, quota=None, image_format='raw', share_layers=False
+    ):
         """
         :param str path: Path to a local dir for this store, will be created if
             it does not exist
+        :param str quota: Maximum size of the store (see
+            :func:`lago.utils.parse_size`), if set, the store will be
+            garbage collected after each download
+        :param str image_format: Format to store the images in, one of
+            :data:`STORE_FORMATS`
+        :param bool share_layers: If set, layered templates whose base is
+            already in the store are kept as a thin qcow2 layer on top of it,
+            instead of being flattened
         :raises OSError: if there's a failure creating the dir
+        :raises LagoUserException: if the image format is not supported
         """
+        if image_format not in STORE_FORMATS:
+            raise utils.LagoUserException(
+                'Unsupported template store format {}, supported: {}'.format(
+                    image_format, ', '.join(sorted(STORE_FORMATS))
+                )
+            )
+
         self._root = path
+        self._quota = utils.parse_size(quota) if quota else None
+        self._image_format = image_format
+        self._share_layers = share_layers
+        self._index_cache = None
         try:
             os.makedirs(path)
         except OSError as e:
@@ -597,7 +1542,8 @@ class TemplateStore:
 
     def __contains__(self, temp_ver):
         """
-        Checks if a given version is in this store
+        Checks if a given version is in this store. Versions whose image was
+        removed from the store behind lago's back are dropped from the index.
 
         Args:
             temp_ver (TemplateVersion): Version to look for
@@ -605,7 +1551,22 @@ class TemplateStore:
         Returns:
             bool: ``True`` if the version is in this store
         """
-        return os.path.exists(self._prefixed(temp_ver.name))
+        if temp_ver.name not in self._index()['templates']:
+            return False
+
+        if os.path.exists(self._prefixed(temp_ver.name)):
+            return True
+
+        LOGGER.debug(
+            'The image of %s is gone, dropping it from the store index',
+            temp_ver.name,
+        )
+        with self._edit_index() as index:
+            if not os.path.exists(self._prefixed(temp_ver.name)):
+                index['templates'].pop(temp_ver.name, None)
+                index['usage'].pop(temp_ver.name, None)
+
+        return False
 
     def get_path(self, temp_ver):
         """
@@ -644,14 +1605,22 @@ class TemplateStore:
         with utils.LockFile(dest + '.lock'):
             # Image was downloaded while we were waiting
             if os.path.exists(dest):
+                if temp_ver not in self:
+                    # by a lago version that does not know about the index
+                    with self._edit_index() as index:
+                        index['templates'][temp_ver.name] = \
+                            self._entry_from_sidecars(temp_ver.name)
                 return
 
-            temp_ver.download(temp_dest)
+            sha1 = temp_ver.download(temp_dest)
+            metadata = None
             if store_metadata:
+                metadata = temp_ver.get_metadata()
                 with open('%s.metadata' % dest, 'w') as f:
-                    utils.json_dump(temp_ver.get_metadata(), f)
+                    utils.json_dump(metadata, f)
 
-            sha1 = utils.get_hash(temp_dest)
+            if sha1 is None:
+                sha1 = utils.get_hash(temp_dest)
             if temp_ver.get_hash() != sha1:
                 raise RuntimeError(
                     'Image %s does not match the expected hash %s' % (
@@ -663,21 +1632,370 @@ class TemplateStore:
             with open('%s.hash' % dest, 'w') as f:
                 f.write(sha1)
 
+            # Convert next to the final path and rename it once done, as
+            # the image is considered to be in the store as soon as its
+            # path exists
+            converted_dest = '%s.converted' % dest
             with log_utils.LogTask('Convert image', logger=LOGGER):
-                result = utils.run_command(
-                    [
-                        'qemu-img',
-                        'convert',
-                        '-O',
-                        'raw',
-                        temp_dest,
-                        dest,
-                    ],
+                try:
+                    image_format, backing = self._store_image(
+                        temp_ver.name, temp_dest, converted_dest
+                    )
+                finally:
+                    PartialDownload._remove(temp_dest)
+
+                os.rename(converted_dest, dest)
+
+            with self._edit_index() as index:
+                index['templates'][temp_ver.name] = {
+                    'path': dest,
+                    'size': self._disk_usage(temp_ver.name),
+                    'hash': sha1,
+                    'metadata': metadata,
+                    'format': image_format,
+                    'backing': backing,
+                }
+
+        if self._quota is not None:
+            self.gc()
+
+    def _store_image(self, name, src, dest):
+        """
+        Convert the given downloaded image to the store format.
+
+        If the image is a layer on top of another template version of the
+        same repo (as exported by ``lago export`` without ``--standalone``),
+        and that version is in the store, the layer is pointed to it, and
+        then either kept as is, if sharing layers, or flattened.
+
+        Args:
+            name (str): name of the template version
+            src (str): path to the downloaded image
+            dest (str): path to write the stored image to
+
+        Returns:
+            tuple(str, str or None): format of the stored image, and the name
+                of the template version it's layered on, if any
+
+        Raises:
+            RuntimeError: if the conversion failed, or the base of a layered
+                image is not in the store
+        """
+        parent = utils.get_qemu_info(src).get('backing-filename')
+        if parent:
+            repo_name = name.split(':', 1)[0]
+            base_name = '%s:%s' % (repo_name, os.path.basename(parent))
+            base = self._index()['templates'].get(base_name)
+            if base is None:
+                raise RuntimeError(
+                    'Template %s is layered on %s, which is not in the store' %
+                    (name, base_name)
                 )
 
-                os.unlink(temp_dest)
-                if result:
-                    raise RuntimeError(result.err)
+            utils.qemu_rebase(
+                target=src,
+                backing_file=self._prefixed(base_name),
+                backing_format=base.get('format', 'raw'),
+                safe=False,
+            )
+            if self._share_layers:
+                LOGGER.debug('Storing %s as a layer of %s', name, base_name)
+                os.rename(src, dest)
+                return 'qcow2', base_name
+
+        image_format, options = STORE_FORMATS[self._image_format]
+        result = utils.run_command(
+            ['qemu-img', 'convert', '-O', image_format] + options +
+            [src, dest],
+        )
+        if result:
+            raise RuntimeError(result.err)
+
+        return image_format, None
+
+    def get_stored_format(self, temp_ver):
+        """
+        Retrieves the format of the image of the given template version in
+        the store
+
+        Args:
+            temp_ver (TemplateVersion): template version to retrieve the
+                format for
+
+        Returns:
+            str: qemu image format of the given template version
+        """
+        entry = self._index()['templates'].get(temp_ver.name, {})
+        # images stored before the format was configurable are always raw
+        return entry.get('format') or 'raw'
+
+    def _lock(self):
+        """
+        Lock for the store wide state, that is, the index and the garbage
+        collection
+
+        Returns:
+            lago.utils.LockFile: the lock context manager
+        """
+        return utils.LockFile(self._prefixed('.store.lock'))
+
+    def _read_index(self):
+        """
+        Read the index file, reusing the already parsed one if the file did
+        not change
+
+        Returns:
+            dict or None: the index, or ``None`` if there's no index file yet
+        """
+        index_path = self._prefixed(INDEX_FILE)
+        try:
+            index_stat = os.stat(index_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        key = (index_stat.st_mtime_ns, index_stat.st_size, index_stat.st_ino)
+        if self._index_cache is None or self._index_cache[0] != key:
+            with open(index_path) as f:
+                self._index_cache = (key, json.load(f))
+
+        return self._index_cache[1]
+
+    def _index(self):
+        """
+        Returns:
+            dict: the store index, creating it if needed, see
+                :func:`TemplateStore._edit_index`
+        """
+        index = self._read_index()
+        if index is None:
+            with self._edit_index() as index:
+                pass
+
+        return index
+
+    @contextlib.contextmanager
+    def _edit_index(self):
+        """
+        Context manager to modify the store index under the store lock, the
+        changes are written when exiting the context.
+
+        The index has two maps, both keyed by template version name:
+
+        * ``templates``: the versions fully stored, with their ``path``,
+          ``size`` (on disk), ``hash``, ``metadata``, image ``format`` and
+          the name of the version they are layered on (``backing``)
+
+        * ``usage``: the ``last_access`` time and the ``users`` of each
+          version, see :func:`TemplateStore.mark_used`
+
+        If there's no index yet, it's created from the sidecar files of the
+        stored images.
+
+        Yields:
+            dict: the index to modify
+        """
+        with self._lock():
+            # always start from a fresh copy, readers might hold the cached one
+            self._index_cache = None
+            index = self._read_index()
+            if index is None:
+                index = self._index_from_sidecars()
+
+            self._index_cache = None
+            yield index
+
+            index_path = self._prefixed(INDEX_FILE)
+            with open(index_path + '.tmp', 'w') as f:
+                utils.json_dump(index, f)
+            os.rename(index_path + '.tmp', index_path)
+
+    def _index_from_sidecars(self):
+        """
+        Build the index from the sidecar files of the stored images
+
+        Returns:
+            dict: the new index
+        """
+        index = {'templates': {}, 'usage': {}}
+        for entry in os.listdir(self._root):
+            name = entry[:-len('.hash')]
+            if not (
+                entry.endswith('.hash')
+                and os.path.isfile(self._prefixed(name))
+            ):
+                continue
+
+            index['templates'][name] = self._entry_from_sidecars(name)
+            # Users files written before the index existed
+            try:
+                with open(self._prefixed('%s.users' % name)) as f:
+                    index['usage'][name] = json.load(f)
+            except (IOError, OSError, ValueError):
+                pass
+
+        return index
+
+    def _entry_from_sidecars(self, name):
+        dest = self._prefixed(name)
+        with open('%s.hash' % dest) as f:
+            sha1 = f.read().strip()
+
+        try:
+            with open('%s.metadata' % dest) as f:
+                metadata = json.load(f)
+        except (IOError, OSError):
+            metadata = None
+
+        return {
+            'path': dest,
+            'size': self._disk_usage(name),
+            'hash': sha1,
+            'metadata': metadata,
+        }
+
+    def mark_used(self, temp_ver, uuid_path):
+        """
+        Register the prefix with the given uuid file as a user of the given
+        template version, and refresh the version last access time. The
+        template will not be evicted while the prefix exists.
+
+        Args:
+            temp_ver (TemplateVersion): template version that is used
+            uuid_path (str): path to the uuid file of the prefix that uses it
+
+        Returns:
+            None
+        """
+        with open(uuid_path) as f:
+            user = [uuid_path, f.read()]
+
+        with self._edit_index() as index:
+            usage = index['usage'].get(temp_ver.name, {})
+            live_users = [
+                entry for entry in usage.get('users', [])
+                if entry != user and _prefix_exists(*entry)
+            ]
+            index['usage'][temp_ver.name] = {
+                'last_access': time.time(),
+                'users': live_users + [user],
+            }
+
+    def _disk_usage(self, name):
+        try:
+            return os.stat(self._prefixed(name)).st_blocks * 512
+        except OSError:
+            return 0
+
+    def list(self):
+        """
+        List the template versions in the store, from the index
+
+        Returns:
+            dict: for each template version name, its ``path``, ``size``,
+                ``hash``, ``format``, ``last_access`` time (``None`` if
+                unknown) and ``refcount``, the number of live prefixes using
+                it (``None`` if unknown)
+        """
+        index = self._index()
+        result = {}
+        for name, entry in index['templates'].items():
+            usage = index['usage'].get(name)
+            last_access = refcount = None
+            if usage is not None:
+                last_access = usage['last_access']
+                refcount = len(
+                    [user for user in usage['users'] if _prefix_exists(*user)]
+                )
+
+            result[name] = {
+                'path': entry['path'],
+                'size': entry['size'],
+                'hash': entry['hash'],
+                'format': entry.get('format') or 'raw',
+                'last_access': last_access,
+                'refcount': refcount,
+            }
+
+        return result
+
+    def gc(self, quota=None):
+        """
+        Evict templates from the store, least recently used first, until it
+        fits in the given quota. Templates that are still used by a live
+        prefix, being downloaded, that are the base of other stored layered
+        templates, or that have no usage info (stored by older versions of
+        lago, so their users are unknown) are never evicted.
+
+        Args:
+            quota (str or int or None): maximum size of the store, if not
+                passed the quota of the store is used
+
+        Returns:
+            list of str: names of the evicted template versions
+        """
+        quota = self._quota if quota is None else utils.parse_size(quota)
+        if quota is None:
+            return []
+
+        evicted = []
+        with self._edit_index() as index:
+            templates = index['templates']
+            usage = sum(entry['size'] for entry in templates.values())
+            candidates = []
+            for name in templates:
+                users = index['usage'].get(name)
+                if users is None:
+                    LOGGER.debug('Skipping %s, its users are unknown', name)
+                    continue
+                if any(_prefix_exists(*user) for user in users['users']):
+                    continue
+                candidates.append((users['last_access'], name))
+
+            for _, name in sorted(candidates):
+                if usage <= quota:
+                    break
+
+                if any(
+                    entry.get('backing') == name
+                    for entry in templates.values()
+                ):
+                    LOGGER.debug('Skipping %s, other templates use it', name)
+                    continue
+
+                if self._evict(name):
+                    usage -= templates.pop(name)['size']
+                    index['usage'].pop(name)
+                    evicted.append(name)
+
+        return evicted
+
+    def _evict(self, name):
+        """
+        Remove the given template version files from the store, unless it's
+        being downloaded
+
+        Args:
+            name (str): name of the template version to remove
+
+        Returns:
+            bool: ``True`` if it was removed, ``False`` if it was busy
+        """
+        dest = self._prefixed(name)
+        try:
+            with utils.LockFile(dest + '.lock', blocking=False):
+                LOGGER.info('Evicting template %s from the store', name)
+                for path in (
+                    dest + '.hash', dest, dest + '.metadata', dest + '.users'
+                ):
+                    PartialDownload._remove(path)
+                return True
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            LOGGER.debug('Skipping %s, it is being downloaded', name)
+            return False
 
     def get_stored_metadata(self, temp_ver):
         """
@@ -690,6 +2008,10 @@ class TemplateStore:
         Returns:
             dict: the metadata of the given template version
         """
+        entry = self._index()['templates'].get(temp_ver.name)
+        if entry is not None and entry['metadata'] is not None:
+            return entry['metadata']
+
         with open(self._prefixed('%s.metadata' % temp_ver.name)) as f:
             return json.load(f)
 
@@ -704,10 +2026,33 @@ class TemplateStore:
         Returns:
             str: hash of the given template version
         """
+        entry = self._index()['templates'].get(temp_ver.name)
+        if entry is not None:
+            return entry['hash']
+
         with open(self._prefixed('%s.hash' % temp_ver.name)) as f:
             return f.read().strip()
 
 
+def _prefix_exists(uuid_path, uuid):
+    """
+    Check if the prefix with the given uuid file still exists, that is, that
+    its uuid file is still there with the same uuid
+
+    Args:
+        uuid_path (str): path to the uuid file of the prefix
+        uuid (str): uuid of the prefix
+
+    Returns:
+        bool: ``True`` if the prefix exists
+    """
+    try:
+        with open(uuid_path) as f:
+            return f.read() == uuid
+    except (IOError, OSError):
+        return False
+
+
 class LagoMissingTemplateError(utils.LagoException):
     def __init__(self, name, path):
         super().__init__(
@@ -49,6 +49,8 @@ import six
 from six.moves import queue
 
 LOGGER = logging.getLogger(__name__)
+#: Size of the chunks files are read in when hashing them
+HASH_CHUNK_SIZE = 1024 * 1024
 
 
 class TimerException(Exception):
@@ -74,14 +76,39 @@ def func_vector(target, args_sequence):
     return [functools.partial(target, *args) for args in args_sequence]
 
 
+def _bounded(func, semaphore):
+    @functools.wraps(func)
+    def wrapper():
+        with semaphore:
+            return func()
+
+    return wrapper
+
+
 class VectorThread:
-    def __init__(self, targets):
+    """
+    Runs a list of callables, each one in its own thread
+
+    Args:
+        targets(list of callable): functions to run
+        max_workers(int): if set, at most this many targets will be
+            running at the same time, the rest will wait for a free slot
+    """
+
+    def __init__(self, targets, max_workers=None):
         self.targets = targets
         self.results = None
+        self.max_workers = max_workers
 
     def start_all(self):
         self.thread_handles = []
+        semaphore = None
+        if self.max_workers:
+            semaphore = threading.BoundedSemaphore(self.max_workers)
+
         for target in self.targets:
+            if semaphore is not None:
+                target = _bounded(target, semaphore)
             q = queue.Queue()
             t = threading.Thread(target=_ret_via_queue, args=(target, q))
             self.thread_handles.append((t, q))
@@ -103,14 +130,17 @@ class VectorThread:
         return [x.get('return', None) for x in self.results]
 
 
-def invoke_in_parallel(func, *args_sequences):
-    vt = VectorThread(func_vector(func, list(zip(*args_sequences))))
+def invoke_in_parallel(func, *args_sequences, max_workers=None):
+    vt = VectorThread(
+        func_vector(func, list(zip(*args_sequences))),
+        max_workers=max_workers,
+    )
     vt.start_all()
     return vt.join_all()
 
 
-def invoke_different_funcs_in_parallel(*funcs):
-    vt = VectorThread(funcs)
+def invoke_different_funcs_in_parallel(*funcs, max_workers=None):
+    vt = VectorThread(funcs, max_workers=max_workers)
     vt.start_all()
     return vt.join_all()
 
@@ -364,6 +394,12 @@ class ExceptionTimer(object):
         self.stop()
 
     def start(self):
+        # SIGALRM can only be handled from the main thread, so without a
+        # timeout there is nothing to arm, and the timer can be used from
+        # worker threads too
+        if not self.timeout:
+            return
+
         def raise_timeout(*_):
             raise TimerException('Passed %d seconds' % self.timeout)
 
@@ -371,7 +407,8 @@ class ExceptionTimer(object):
         signal.alarm(self.timeout)
 
     def stop(self):
-        signal.alarm(0)
+        if self.timeout:
+            signal.alarm(0)
 
 
 class Flock(object):
@@ -415,7 +452,8 @@ class LockFile(object):
     Context manager that creates a file based lock, with optional
     timeout in the acquire operation.
 
-    This context manager should be used only from the main Thread.
+    When a timeout is given, this context manager should be used only
+    from the main Thread.
 
     Args:
         path(str): path to the dir to lock
@@ -600,7 +638,9 @@ def add_timestamp_suffix(base_string):
 
 
 def rotate_dir(base_dir):
-    shutil.move(base_dir, add_timestamp_suffix(base_dir))
+    rotated = add_timestamp_suffix(base_dir)
+    shutil.move(base_dir, rotated)
+    return rotated
 
 
 def ipv4_to_mac(ip):
@@ -665,6 +705,31 @@ def run_command_with_validation(
     return result
 
 
+def qemu_convert(
+    source, target, target_format, source_format=None, fail_on_error=True
+):
+    """
+    Write the disk in source to target with qemu-img convert. The layers of
+    source are merged, and zeroed and unallocated areas are not written, so
+    target comes out sparse.
+
+    Args:
+        source(str): Path to the source disk
+        target(str): Path to write the disk to
+        target_format(str): Format of target, for example qcow2 or raw
+        source_format(str): Format of source, probed if not given
+    """
+    cmd = ['qemu-img', 'convert', '-O', target_format, source, target]
+    if source_format:
+        cmd[2:2] = ['-f', source_format]
+
+    return run_command_with_validation(
+        cmd,
+        fail_on_error,
+        msg='Failed to convert {} to {}'.format(source, target)
+    )
+
+
 def get_qemu_info(path, backing_chain=False, fail_on_error=True):
     """
     Get info on a given qemu disk
@@ -689,7 +754,9 @@ def get_qemu_info(path, backing_chain=False, fail_on_error=True):
     return json.loads(result.out)
 
 
-def qemu_rebase(target, backing_file, safe=True, fail_on_error=True):
+def qemu_rebase(
+    target, backing_file, safe=True, fail_on_error=True, backing_format=None
+):
     """
     changes the backing file of 'source' to 'backing_file'
     If backing_file is specified as "" (the empty string),
@@ -702,10 +769,13 @@ def qemu_rebase(target, backing_file, safe=True, fail_on_error=True):
         backing_file(str): path to the base disk
         safe(bool): if false, allow unsafe rebase
          (check qemu-img docs for more info)
+        backing_format(str): format of the base disk, if known
     """
     cmd = ['qemu-img', 'rebase', '-b', backing_file, target]
     if not safe:
         cmd.insert(2, '-u')
+    if backing_format:
+        cmd[2:2] = ['-F', backing_format]
 
     return run_command_with_validation(
         cmd,
@@ -716,14 +786,75 @@ def qemu_rebase(target, backing_file, safe=True, fail_on_error=True):
     )
 
 
-def compress(input_file, block_size, fail_on_error=True):
-    cmd = [
-        'xz', '--compress', '--keep', '--threads=0', '--best', '--force',
-        '--verbose', '--block-size={}'.format(block_size), input_file
-    ]
-    return run_command_with_validation(
-        cmd, fail_on_error, msg='Failed to compress {}'.format(input_file)
-    )
+def hash_and_compress(
+    file_path,
+    checksum='sha1',
+    compress_to=None,
+    compress_cmd=None,
+):
+    """
+    Generate a hash for the given file, and optionally compress it, reading
+    it only once for both
+
+    Args:
+        file_path (str): Path to the file to generate the hash for
+        checksum (str): hash to apply, one of the supported by hashlib, for
+            example sha1 or sha512
+        compress_to (str): If set, the file is compressed into this path
+        compress_cmd (list of str): Command that compresses its stdin to its
+            stdout, required with ``compress_to``, see
+            :func:`lago.compression.Codec.compress_cmd`
+
+    Returns:
+        str: hash for that file
+
+    Raises:
+        RuntimeError: If the compression failed
+    """
+    if not compress_to:
+        return get_hash(file_path, checksum)
+
+    if not compress_cmd:
+        raise ValueError('No command to compress {} with'.format(file_path))
+
+    sha = getattr(hashlib, checksum)()
+    cmd = compress_cmd
+    with open(file_path, 'rb') as file_descriptor, \
+            open(compress_to, 'wb') as compressed:
+        compressor = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=compressed,
+            stderr=subprocess.PIPE,
+        )
+        exited_early = False
+        try:
+            for chunk in iter(
+                functools.partial(file_descriptor.read, HASH_CHUNK_SIZE), b''
+            ):
+                sha.update(chunk)
+                try:
+                    compressor.stdin.write(chunk)
+                except BrokenPipeError as err:
+                    # the compressor exited, its errors are reported below
+                    LOGGER.debug('Failed writing to %s: %s', cmd[0], err)
+                    exited_early = True
+                    break
+        except BaseException:
+            # don't let the compressor finish a truncated file
+            compressor.kill()
+            raise
+        finally:
+            _, err = compressor.communicate()
+
+    if compressor.returncode or exited_early:
+        raise RuntimeError(
+            'Failed to compress {}\n{}'.format(
+                file_path, err.decode('utf-8', 'replace')
+            )
+        )
+
+    return sha.hexdigest()
 
 
 def cp(input_file, output_file, fail_on_error=True):
@@ -855,6 +986,52 @@ def filter_spec(spec, paths, wildcard='*', separator='/'):
             raise
 
 
+def parse_size(size):
+    """
+    Parse a size with an optional binary unit suffix, as qemu-img does
+
+    Args:
+        size(str or int): size to parse, for example ``512``, ``10G`` or
+            ``1.5T``
+
+    Returns:
+        int: size in bytes
+
+    Raises:
+        LagoUserException: if the size is malformed
+    """
+    if isinstance(size, six.integer_types):
+        return size
+
+    units = 'BKMGTP'
+    size = str(size).strip().upper()
+    factor = 1
+    if size and size[-1] in units:
+        factor = 1024**units.index(size[-1])
+        size = size[:-1]
+
+    try:
+        return int(float(size) * factor)
+    except ValueError:
+        raise LagoUserException('Malformed size: {}'.format(size))
+
+
+def str_to_bool(value):
+    """
+    Interpret a config value as a boolean
+
+    Args:
+        value(str or bool): value to interpret, strings like ``true``,
+            ``yes``, ``on`` or ``1`` (in any case) are true
+
+    Returns:
+        bool: the value as a boolean
+    """
+    if isinstance(value, six.string_types):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
 def ver_cmp(ver1, ver2):
     """
     Compare lago versions
@@ -20,20 +20,23 @@
 
 from __future__ import absolute_import
 
+import contextlib
 from copy import deepcopy
 import functools
 import hashlib
 import json
 import logging
 import os
+import threading
 import uuid
 
 import yaml
 
 import six
 
-from lago import log_utils, plugins, utils
+from lago import chunk_store, export, log_utils, plugins, ssh, utils
 from lago.config import config
+from lago.providers.libvirt import utils as libvirt_utils
 from lago.providers.libvirt.network import BridgeNetwork, NATNetwork
 
 LOGGER = logging.getLogger(__name__)
@@ -50,6 +53,58 @@ class LagoUnknownVMTypeError(utils.LagoUserException):
         )
 
 
+def _start_waves(vms, known):
+    """
+    Split the given VMs into waves that can be started concurrently, so
+    that every VM comes after the VMs listed in its ``depends-on`` spec
+    entry. Dependencies on VMs that are not being started are assumed to
+    be up already.
+
+    Args:
+        vms (list of lago.plugins.vm.VMPlugin): VMs to start
+        known (container of str): Names of all the VMs in the environment
+
+    Returns:
+        list of lists of lago.plugins.vm.VMPlugin: The VMs grouped by wave,
+            in start order
+
+    Raises:
+        LagoUserException: If a VM depends on an unknown VM, or the
+            dependencies form a cycle
+    """
+    pending = {}
+    for vm in vms:
+        deps = vm.spec.get('depends-on', [])
+        if isinstance(deps, six.string_types):
+            deps = [deps]
+        unknown = set(name for name in deps if name not in known)
+        if unknown:
+            raise utils.LagoUserException(
+                'VM {} depends on unknown VMs: {}'.format(
+                    vm.name(), ', '.join(sorted(unknown))
+                )
+            )
+        pending[vm.name()] = (vm, set(deps))
+
+    for _, deps in pending.values():
+        deps.intersection_update(pending)
+
+    waves = []
+    while pending:
+        ready = [name for name, (_, deps) in pending.items() if not deps]
+        if not ready:
+            raise utils.LagoUserException(
+                'Circular depends-on between VMs: {}'.format(
+                    ', '.join(sorted(pending))
+                )
+            )
+        waves.append([pending.pop(name)[0] for name in ready])
+        for _, deps in pending.values():
+            deps.difference_update(ready)
+
+    return waves
+
+
 def _gen_ssh_command_id():
     return uuid.uuid1().hex[:8]
 
@@ -95,6 +150,13 @@ class VirtEnv(object):
         with open(self.prefix.paths.uuid(), 'r') as uuid_fd:
             self.uuid = uuid_fd.read().strip()
 
+        self.ssh_pool = ssh.SSHConnectionPool(
+            idle_timeout=int(config.get('ssh_idle_timeout'))
+        )
+        # See state_snapshot
+        self.current_state_snapshot = None
+        self._state_snapshot_lock = threading.Lock()
+
         self._nets = {}
         compat = self.get_compat()
         for name, spec in net_specs.items():
@@ -176,9 +238,17 @@ class VirtEnv(object):
         init_file_name,
         out_format,
         collect_only=False,
-        with_threads=True
+        with_threads=True,
+        compression=None,
+        chunked=False,
+        since=None,
     ):
         # todo: move this logic to PrefixExportManager
+        if since and chunked:
+            raise utils.LagoUserException(
+                'The changes since a snapshot can not be exported chunked'
+            )
+
         if not vms_names:
             vms_names = list(self._vms.keys())
 
@@ -207,9 +277,21 @@ class VirtEnv(object):
             if not os.path.isdir(dst_dir):
                 os.mkdir(dst_dir)
 
+            # All the disks of all the VMs queue on the same I/O and CPU
+            # budgets
+            scheduler = export.ExportScheduler()
+
             def _export_disks(vm):
                 return vm.export_disks(
-                    standalone, dst_dir, compress, collect_only, with_threads
+                    standalone,
+                    dst_dir,
+                    compress,
+                    collect_only,
+                    with_threads,
+                    scheduler=scheduler,
+                    compression=compression,
+                    chunked=chunked,
+                    since=since,
                 )
 
             if collect_only:
@@ -230,14 +312,26 @@ class VirtEnv(object):
                 )
 
         self.generate_init(
-            os.path.join(dst_dir, init_file_name), out_format, vms
+            os.path.join(dst_dir, init_file_name),
+            out_format,
+            vms,
+            chunked=chunked,
+            since=since,
         )
 
         results['init-file'] = os.path.join(dst_dir, init_file_name)
 
         return results
 
-    def generate_init(self, dst, out_format, vms_to_include, filters=None):
+    def generate_init(
+        self,
+        dst,
+        out_format,
+        vms_to_include,
+        filters=None,
+        chunked=False,
+        since=None,
+    ):
         """
         Generate an init file which represents this env and can
         be used with the images created by self.export_vms
@@ -249,6 +343,11 @@ class VirtEnv(object):
                 the init file
             vms_to_include (list of :class:lago.plugins.vm.VMPlugin):
                 list of vms to include in the init file
+            chunked (bool): If True, the disks were exported as manifests of
+                a chunk store, see :class:`lago.export.ChunkedExportManager`
+            since (str): If given, the disks were exported as the changes
+                since this snapshot, see
+                :class:`lago.export.DeltaExportManager`
         Returns:
             None
         """
@@ -281,7 +380,13 @@ class VirtEnv(object):
                 ]
 
                 for disk in domain['disks']:
-                    if disk['type'] == 'template':
+                    if since:
+                        # Each disk is a layer on top of its earlier export
+                        disk['type'] = 'template'
+                        disk['template_type'] = 'qcow2'
+                        disk['format'] = 'qcow2'
+                        disk.pop('make_a_copy', None)
+                    elif disk['type'] == 'template':
                         disk['template_type'] = 'qcow2'
                     elif disk['type'] == 'empty':
                         disk['type'] = 'file'
@@ -291,6 +396,8 @@ class VirtEnv(object):
                     disk['path'] = os.path.join(
                         '$LAGO_INITFILE_PATH', os.path.basename(disk['path'])
                     )
+                    if chunked:
+                        disk['path'] += chunk_store.MANIFEST_SUFFIX
 
             with open(dst, 'wt') as f:
                 if isinstance(out_format, plugins.output.YAMLOutFormatPlugin):
@@ -343,16 +450,25 @@ class VirtEnv(object):
                     set(self._nets[net_name] for net_name in vm.nets())
                 )
 
+        waves = _start_waves(vms, self._vms)
+        max_workers = int(config.get('start_workers'))
+        rollback_lock = threading.Lock()
+
         with LogTask(log_msg), utils.RollbackContext() as rollback:
+
+            def _start(entity):
+                entity.start()
+                with rollback_lock:
+                    rollback.prependDefer(entity.stop)
+
             with LogTask('Start nets'):
-                for net in nets:
-                    net.start()
-                    rollback.prependDefer(net.stop)
+                utils.invoke_in_parallel(_start, list(nets))
 
             with LogTask('Start vms'):
-                for vm in vms:
-                    vm.start()
-                    rollback.prependDefer(vm.stop)
+                for wave in waves:
+                    utils.invoke_in_parallel(
+                        _start, wave, max_workers=max_workers
+                    )
                 rollback.clear()
 
     def _get_stop_shutdown_common_args(self, vm_names):
@@ -397,23 +513,61 @@ class VirtEnv(object):
 
         for vm in vms_to_stop:
             unused_nets = unused_nets.union(vm.nets())
-        for vm in self._vms.values():
-            if not vm.running() or vm.name() in vm_names:
-                continue
-            for net in vm.nets():
-                unused_nets.discard(net)
+        with self.state_snapshot():
+            for vm in self._vms.values():
+                if vm.name() in vm_names or not vm.running():
+                    continue
+                for net in vm.nets():
+                    unused_nets.discard(net)
         nets = [self._nets[net] for net in unused_nets]
 
         return nets
 
+    @contextlib.contextmanager
+    def state_snapshot(self):
+        """
+        Get the states of all the VMs and networks at once, and answer the
+        state queries of the libvirt VMs and networks (state, running and
+        alive) from it for the duration of the context. VMs and networks
+        that are stopped in the context are removed from the snapshot.
+
+        The snapshot is kept in ``current_state_snapshot`` for the duration
+        of the context, and is used only by the VMs and networks of this
+        env. Nested contexts use the snapshot of the outermost one.
+
+        Note:
+            The snapshot is not updated on other state changes, so it
+            should not be used while waiting for them.
+
+        Yields:
+            lago.providers.libvirt.utils.StateSnapshot: The snapshot
+        """
+        with self._state_snapshot_lock:
+            outermost = self.current_state_snapshot is None
+            if outermost:
+                self.current_state_snapshot = libvirt_utils.StateSnapshot(
+                    libvirt_utils.get_shared_connection().con
+                )
+            snapshot = self.current_state_snapshot
+        try:
+            yield snapshot
+        finally:
+            if outermost:
+                with self._state_snapshot_lock:
+                    self.current_state_snapshot = None
+
     def stop(self, vm_names=None):
+        with self.state_snapshot():
+            self._stop(vm_names)
 
+    def _stop(self, vm_names):
         vms, nets, log_msg = self._get_stop_shutdown_common_args(vm_names)
 
         with LogTask(log_msg.format('Stop')):
             with LogTask('Stop vms'):
                 for vm in vms:
                     vm.stop()
+                    vm.discard_ssh_connection()
             with LogTask('Stop nets'):
                 for net in nets:
                     net.stop()
@@ -432,10 +586,46 @@ class VirtEnv(object):
                 with LogTask('Shutdown vms'):
                     for vm in vms:
                         vm.shutdown()
+                        vm.discard_ssh_connection()
                 with LogTask('Stop nets'):
                     for net in nets:
                         net.stop()
 
+    def wait_for_ssh(self, vms=None):
+        """
+        Wait until all the given VMs can be reached with ssh. All the VMs
+        are probed at once for their ssh banner, and only the ones that
+        greeted us go through an authenticated check.
+
+        Args:
+            vms (list of lago.plugins.vm.VMPlugin): VMs to wait for, all
+                the VMs if None
+
+        Raises:
+            lago.ssh.LagoSSHTimeoutException: If some VMs did not start
+                their ssh server in time
+        """
+        if vms is None:
+            vms = list(self._vms.values())
+        if not vms:
+            return
+
+        ready = ssh.wait_for_banners(
+            [vm.ip() for vm in vms],
+            max(vm.boot_time_sec() for vm in vms),
+        )
+        unreachable = [vm.name() for vm in vms if vm.ip() not in ready]
+        if unreachable:
+            raise ssh.LagoSSHTimeoutException(
+                'Timed out waiting for ssh on {}'.format(
+                    ', '.join(sorted(unreachable))
+                )
+            )
+
+        utils.invoke_in_parallel(
+            lambda vm: vm.wait_for_ssh(probe_banner=False), vms
+        )
+
     def get_nets(self):
         return self._nets.copy()
 
@@ -486,6 +676,38 @@ class VirtEnv(object):
     def get_vm(self, name):
         return self._vms[name]
 
+    def select_vms(self, names=None, groups=None, vm_types=None):
+        """
+        Select VMs by name, group or VM type. A VM is selected if it
+        matches any of the given criteria.
+
+        Args:
+            names (list of str): Names of VMs to select
+            groups (list of str): Select the VMs in these groups
+            vm_types (list of str): Select the VMs of these types
+
+        Returns:
+            list of lago.plugins.vm.VMPlugin: The selected VMs, sorted by
+                name, or all the VMs if no criteria was given
+
+        Raises:
+            utils.LagoUserException: If a vm name doesn't exist
+        """
+        if not (names or groups or vm_types):
+            return [vm for _, vm in sorted(self._vms.items())]
+
+        groups = set(groups or [])
+        vm_types = set(vm_types or [])
+        selected = self.get_vms(names) if names else {}
+        for name, vm in self._vms.items():
+            vm_groups = vm.groups
+            if isinstance(vm_groups, six.string_types):
+                vm_groups = [vm_groups]
+            if groups.intersection(vm_groups) or vm.vm_type in vm_types:
+                selected[name] = vm
+
+        return [vm for _, vm in sorted(selected.items())]
+
     @classmethod
     def from_prefix(cls, prefix):
         virt_path = functools.partial(prefix.paths.prefixed, 'virt')
@@ -46,7 +46,7 @@ class SSHVMProvider(vm.VMProviderPlugin):
 
     def running(self, *args, **kwargs):
         try:
-            ssh.get_ssh_client(
+            with self.vm.virt_env.ssh_pool.client(
                 ip_addr=self.vm.ip(),
                 host_name=self.vm.name(),
                 propagate_fail=False,
@@ -54,7 +54,8 @@ class SSHVMProvider(vm.VMProviderPlugin):
                 ssh_key=self.vm.virt_env.prefix.paths.ssh_id_rsa(),
                 username=self.vm._spec.get('ssh-user'),
                 password=self.vm._spec.get('ssh-password'),
-            )
+            ):
+                pass
         except ssh.LagoSSHTimeoutException:
             return False
 
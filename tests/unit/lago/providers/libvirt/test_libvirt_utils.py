@@ -19,6 +19,7 @@
 #
 from __future__ import absolute_import
 
+import mock
 import pytest
 
 import lago.providers.libvirt.utils as libvirt_utils
@@ -34,3 +35,103 @@ class TestDomain(object):
     )
     def test_resolve_status(self, monkeypatch, expected, state):
         assert expected == libvirt_utils.Domain.resolve_state(state)
+
+
+CAPS_XML = '<capabilities><host><cpu><arch>x86_64</arch></cpu></host>' \
+    '</capabilities>'
+
+
+def _connection(alive=True):
+    con = mock.Mock()
+    con.isAlive.return_value = int(alive)
+    con.getCapabilities.return_value = CAPS_XML
+    con.getLibVersion.return_value = 3002000
+    return con
+
+
+@pytest.fixture
+def open_auth():
+    with mock.patch('libvirt.openAuth') as open_auth:
+        open_auth.side_effect = lambda *args: _connection()
+        yield open_auth
+
+
+class TestSharedConnection(object):
+    def test_shared_per_url(self, open_auth):
+        first = libvirt_utils.get_shared_connection('test:///first')
+        second = libvirt_utils.get_shared_connection('test:///second')
+
+        assert libvirt_utils.get_shared_connection('test:///first') is first
+        assert second is not first
+
+    def test_opens_once(self, open_auth):
+        shared = libvirt_utils.SharedConnection('test:///default')
+
+        assert shared.con is shared.con
+        assert open_auth.call_count == 1
+
+    def test_memoizes_host_info(self, open_auth):
+        shared = libvirt_utils.SharedConnection('test:///default')
+
+        assert shared.host_cpu.findtext('arch') == 'x86_64'
+        assert shared.caps is shared.caps
+        assert shared.lib_version == shared.lib_version == 3002000
+        shared.con.getCapabilities.assert_called_once_with()
+        shared.con.getLibVersion.assert_called_once_with()
+
+    def test_reconnects_when_lost(self, open_auth):
+        shared = libvirt_utils.SharedConnection('test:///default')
+        lost = shared.con
+        shared.caps
+        lost.isAlive.return_value = 0
+
+        con = shared.con
+        shared.caps
+
+        assert con is not lost
+        lost.close.assert_called_once_with()
+        con.getCapabilities.assert_called_once_with()
+
+
+def _domain_stats(name, state, reason=1):
+    dom = mock.Mock()
+    dom.name.return_value = name
+    return dom, {'state.state': state, 'state.reason': reason}
+
+
+class TestStateSnapshot(object):
+    @pytest.fixture
+    def con(self):
+        con = _connection()
+        con.getAllDomainStats.return_value = [
+            _domain_stats('vm0', libvirt_utils.libvirt.VIR_DOMAIN_RUNNING),
+            _domain_stats('vm1', libvirt_utils.libvirt.VIR_DOMAIN_SHUTOFF),
+        ]
+        net = mock.Mock()
+        net.name.return_value = 'net0'
+        con.listAllNetworks.return_value = [net]
+        return con
+
+    def test_snapshot(self, con):
+        snapshot = libvirt_utils.StateSnapshot(con)
+
+        assert snapshot.domains == {
+            'vm0': [libvirt_utils.libvirt.VIR_DOMAIN_RUNNING, 1],
+            'vm1': [libvirt_utils.libvirt.VIR_DOMAIN_SHUTOFF, 1],
+        }
+        assert snapshot.networks == set(['net0'])
+        con.getAllDomainStats.assert_called_once_with(
+            libvirt_utils.libvirt.VIR_DOMAIN_STATS_STATE
+        )
+        con.listAllNetworks.assert_called_once_with(
+            libvirt_utils.ACTIVE_NETWORKS_FLAGS
+        )
+
+    def test_remove(self, con):
+        snapshot = libvirt_utils.StateSnapshot(con)
+        snapshot.remove_domain('vm0')
+        snapshot.remove_network('net0')
+        snapshot.remove_domain('missing')
+
+        assert list(snapshot.domains) == ['vm1']
+        assert snapshot.networks == set()
@@ -0,0 +1,83 @@
+import hashlib
+import os
+
+import pytest
+
+from lago import chunk_store
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(chunk_store, 'BLOCK_SIZE', 4096)
+
+
+@pytest.fixture
+def shared_data():
+    return os.urandom(4096 * 4)
+
+
+def _write_images(tmpdir, *images):
+    export_dir = tmpdir.mkdir('export')
+    manifests = []
+    for idx, data in enumerate(images):
+        image = tmpdir.join('image%d' % idx)
+        image.write_binary(data)
+        manifest = export_dir.join('image%d.manifest' % idx)
+        sha = chunk_store.write_image(str(image), str(manifest), 'raw')
+        assert sha == hashlib.sha1(data).hexdigest()
+        manifests.append(manifest)
+    return export_dir, manifests
+
+
+def _stored_chunks(export_dir):
+    return [
+        name
+        for _, _, names in
+        os.walk(str(export_dir.join(chunk_store.CHUNKS_DIR))) for name in names
+    ]
+
+
+@pytest.mark.usefixtures('small_blocks')
+class TestChunkStore(object):
+    def test_shared_blocks_are_stored_once(self, tmpdir, shared_data):
+        first = shared_data + os.urandom(4096)
+        second = shared_data + os.urandom(4096)
+        export_dir, _ = _write_images(tmpdir, first, second)
+
+        assert len(_stored_chunks(export_dir)) == 4 + 2
+
+    def test_zero_blocks_are_not_stored(self, tmpdir, shared_data):
+        data = b'\0' * 4096 * 3 + shared_data
+        export_dir, (manifest, ) = _write_images(tmpdir, data)
+
+        assert len(_stored_chunks(export_dir)) == 4
+        assert chunk_store.read_manifest(str(manifest))['chunks'][:3] == \
+            [None] * 3
+
+    def test_rebuild(self, tmpdir, shared_data):
+        data = shared_data + b'\0' * 4096 * 8 + b'tail'
+        _, (manifest, ) = _write_images(tmpdir, data)
+        dest = tmpdir.join('rebuilt')
+
+        assert chunk_store.rebuild_image(str(manifest), str(dest)) == 'raw'
+        assert dest.read_binary() == data
+        # the zeros are left as holes
+        assert os.stat(str(dest)).st_blocks * 512 < len(data)
+
+    def test_corrupted_chunk(self, tmpdir, shared_data):
+        export_dir, (manifest, ) = _write_images(tmpdir, shared_data)
+        digest = chunk_store.read_manifest(str(manifest))['chunks'][0]
+        export_dir.join(chunk_store.CHUNKS_DIR, digest[:2],
+                        digest).write_binary(b'garbage')
+        dest = tmpdir.join('rebuilt')
+
+        with pytest.raises(chunk_store.ChunkStoreError):
+            chunk_store.rebuild_image(str(manifest), str(dest))
+        assert not dest.check()
+
+    def test_unsupported_manifest(self, tmpdir):
+        manifest = tmpdir.join('image.manifest')
+        manifest.write('{"version": 100}')
+
+        with pytest.raises(chunk_store.ChunkStoreError):
+            chunk_store.read_manifest(str(manifest))
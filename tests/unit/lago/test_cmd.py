@@ -0,0 +1,67 @@
+from __future__ import absolute_import
+
+import mock
+import pytest
+
+from lago import cmd, utils
+
+
+@pytest.fixture
+def fake_prefix():
+    fake = mock.Mock()
+    fake.exec_on_vms.return_value = [
+        ('vm0', utils.CommandStatus(0, b'line0\nline1\n', b'')),
+        ('vm1', utils.CommandStatus(0, b'', b'warning\n')),
+    ]
+    return fake
+
+
+class TestFanOutShell(object):
+    def _run(self, fake_prefix, selector, args):
+        with pytest.raises(SystemExit) as excinfo:
+            cmd._fan_out_shell(fake_prefix, selector, args)
+        return excinfo.value.code
+
+    def test_output_and_success(self, fake_prefix, capsys):
+        assert self._run(fake_prefix, '--all', ['-c', 'true']) == 0
+
+        out, err = capsys.readouterr()
+        assert out == 'vm0: line0\nvm0: line1\n'
+        assert err == 'vm1: warning\n'
+        fake_prefix.exec_on_vms.assert_called_once_with(
+            command=['true'],
+            script=None,
+            names=[],
+            groups=[],
+            vm_types=[],
+        )
+
+    @pytest.mark.parametrize('code', [1, -1])
+    def test_failure(self, fake_prefix, code):
+        fake_prefix.exec_on_vms.return_value.append(
+            ('vm2', utils.CommandStatus(code, b'', b'failed'))
+        )
+
+        assert self._run(fake_prefix, '--all', ['true']) == 1
+
+    def test_selectors(self, fake_prefix, tmpdir):
+        script = tmpdir.join('script.sh')
+        script.write('true')
+
+        self._run(
+            fake_prefix,
+            'vm0,group:hosts,vm-type:ovirt-host,vm1',
+            [str(script)],
+        )
+
+        fake_prefix.exec_on_vms.assert_called_once_with(
+            command=None,
+            script=str(script),
+            names=['vm0', 'vm1'],
+            groups=['hosts'],
+            vm_types=['ovirt-host'],
+        )
+
+    def test_no_command(self, fake_prefix):
+        with pytest.raises(utils.LagoUserException):
+            cmd._fan_out_shell(fake_prefix, '--all', [])
@@ -0,0 +1,67 @@
+import pytest
+
+from lago import compression, utils
+
+
+@pytest.fixture
+def data():
+    return b'some data to compress ' * 100000
+
+
+@pytest.mark.parametrize('name', ['xz', 'zstd', 'gzip'])
+class TestCodecs(object):
+    def test_compress_and_decompress(self, tmpdir, data, name):
+        codec = compression.get_codec(name)
+        src = tmpdir.join('data')
+        src.write_binary(data)
+        compressed = tmpdir.join('data' + codec.extension)
+
+        codec.compress(str(src), str(compressed), threads=2, block_size=65536)
+        assert compression.get_codec_by_extension(str(compressed)) is codec
+        assert compression.sniff_codec(
+            compressed.read_binary()[:compression.MAGIC_SIZE]
+        ) is codec
+
+        codec.decompress(str(compressed), str(tmpdir.join('out')))
+        assert tmpdir.join('out').read_binary() == data
+
+    def test_streaming_decompression(self, tmpdir, data, name):
+        codec = compression.get_codec(name)
+        src = tmpdir.join('data')
+        src.write_binary(data)
+        utils.hash_and_compress(
+            str(src),
+            compress_to=str(tmpdir.join('compressed')),
+            compress_cmd=codec.compress_cmd(),
+        )
+        compressed = tmpdir.join('compressed').read_binary()
+
+        out = []
+        decompressor = codec.decompressor(out.append)
+        for idx in range(0, len(compressed), 1000):
+            decompressor.write(compressed[idx:idx + 1000])
+        decompressor.close()
+
+        assert b''.join(out) == data
+        assert max(len(chunk) for chunk in out) <= compression.CHUNK_SIZE
+
+    def test_corrupted_stream_fails(self, data, name):
+        codec = compression.get_codec(name)
+        decompressor = codec.decompressor(lambda chunk: None)
+        with pytest.raises(Exception):
+            decompressor.write(codec.magic + b'garbage' * 1000)
+            decompressor.close()
+        decompressor.abort()
+
+
+def test_default_codec_from_config():
+    assert compression.get_codec().name == 'xz'
+
+
+def test_unknown_codec():
+    with pytest.raises(utils.LagoUserException):
+        compression.get_codec('rar')
+
+
+def test_unknown_extension():
+    assert compression.get_codec_by_extension('disk.qcow2') is None
@@ -0,0 +1,400 @@
+import json
+import os
+import threading
+import time
+
+import mock
+import pytest
+
+from lago import export, utils
+
+
+class ConcurrencyCounter(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def __call__(self, *args, **kwargs):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+        time.sleep(0.05)
+        with self._lock:
+            self.current -= 1
+
+
+class TestExportScheduler(object):
+    @pytest.mark.parametrize('workers', [1, 3])
+    def test_io_stages_are_bounded(self, workers):
+        scheduler = export.ExportScheduler(io_workers=workers, cpu_workers=1)
+        counter = ConcurrencyCounter()
+
+        def _stage():
+            with scheduler.io_stage():
+                counter()
+
+        utils.invoke_different_funcs_in_parallel(*[_stage] * 8)
+
+        assert counter.peak == workers
+
+    def test_budgets_are_separate(self):
+        scheduler = export.ExportScheduler(io_workers=1, cpu_workers=1)
+        with scheduler.cpu_stage():
+            # would block if the stages shared a budget
+            with scheduler.io_stage():
+                pass
+
+    def test_compress_threads_share_the_cores(self):
+        with mock.patch('os.cpu_count', return_value=8):
+            scheduler = export.ExportScheduler(io_workers=1, cpu_workers=2)
+            assert scheduler.compress_threads == 4
+            scheduler = export.ExportScheduler(io_workers=1, cpu_workers=16)
+            assert scheduler.compress_threads == 1
+
+    def test_defaults_from_config(self):
+        with mock.patch.object(
+            export.config,
+            'get',
+            side_effect={
+                'export_io_workers': '3',
+                'export_cpu_workers': '5',
+            }.get,
+        ):
+            scheduler = export.ExportScheduler()
+
+        assert scheduler.io_workers == 3
+        assert scheduler.cpu_workers == 5
+
+
+@pytest.fixture
+def file_disks(tmpdir):
+    disks = []
+    for idx in range(6):
+        disk = tmpdir.join('disk{}'.format(idx))
+        disk.write('data')
+        disks.append(
+            {
+                'path': str(disk),
+                'type': 'file',
+                'format': 'iso',
+                'metadata': {},
+            }
+        )
+    return disks
+
+
+class TestVMExportManager(object):
+    def test_disks_share_the_scheduler(self, tmpdir, file_disks):
+        scheduler = export.ExportScheduler(io_workers=2, cpu_workers=1)
+        copies = ConcurrencyCounter()
+        compressions = ConcurrencyCounter()
+        dst = tmpdir.mkdir('dst')
+
+        def _copy(src, dst):
+            copies()
+            with open(dst, 'w') as f:
+                f.write('data')
+
+        def _compress(path, checksum, compress_to, **kwargs):
+            compressions()
+            open(compress_to, 'w').close()
+            return 'sha'
+
+        hash_and_compress = mock.patch.object(
+            export.utils,
+            'hash_and_compress',
+            side_effect=_compress,
+        )
+        with mock.patch.object(export.utils, 'cp', side_effect=_copy), \
+                hash_and_compress:
+            # two VMs exported at once
+            utils.invoke_different_funcs_in_parallel(
+                *[
+                    export.VMExportManager(
+                        disks, str(dst), True, scheduler=scheduler
+                    ).export for disks in (file_disks[:3], file_disks[3:])
+                ]
+            )
+
+        assert copies.peak == 2
+        assert compressions.peak == 1
+        assert sorted(path.basename for path in dst.listdir()) == sorted(
+            [
+                'disk{}{}'.format(idx, suffix)
+                for idx in range(6)
+                for suffix in ('.hash', '.metadata', '.xz')
+            ]
+        )
+
+
+class TestChunkedExport(object):
+    def test_export_and_rebuild(self, tmpdir, file_disks, monkeypatch):
+        monkeypatch.setattr(export.chunk_store, 'BLOCK_SIZE', 4096)
+        shared = os.urandom(4096 * 8)
+        for disk in file_disks[:2]:
+            with open(disk['path'], 'wb') as disk_fd:
+                disk_fd.write(shared + os.urandom(4096))
+        dst = tmpdir.mkdir('dst')
+
+        manifests = export.VMExportManager(
+            file_disks[:2], str(dst), False, chunked=True
+        ).export()
+
+        assert manifests == [
+            str(dst.join('disk0.manifest')),
+            str(dst.join('disk1.manifest')),
+        ]
+        chunks = [
+            name
+            for _, _, names in os.walk(str(dst.join('chunks')))
+            for name in names
+        ]
+        assert len(chunks) == 8 + 2
+        for disk, manifest in zip(file_disks, manifests):
+            rebuilt = tmpdir.join('rebuilt')
+            export.chunk_store.rebuild_image(manifest, str(rebuilt))
+            with open(disk['path'], 'rb') as disk_fd:
+                assert rebuilt.read_binary() == disk_fd.read()
+            assert dst.join(os.path.basename(disk['path']) + '.hash'
+                            ).read() == utils.get_hash(disk['path'])
+
+
+@pytest.fixture
+def commands():
+    """
+    Records the commands the export runs, copies run for real and
+    conversions copy the source, the rest do nothing
+    """
+    commands = []
+    run = utils.run_command_with_validation
+
+    def _run(cmd, *args, **kwargs):
+        commands.append(cmd)
+        if cmd[0] == 'cp':
+            return run(cmd, *args, **kwargs)
+        if cmd[:2] == ['qemu-img', 'convert']:
+            return run(['cp'] + cmd[-2:], *args, **kwargs)
+
+    with mock.patch.object(
+        export.utils,
+        'run_command_with_validation',
+        side_effect=_run,
+    ):
+        yield commands
+
+
+def _disk(tmpdir, disk_type, disk_format):
+    disk = tmpdir.join('disk0')
+    disk.write('data')
+    return {
+        'path': str(disk),
+        'type': disk_type,
+        'format': disk_format,
+        'metadata': {},
+    }
+
+
+def _export(dst, disk, do_compress=False, **kwargs):
+    return export.DiskExportManager.get_instance_by_type(
+        str(dst), disk, do_compress, **kwargs
+    ).export()
+
+
+class TestTemplateExport(object):
+    @pytest.fixture
+    def template_disk(self, tmpdir):
+        disk = _disk(tmpdir, 'template', 'qcow2')
+        chain = [
+            {
+                'filename': disk['path'],
+                'backing-filename': '/var/lib/lago/store/repo:el7:v1',
+                'format': 'qcow2'
+            },
+            {
+                'filename': '/var/lib/lago/store/repo:el7:v1',
+                'format': 'qcow2'
+            },
+        ]
+        with mock.patch.object(
+            export.utils, 'get_qemu_info', return_value=chain
+        ):
+            yield disk
+
+    def test_standalone(self, tmpdir, template_disk, commands):
+        dst = tmpdir.mkdir('dst')
+
+        _export(dst, template_disk, standalone=True)
+
+        exported = str(dst.join('disk0'))
+        # the layers are merged by the conversion, nothing to rebase
+        assert commands == [
+            [
+                'qemu-img', 'convert', '-f', 'qcow2', '-O', 'qcow2',
+                template_disk['path'], exported
+            ],
+            [
+                'virt-sparsify', '-q', '-v', '--format', 'qcow2', '--in-place',
+                exported
+            ],
+        ]
+        metadata = json.loads(dst.join('disk0.metadata').read())
+        assert metadata['base'] == 'None'
+
+    def test_layered(self, tmpdir, template_disk, commands):
+        dst = tmpdir.mkdir('dst')
+
+        _export(dst, template_disk, standalone=False)
+
+        exported = str(dst.join('disk0'))
+        assert commands == [
+            ['cp', template_disk['path'], exported],
+            [
+                'virt-sparsify', '-q', '-v', '--format', 'qcow2', '--in-place',
+                exported
+            ],
+            ['qemu-img', 'rebase', '-u', '-b', './el7:v1', exported],
+        ]
+        metadata = json.loads(dst.join('disk0.metadata').read())
+        assert metadata['base'] == 'disk0'
+
+    def test_too_many_layers(self, tmpdir, template_disk, commands):
+        chain = export.utils.get_qemu_info.return_value
+        chain.append({'filename': 'base', 'format': 'qcow2'})
+
+        with pytest.raises(utils.LagoUserException):
+            export.DiskExportManager.get_instance_by_type(
+                str(tmpdir), template_disk, False, standalone=False
+            )
+        assert commands == []
+
+
+class TestFileExport(object):
+    def test_iso(self, tmpdir, commands):
+        disk = _disk(tmpdir, 'file', 'iso')
+        dst = tmpdir.mkdir('dst')
+
+        _export(dst, disk)
+
+        # qemu-img can't write isos, and they are not sparsified
+        assert commands == [['cp', disk['path'], str(dst.join('disk0'))]]
+        assert dst.join('disk0').read() == 'data'
+
+    def test_failed_export_removes_exported_files(self, tmpdir, commands):
+        disk = _disk(tmpdir, 'file', 'raw')
+        dst = tmpdir.mkdir('dst')
+
+        def _compress(path, checksum, compress_to, **kwargs):
+            open(compress_to, 'w').close()
+            return 'sha'
+
+        hash_and_compress = mock.patch.object(
+            export.utils,
+            'hash_and_compress',
+            side_effect=_compress,
+        )
+        failing_dump = mock.patch.object(
+            export.json,
+            'dump',
+            side_effect=IOError('disk full'),
+        )
+        with hash_and_compress, failing_dump:
+            with pytest.raises(IOError):
+                _export(dst, disk, do_compress=True)
+
+        assert dst.listdir() == []
+
+
+@pytest.fixture
+def snapshot_disk(tmpdir):
+    # Two snapshots were taken, the first one froze disk0, the second one
+    # froze the layer that was added by the first
+    base = tmpdir.join('disk0')
+    layer = tmpdir.join('disk0.1700000000')
+    active = tmpdir.join('disk0.1700000100')
+    for image in (base, layer, active, tmpdir.join('template')):
+        image.write('data')
+    chain = [
+        {
+            'filename': str(active),
+            'format': 'qcow2'
+        },
+        {
+            'filename': str(layer),
+            'format': 'qcow2'
+        },
+        {
+            'filename': str(base),
+            'format': 'qcow2'
+        },
+        {
+            'filename': str(tmpdir.join('template')),
+            'format': 'raw'
+        },
+    ]
+    disk = {
+        'path': str(active),
+        'type': 'template',
+        'format': 'qcow2',
+        'metadata': {
+            'distro': 'el7'
+        },
+        'snapshot-base': str(base),
+    }
+    with mock.patch.object(export.utils, 'get_qemu_info', return_value=chain):
+        yield disk
+
+
+class TestDeltaExport(object):
+    def test_export(self, tmpdir, snapshot_disk):
+        dst = tmpdir.mkdir('dst')
+        delta = dst.join('disk0.1700000100')
+        commands = []
+        run = utils.run_command_with_validation
+
+        def _run(cmd, *args, **kwargs):
+            commands.append(cmd)
+            if cmd[0] == 'cp':
+                return run(cmd, *args, **kwargs)
+
+        with mock.patch.object(
+            export.utils,
+            'run_command_with_validation',
+            side_effect=_run,
+        ):
+            exported = export.VMExportManager(
+                [snapshot_disk], str(dst), False, since='snap'
+            ).export()
+
+        assert exported == [str(delta)]
+        assert commands == [
+            ['cp', snapshot_disk['path'],
+             str(delta)],
+            [
+                'qemu-img', 'rebase', '-F', 'qcow2', '-u', '-b',
+                str(tmpdir.join('disk0.1700000000')),
+                str(delta)
+            ],
+            # a safe rebase, that keeps the changes of the middle layer
+            [
+                'qemu-img', 'rebase', '-F', 'qcow2', '-b',
+                str(tmpdir.join('disk0')),
+                str(delta)
+            ],
+            [
+                'qemu-img', 'rebase', '-F', 'qcow2', '-u', '-b', './disk0',
+                str(delta)
+            ],
+        ]
+        metadata = json.loads(dst.join('disk0.1700000100.metadata').read())
+        assert metadata['base'] == 'disk0'
+        assert metadata['since'] == 'snap'
+        assert metadata['distro'] == 'el7'
+
+    def test_disk_not_from_snapshot(self, tmpdir, snapshot_disk):
+        snapshot_disk['snapshot-base'] = str(tmpdir.join('other'))
+
+        with pytest.raises(utils.LagoUserException):
+            export.DiskExportManager.get_instance_by_type(
+                str(tmpdir), snapshot_disk, False, since='snap'
+            )
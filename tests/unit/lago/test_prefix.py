@@ -21,10 +21,11 @@ from __future__ import absolute_import
 
 import os
 
+import mock
 import pytest
 
 import lago
-from lago import prefix
+from lago import chunk_store, prefix, utils
 from lago.utils import LagoInitException
 
 
@@ -267,3 +268,93 @@ class TestPrefixNetworkInitalization(object):
         with pytest.raises(LagoInitException, match=err_msg) as exc_info:
             empty_prefix._validate_netconfig(conf)
         exc_info.match(err_msg)
+
+
+class TestChunkedDisks(object):
+    def test_file_disk_from_manifest(self, tmpdir, empty_prefix, monkeypatch):
+        image = tmpdir.join('disk0.iso')
+        image.write_binary(os.urandom(4096) * 3)
+        export_dir = tmpdir.mkdir('export')
+        manifest = export_dir.join('disk0.iso.manifest')
+        chunk_store.write_image(str(image), str(manifest), 'raw')
+        images_dir = tmpdir.mkdir('images')
+        monkeypatch.setattr(
+            empty_prefix,
+            '_generate_disk_path', lambda name: str(images_dir.join(name))
+        )
+
+        disk_path, _ = empty_prefix._handle_file_disk({'path': str(manifest)})
+
+        assert disk_path == str(images_dir.join('disk0.iso'))
+        assert images_dir.join('disk0.iso').read_binary() == \
+            image.read_binary()
+
+
+class TestExecOnVMs(object):
+    @pytest.fixture
+    def vms(self):
+        vms = []
+        for name, result in (
+            ('vm0', utils.CommandStatus(0, b'out0', b'')),
+            ('vm1', utils.CommandStatus(2, b'', b'err1')),
+            ('vm2', RuntimeError('no ssh')),
+        ):
+            vm = mock.Mock()
+            vm.name.return_value = name
+            vm.ssh.side_effect = [result]
+            vm.ssh_script.side_effect = [result]
+            vms.append(vm)
+        return vms
+
+    @pytest.fixture
+    def env_prefix(self, empty_prefix, vms):
+        empty_prefix._virt_env = mock.Mock()
+        empty_prefix._virt_env.select_vms.return_value = vms
+        return empty_prefix
+
+    def test_results(self, env_prefix, vms):
+        results = dict(
+            env_prefix.exec_on_vms(
+                command=['true'], groups=['all'], max_workers=2, timeout=3
+            )
+        )
+
+        assert results == {
+            'vm0': (0, b'out0', b''),
+            'vm1': (2, b'', b'err1'),
+            'vm2': (-1, b'', b'no ssh'),
+        }
+        env_prefix.virt_env.select_vms.assert_called_once_with(
+            None, ['all'], None
+        )
+        for vm in vms:
+            vm.ssh.assert_called_once_with(
+                ['true'], show_output=False, timeout=3
+            )
+
+    def test_script(self, env_prefix, vms):
+        results = dict(
+            env_prefix.exec_on_vms(script='/script.sh', names=['vm0'])
+        )
+
+        assert sorted(results) == ['vm0', 'vm1', 'vm2']
+        for vm in vms:
+            vm.ssh_script.assert_called_once_with(
+                '/script.sh', show_output=False, timeout=None
+            )
+            assert not vm.ssh.called
+
+    @pytest.mark.parametrize(
+        'kwargs', [{}, {
+            'command': ['true'],
+            'script': '/script.sh'
+        }]
+    )
+    def test_command_or_script(self, env_prefix, kwargs):
+        with pytest.raises(utils.LagoUserException):
+            list(env_prefix.exec_on_vms(**kwargs))
+
+    def test_no_vms(self, env_prefix):
+        env_prefix.virt_env.select_vms.return_value = []
+
+        assert list(env_prefix.exec_on_vms(command=['true'])) == []
@@ -0,0 +1,374 @@
+import io
+import os
+import socket
+import threading
+import time
+
+import mock
+import paramiko
+import pytest
+
+from lago import ssh
+
+
+def _client(active=True):
+    client = mock.Mock(spec=paramiko.SSHClient)
+    client.get_transport.return_value.is_active.return_value = active
+    return client
+
+
+@pytest.fixture
+def get_ssh_client():
+    with mock.patch('lago.ssh.get_ssh_client') as get_client:
+        get_client.side_effect = lambda **kwargs: _client()
+        yield get_client
+
+
+class TestSSHConnectionPool(object):
+    def test_reuses_connection(self, get_ssh_client):
+        pool = ssh.SSHConnectionPool()
+        with pool.client(ip_addr='1.1.1.1') as first:
+            pass
+        with pool.client(ip_addr='1.1.1.1') as second:
+            pass
+
+        assert first is second
+        assert get_ssh_client.call_count == 1
+
+    def test_keyed_by_ip_user_and_key(self, get_ssh_client):
+        pool = ssh.SSHConnectionPool()
+        clients = set()
+        for kwargs in (
+            {},
+            {
+                'username': 'user'
+            },
+            {
+                'ssh_key': ['id_rsa']
+            },
+            {
+                'ip_addr': '2.2.2.2'
+            },
+        ):
+            kwargs.setdefault('ip_addr', '1.1.1.1')
+            with pool.client(**kwargs) as client:
+                clients.add(client)
+
+        assert len(clients) == 4
+
+    def test_replaces_dead_connection(self, get_ssh_client):
+        pool = ssh.SSHConnectionPool()
+        with pool.client(ip_addr='1.1.1.1') as first:
+            first.get_transport.return_value.is_active.return_value = False
+        with pool.client(ip_addr='1.1.1.1') as second:
+            pass
+
+        assert first is not second
+        first.close.assert_called_once_with()
+
+    def test_idle_connections_are_closed(self, get_ssh_client):
+        pool = ssh.SSHConnectionPool(idle_timeout=0)
+        with pool.client(ip_addr='1.1.1.1') as first:
+            # in use, so it is not idle
+            with pool.client(ip_addr='1.1.1.1') as second:
+                assert first is second
+        with pool.client(ip_addr='1.1.1.1') as third:
+            pass
+
+        assert third is not first
+        first.close.assert_called_once_with()
+
+    def test_session_reconnects_once(self, get_ssh_client):
+        broken = _client()
+        broken.get_transport.return_value.open_session.side_effect = EOFError
+        working = _client()
+        get_ssh_client.side_effect = [broken, working]
+
+        pool = ssh.SSHConnectionPool()
+        with pool.session(ip_addr='1.1.1.1') as channel:
+            assert channel is \
+                working.get_transport.return_value.open_session.return_value
+
+        channel.close.assert_called_once_with()
+        broken.close.assert_called_once_with()
+        working.close.assert_not_called()
+
+    def test_concurrent_users_share_one_handshake(self, get_ssh_client):
+        pool = ssh.SSHConnectionPool()
+        clients = []
+
+        def _use():
+            with pool.client(ip_addr='1.1.1.1') as client:
+                clients.append(client)
+
+        threads = [threading.Thread(target=_use) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(set(clients)) == 1
+        assert get_ssh_client.call_count == 1
+
+    def test_close(self, get_ssh_client):
+        pool = ssh.SSHConnectionPool()
+        with pool.client(ip_addr='1.1.1.1') as client:
+            pass
+        pool.close()
+
+        client.close.assert_called_once_with()
+        with pool.client(ip_addr='1.1.1.1') as new_client:
+            assert new_client is not client
+
+
+class FakeChannel(object):
+    """
+    Minimal stand in for paramiko.Channel, which is fed from a thread
+    """
+
+    def __init__(self, exit_status=0):
+        self.exit_status = exit_status
+        self.closed = False
+        self._lock = threading.Lock()
+        self._buffers = {'out': bytearray(), 'err': bytearray()}
+        self._read_fd, self._write_fd = os.pipe()
+
+    def settimeout(self, timeout):
+        pass
+
+    def fileno(self):
+        return self._read_fd
+
+    def feed(self, out=b'', err=b''):
+        with self._lock:
+            self._buffers['out'].extend(out)
+            self._buffers['err'].extend(err)
+        os.write(self._write_fd, b'x')
+
+    def close(self):
+        self.closed = True
+        os.write(self._write_fd, b'x')
+
+    def _recv(self, name, size):
+        with self._lock:
+            buf = self._buffers[name]
+            chunk = bytes(buf[:size])
+            del buf[:size]
+        if not any(self._buffers.values()):
+            try:
+                os.read(self._read_fd, 4096)
+            except OSError:
+                pass
+        return chunk
+
+    def recv_ready(self):
+        return bool(self._buffers['out'])
+
+    def recv_stderr_ready(self):
+        return bool(self._buffers['err'])
+
+    def recv(self, size):
+        return self._recv('out', size)
+
+    def recv_stderr(self, size):
+        return self._recv('err', size)
+
+
+def _feed_in_background(chan, chunks):
+    def _feed():
+        for out, err in chunks:
+            chan.feed(out, err)
+            time.sleep(0.01)
+        chan.close()
+
+    thread = threading.Thread(target=_feed)
+    thread.start()
+    return thread
+
+
+class TestDrainSSHChannel(object):
+    def test_collects_output_and_errors(self):
+        chan = FakeChannel(exit_status=3)
+        thread = _feed_in_background(
+            chan, [(b'out1', b'err1'), (b'out2', b''), (b'', b'err2')]
+        )
+        result = ssh.drain_ssh_channel(chan, stdout=None, stderr=None)
+        thread.join()
+
+        assert result == (3, b'out1out2', b'err1err2')
+
+    def test_reads_data_buffered_before_close(self):
+        chan = FakeChannel()
+        chan.feed(b'a' * (ssh.DRAIN_CHUNK_SIZE * 3 + 5), b'e')
+        chan.close()
+
+        _, out, err = ssh.drain_ssh_channel(chan, stdout=None, stderr=None)
+
+        assert len(out) == ssh.DRAIN_CHUNK_SIZE * 3 + 5
+        assert err == b'e'
+
+    def test_streams_to_sinks_without_keeping_output(self):
+        chan = FakeChannel()
+        chunks = [(os.urandom(1000), b'') for _ in range(20)]
+        thread = _feed_in_background(chan, chunks + [(b'', b'oops')])
+        out_file = io.BytesIO()
+        errors = []
+
+        result = ssh.drain_ssh_channel(
+            chan,
+            stdout=out_file,
+            stderr=errors.append,
+            keep_output=False,
+        )
+        thread.join()
+
+        assert result == (0, b'', b'')
+        assert out_file.getvalue() == b''.join(out for out, _ in chunks)
+        assert errors == [b'oops']
+
+    def test_text_streams_get_decoded_output(self):
+        chan = FakeChannel()
+        data = u'\u05e9\u05dc\u05d5\u05dd'.encode('utf-8')
+        # split a multi byte character between the chunks
+        thread = _feed_in_background(
+            chan, [(data[:3], data[:3]), (data[3:], data[3:])]
+        )
+        out, err = io.StringIO(), io.StringIO()
+
+        ssh.drain_ssh_channel(chan, stdout=out, stderr=err)
+        thread.join()
+
+        assert out.getvalue() == data.decode('utf-8')
+        assert err.getvalue() == data.decode('utf-8')
+
+    def test_timeout(self):
+        chan = FakeChannel()
+        chan.feed(b'partial')
+        start = time.time()
+
+        with pytest.raises(ssh.LagoSSHTimeoutException):
+            ssh.drain_ssh_channel(chan, stdout=None, stderr=None, timeout=0.2)
+
+        assert time.time() - start < 1
+
+
+class TestSSH(object):
+    def _ssh(self, chan, **kwargs):
+        chan.exec_command = mock.Mock()
+        chan.sendall = mock.Mock()
+        chan.shutdown_write = mock.Mock()
+        session = mock.patch('lago.ssh._session')
+        with session as _session:
+            _session.return_value.__enter__.return_value = chan
+            return ssh.ssh('1.1.1.1', ['false'], **kwargs)
+
+    def test_stdout_only_keeps_errors(self):
+        chan = FakeChannel(exit_status=1)
+        thread = _feed_in_background(chan, [(b'out', b''), (b'', b'oops')])
+        out_file = io.BytesIO()
+
+        result = self._ssh(chan, stdout=out_file)
+        thread.join()
+
+        assert result == (1, b'', b'oops')
+        assert out_file.getvalue() == b'out'
+
+    def test_stderr_only_keeps_output(self):
+        chan = FakeChannel()
+        thread = _feed_in_background(chan, [(b'out', b'err')])
+        errors = []
+
+        result = self._ssh(chan, stderr=errors.append)
+        thread.join()
+
+        assert result == (0, b'out', b'')
+        assert errors == [b'err']
+
+
+class BannerServer(object):
+    def __init__(self, addr='127.0.0.1', port=0, banner=b'SSH-2.0-test\r\n'):
+        self.banner = banner
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((addr, port))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            if self.banner is not None:
+                conn.sendall(self.banner)
+            conn.close()
+
+    def close(self):
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+
+
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestWaitForBanners(object):
+    def test_all_hosts_at_once(self):
+        port = _free_port()
+        servers = [
+            BannerServer(addr='127.0.0.%d' % i, port=port) for i in (1, 2, 3)
+        ]
+        try:
+            start = time.time()
+            ready = ssh.wait_for_banners(
+                ['127.0.0.1', '127.0.0.2', '127.0.0.3'], timeout=10, port=port
+            )
+            assert time.time() - start < 2
+        finally:
+            for server in servers:
+                server.close()
+
+        assert ready == set(['127.0.0.1', '127.0.0.2', '127.0.0.3'])
+
+    def test_server_that_comes_up_later(self):
+        port = _free_port()
+        servers = []
+        timer = threading.Timer(
+            0.5, lambda: servers.append(BannerServer(port=port))
+        )
+        timer.start()
+        try:
+            ready = ssh.wait_for_banners(['127.0.0.1'], timeout=10, port=port)
+        finally:
+            timer.join()
+            for server in servers:
+                server.close()
+
+        assert ready == set(['127.0.0.1'])
+
+    def test_times_out(self):
+        port = _free_port()
+        start = time.time()
+        ready = ssh.wait_for_banners(['127.0.0.1'], timeout=1, port=port)
+
+        assert ready == set()
+        assert 1 <= time.time() - start < 3
+
+    def test_no_banner_is_not_ready(self):
+        server = BannerServer(banner=b'HTTP/1.1 400 Bad Request\r\n')
+        try:
+            ready = ssh.wait_for_banners(
+                ['127.0.0.1'], timeout=1, port=server.port
+            )
+        finally:
+            server.close()
+
+        assert ready == set()
@@ -166,6 +166,61 @@ class TestSubnetStore(object):
         assert len(subnet_store.list_leases()) == remains
         assert len(get_leases()) == remains
 
+    def test_acquire_many(self, subnet_store, prefix):
+        networks = subnet_store.acquire_many(
+            prefix.uuid_path,
+            count=3,
+            requested=['192.168.210.0', '192.168.200.1'],
+        )
+
+        third_octets = [str(network).split('.')[2] for network in networks]
+        assert third_octets == ['210', '200', '201', '202', '203']
+        assert all(
+            lease_has_valid_uuid(
+                os.path.join(subnet_store.path, '{}.lease'.format(octet))
+            ) for octet in third_octets
+        )
+
+    def test_acquire_many_skips_taken_and_stale_leases(
+        self, subnet_store, prefixes
+    ):
+        stale = subnet_store.acquire(prefixes[1].uuid_path)
+        prefixes[1].remove()
+        taken = subnet_store.acquire_many(prefixes[0].uuid_path, count=2)
+        networks = subnet_store.acquire_many(
+            PrefixMock(prefixes[1].path).uuid_path, count=3
+        )
+
+        assert stale in taken
+        assert not set(taken) & set(networks)
+        assert len(subnet_store.list_leases()) == 5
+
+    def test_acquire_many_is_atomic(self, subnet_store, prefixes):
+        taken = subnet_store.acquire(prefixes[0].uuid_path)
+        with pytest.raises(LagoSubnetLeaseTakenException):
+            subnet_store.acquire_many(
+                prefixes[1].uuid_path, count=2, requested=[str(taken)]
+            )
+        assert len(subnet_store.list_leases()) == 1
+
+        available = \
+            subnet_store._max_third_octet - subnet_store._min_third_octet
+        with pytest.raises(LagoSubnetLeaseStoreFullException):
+            subnet_store.acquire_many(
+                prefixes[1].uuid_path, count=available + 1
+            )
+        assert len(subnet_store.list_leases()) == 1
+
+    def test_acquire_many_reclaims_own_lease(self, subnet_store, prefix):
+        network = subnet_store.acquire(prefix.uuid_path)
+        networks = subnet_store.acquire_many(
+            prefix.uuid_path, count=1, requested=[str(network)]
+        )
+
+        assert networks[0] == network
+        assert networks[1] != network
+        assert len(subnet_store.list_leases()) == 2
+
     def test_list_leases_raises(self, subnet_store):
         with patch('lago.subnet_lease.os.listdir') as mock_listdir:
             mock_listdir.side_effect = OSError(13, 'mocking orig'),
@@ -183,3 +238,103 @@ class TestSubnetStore(object):
 
             assert str(excinfo.value).startswith(exp_begin)
             assert str(excinfo.value).endswith('mocking orig')
+
+
+class TestSubnetPools(object):
+    @pytest.fixture()
+    def prefix(self, tmpdir):
+        return PrefixMock(str(tmpdir.join('prefix')))
+
+    def make_store(self, tmpdir, pools):
+        return subnet_lease.SubnetStore(
+            str(tmpdir.join('subnet_store')), pools=pools
+        )
+
+    def test_split_supernet(self, tmpdir, prefix):
+        store = self.make_store(tmpdir, '10.64.0.0/12:26')
+        networks = store.acquire_many(prefix.uuid_path, count=3)
+
+        assert [str(network) for network in networks] == [
+            '10.64.0.0/26',
+            '10.64.0.64/26',
+            '10.64.0.128/26',
+        ]
+        assert sorted(os.listdir(store.path)) == [
+            '10.64.0.0_26.lease',
+            '10.64.0.128_26.lease',
+            '10.64.0.64_26.lease',
+            LOCK_NAME,
+        ]
+        assert sorted(lease.subnet for lease in store.list_leases()) == \
+            sorted(str(network) for network in networks)
+
+    def test_fills_gaps_then_next_pool(self, tmpdir, prefix_mock_gen):
+        store = self.make_store(tmpdir, '10.0.0.0/24:26, 10.1.0.0/24:25')
+        gen = prefix_mock_gen()
+        owner = next(gen)
+        store.acquire_many(owner.uuid_path, count=4)
+        store.release(['10.0.0.64/26'])
+
+        networks = store.acquire_many(next(gen).uuid_path, count=3)
+
+        assert [str(network) for network in networks] == [
+            '10.0.0.64/26',
+            '10.1.0.0/25',
+            '10.1.0.128/25',
+        ]
+        with pytest.raises(LagoSubnetLeaseStoreFullException):
+            store.acquire(next(gen).uuid_path)
+
+    @pytest.mark.parametrize(
+        'subnet,expected', [
+            ('10.64.1.64/26', True),
+            ('10.64.1.65', True),
+            ('10.64.1.0/24', False),
+            ('10.80.0.0/26', False),
+        ]
+    )
+    def test_is_leasable_subnet(self, tmpdir, subnet, expected):
+        store = self.make_store(tmpdir, '10.64.0.0/12:26')
+
+        assert store.is_leasable_subnet(subnet) == expected
+
+    def test_legacy_lease_files(self, tmpdir, prefix):
+        store = self.make_store(tmpdir, '192.168.0.0/16:24')
+        network = store.acquire(prefix.uuid_path, '192.168.201.1')
+
+        assert str(network) == '192.168.201.1/24'
+        assert os.path.isfile(os.path.join(store.path, '201.lease'))
+        assert [lease.subnet for lease in store.list_leases()] == \
+            ['192.168.201.0/24']
+
+    def test_mixed_prefix_lengths(self, tmpdir, prefix_mock_gen):
+        gen = prefix_mock_gen()
+        legacy_owner = next(gen)
+        legacy_store = subnet_lease.SubnetStore(
+            str(tmpdir.join('subnet_store'))
+        )
+        legacy_store.acquire(legacy_owner.uuid_path, '192.168.200.0')
+        store = self.make_store(tmpdir, '192.168.200.0/23:26')
+
+        networks = store.acquire_many(next(gen).uuid_path, count=2)
+
+        # the /26 subnets inside the legacy /24 lease are skipped
+        assert [str(network) for network in networks] == [
+            '192.168.201.0/26',
+            '192.168.201.64/26',
+        ]
+        with pytest.raises(LagoSubnetLeaseTakenException):
+            store.acquire(next(gen).uuid_path, '192.168.200.64/26')
+
+        # and the other way around, a /24 that holds a /26 lease is skipped
+        network = self.make_store(tmpdir, '192.168.200.0/22:24').acquire(
+            next(gen).uuid_path
+        )
+        assert str(network) == '192.168.202.0/24'
+
+    @pytest.mark.parametrize(
+        'pools', ['10.64.0.0/12', '10.64.0.0/12:8', 'nonsense:24']
+    )
+    def test_malformed_pools(self, tmpdir, pools):
+        with pytest.raises(subnet_lease.LagoSubnetLeaseException):
+            self.make_store(tmpdir, pools)
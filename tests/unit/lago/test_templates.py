@@ -0,0 +1,768 @@
+from __future__ import absolute_import
+
+import functools
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import threading
+
+import mock
+import py
+import pytest
+from six.moves import BaseHTTPServer, SimpleHTTPServer, socketserver
+
+from lago import compression, templates, utils
+
+
+class QuietHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def log_message(self, *_):
+        pass
+
+
+class ThreadingHTTPServer(
+    socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer
+):
+    daemon_threads = True
+
+
+class RangeHandler(QuietHandler):
+    """
+    Minimal handler that supports single range requests (unless the server
+    ``accept_ranges`` attribute is unset), and that can be told to drop the
+    connection after sending some bytes with the server ``fail_after``
+    attribute (once, only on a response longer than that)
+    """
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path, 'rb') as fd:
+            data = fd.read()
+
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start, end = None, len(data) - 1
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if (
+            self.server.accept_ranges and range_header
+            and if_range in (None, etag)
+        ):
+            start, end = range_header.split('=')[1].split('-')
+            start, end = int(start), int(end or len(data) - 1)
+
+        self.send_response(200 if start is None else 206)
+        if start is not None:
+            self.send_header(
+                'Content-Range',
+                'bytes %d-%d/%d' % (start, end, len(data)),
+            )
+        if self.server.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+
+        data = data[start or 0:end + 1]
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+
+        fail_after = self.server.fail_after
+        if fail_after is not None and fail_after < len(data):
+            data = data[:self.server.fail_after]
+            self.server.fail_after = None
+            self.close_connection = True
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def http_root(tmpdir):
+    root = tmpdir.mkdir('http_root')
+    server = ThreadingHTTPServer(
+        ('127.0.0.1', 0),
+        functools.partial(RangeHandler, directory=str(root)),
+    )
+    server.requests = []
+    server.fail_after = None
+    server.accept_ranges = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    root.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    root.server = server
+    yield root
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def image_data():
+    return os.urandom(4096) * (3 * templates.CHUNK_SIZE // 4096) + \
+        b'\0' * (2 * templates.CHUNK_SIZE) + b'tail'
+
+
+def sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class TestImageStreamWriter(object):
+    def _write(self, dest, data, chunk_size=4096):
+        with templates.ImageStreamWriter(str(dest)) as image:
+            for idx in range(0, len(data), chunk_size):
+                image.write(data[idx:idx + chunk_size])
+        return image.hexdigest()
+
+    def test_plain_data(self, tmpdir, image_data):
+        dest = tmpdir.join('image')
+        assert self._write(dest, image_data) == sha1(image_data)
+        assert dest.read_binary() == image_data
+
+    def test_xz_data_is_decompressed(self, tmpdir, image_data):
+        dest = tmpdir.join('image')
+        compressed = lzma.compress(image_data)
+        assert self._write(dest, compressed) == sha1(image_data)
+        assert dest.read_binary() == image_data
+
+    def test_concatenated_xz_streams(self, tmpdir, image_data):
+        dest = tmpdir.join('image')
+        compressed = lzma.compress(image_data[:100]) + \
+            lzma.compress(image_data[100:])
+        assert self._write(dest, compressed) == sha1(image_data)
+        assert dest.read_binary() == image_data
+
+    def test_zeros_are_not_allocated(self, tmpdir):
+        dest = tmpdir.join('image')
+        data = b'\0' * (8 * templates.CHUNK_SIZE)
+        assert self._write(dest, lzma.compress(data)) == sha1(data)
+        assert dest.size() == len(data)
+        assert os.stat(str(dest)).st_blocks * 512 < len(data)
+
+    def test_short_data(self, tmpdir):
+        dest = tmpdir.join('image')
+        assert self._write(dest, b'abc') == sha1(b'abc')
+        assert dest.read_binary() == b'abc'
+
+    def test_truncated_xz_data_fails(self, tmpdir, image_data):
+        dest = tmpdir.join('image')
+        compressed = lzma.compress(image_data)
+        with pytest.raises(RuntimeError):
+            self._write(dest, compressed[:len(compressed) // 2])
+
+    def test_gzip_data_is_decompressed(self, tmpdir, image_data):
+        dest = tmpdir.join('image')
+        compressed = gzip.compress(image_data[:100]) + \
+            gzip.compress(image_data[100:])
+        assert self._write(dest, compressed) == sha1(image_data)
+        assert dest.read_binary() == image_data
+
+    def test_zstd_data_is_decompressed(self, tmpdir, image_data):
+        src = tmpdir.join('src')
+        src.write_binary(image_data)
+        compression.get_codec('zstd').compress(str(src), str(src) + '.zst')
+        dest = tmpdir.join('image')
+        compressed = tmpdir.join('src.zst').read_binary()
+        assert self._write(dest, compressed) == sha1(image_data)
+        assert dest.read_binary() == image_data
+
+    def test_truncated_zstd_data_fails(self, tmpdir, image_data):
+        src = tmpdir.join('src')
+        src.write_binary(image_data)
+        compression.get_codec('zstd').compress(str(src), str(src) + '.zst')
+        compressed = tmpdir.join('src.zst').read_binary()
+        with pytest.raises(RuntimeError):
+            self._write(
+                tmpdir.join('image'), compressed[:len(compressed) // 2]
+            )
+
+
+class TestFileSystemTemplateProvider(object):
+    def test_download_image(self, tmpdir, image_data):
+        tmpdir.join('image.xz').write_binary(lzma.compress(image_data))
+        provider = templates.FileSystemTemplateProvider(str(tmpdir))
+        dest = tmpdir.join('dest')
+
+        assert provider.download_image('image.xz', str(dest)) == \
+            sha1(image_data)
+        assert dest.read_binary() == image_data
+
+
+class TestHttpTemplateProvider(object):
+    def test_download_prefers_compressed_image(self, http_root, image_data):
+        http_root.join('image.xz').write_binary(lzma.compress(image_data))
+        http_root.join('image').write_binary(b'not this one')
+        provider = templates.HttpTemplateProvider(http_root.url, connections=1)
+        dest = http_root.dirpath().join('dest')
+
+        assert provider.download_image('image', str(dest)) == \
+            sha1(image_data)
+        assert dest.read_binary() == image_data
+
+    def test_download_gzip_image(self, http_root, image_data):
+        http_root.join('image.gz').write_binary(gzip.compress(image_data))
+        provider = templates.HttpTemplateProvider(http_root.url, connections=1)
+        dest = http_root.dirpath().join('dest')
+
+        assert provider.download_image('image', str(dest)) == \
+            sha1(image_data)
+        assert dest.read_binary() == image_data
+
+    def test_known_compression_is_not_probed(self, http_root, image_data):
+        http_root.join('image.gz').write_binary(gzip.compress(image_data))
+        provider = templates.HttpTemplateProvider(http_root.url, connections=1)
+        dest = http_root.dirpath().join('dest')
+
+        assert provider.download_image(
+            'image', str(dest), compression='gzip'
+        ) == sha1(image_data)
+        assert len(http_root.server.requests) == 1
+
+    def test_sidecars_probe_only_xz(self, http_root):
+        http_root.join('image.zst').write_binary(b'image')
+        http_root.join('image.metadata').write('{"distro": "el7"}')
+        http_root.join('image.xz.hash').write('hash')
+        provider = templates.HttpTemplateProvider(http_root.url, connections=1)
+
+        assert provider.get_metadata('image') == {'distro': 'el7'}
+        assert len(http_root.server.requests) == 2
+        assert provider.get_hash('image') == 'hash'
+        assert len(http_root.server.requests) == 3
+
+    def test_extract_image(self, tmpdir, image_data):
+        image = tmpdir.join('image')
+        image.write_binary(gzip.compress(image_data))
+
+        templates.HttpTemplateProvider.extract_image(str(image), 'gzip')
+
+        assert image.read_binary() == image_data
+        assert not tmpdir.join('image.gz').check()
+
+    def test_download_plain_image(self, http_root, image_data):
+        http_root.join('image').write_binary(image_data)
+        provider = templates.HttpTemplateProvider(http_root.url, connections=1)
+        dest = http_root.dirpath().join('dest')
+
+        assert provider.download_image('image', str(dest)) == \
+            sha1(image_data)
+        assert dest.read_binary() == image_data
+
+    def test_download_missing_image(self, http_root):
+        provider = templates.HttpTemplateProvider(http_root.url, connections=1)
+        dest = http_root.dirpath().join('dest')
+
+        with pytest.raises(RuntimeError):
+            provider.download_image('image', str(dest))
+
+    def test_interrupted_download_is_resumed(self, http_root, image_data):
+        compressed = lzma.compress(image_data)
+        http_root.join('image.xz').write_binary(compressed)
+        provider = templates.HttpTemplateProvider(http_root.url, connections=1)
+        dest = http_root.dirpath().join('dest')
+        part = http_root.dirpath().join('dest.part')
+        checkpoint = http_root.dirpath().join('dest.part.checkpoint')
+
+        http_root.server.fail_after = len(compressed) // 2
+        with pytest.raises(Exception):
+            provider.download_image('image', str(dest))
+
+        offset = json.loads(checkpoint.read())['offset']
+        assert offset == part.size() > 0
+
+        del http_root.server.requests[:]
+        assert provider.download_image('image', str(dest)) == \
+            sha1(image_data)
+        assert dest.read_binary() == image_data
+        assert http_root.server.requests[0]['Range'] == 'bytes=%d-' % offset
+        assert not part.check()
+        assert not checkpoint.check()
+
+    def test_changed_image_restarts_download(self, http_root, image_data):
+        http_root.join('image.xz').write_binary(lzma.compress(b'old' * 1000))
+        provider = templates.HttpTemplateProvider(http_root.url, connections=1)
+        dest = http_root.dirpath().join('dest')
+
+        http_root.server.fail_after = 20
+        with pytest.raises(Exception):
+            provider.download_image('image', str(dest))
+
+        http_root.join('image.xz').write_binary(lzma.compress(image_data))
+        assert provider.download_image('image', str(dest)) == \
+            sha1(image_data)
+        assert dest.read_binary() == image_data
+
+    def test_corrupted_partial_download_is_discarded(
+        self, http_root, image_data
+    ):
+        compressed = lzma.compress(image_data)
+        http_root.join('image.xz').write_binary(compressed)
+        provider = templates.HttpTemplateProvider(http_root.url, connections=1)
+        dest = http_root.dirpath().join('dest')
+        part = http_root.dirpath().join('dest.part')
+
+        http_root.server.fail_after = len(compressed) // 2
+        with pytest.raises(Exception):
+            provider.download_image('image', str(dest))
+
+        part.write_binary(b'garbage' + part.read_binary()[7:])
+        del http_root.server.requests[:]
+        assert provider.download_image('image', str(dest)) == \
+            sha1(image_data)
+        assert 'Range' not in http_root.server.requests[0]
+
+
+class TestSegmentedDownload(object):
+    @pytest.fixture(autouse=True)
+    def small_segments(self, monkeypatch):
+        monkeypatch.setattr(templates, 'SEGMENT_MIN_SIZE', 16 * 1024)
+
+    @pytest.fixture
+    def random_data(self):
+        return os.urandom(256 * 1024 + 7)
+
+    def test_download_in_segments(self, http_root, random_data):
+        http_root.join('image').write_binary(random_data)
+        provider = templates.HttpTemplateProvider(http_root.url, connections=4)
+        dest = http_root.dirpath().join('dest')
+
+        assert provider.download_image('image', str(dest)) == \
+            sha1(random_data)
+        assert dest.read_binary() == random_data
+        ranges = [
+            request['Range'] for request in http_root.server.requests
+            if request.get('Range', 'bytes=0-0') != 'bytes=0-0'
+        ]
+        assert len(ranges) == 4
+        assert not http_root.dirpath().join('dest.segments').check()
+
+    def test_compressed_download_in_segments(self, http_root, image_data):
+        http_root.join('image.xz').write_binary(lzma.compress(image_data))
+        provider = templates.HttpTemplateProvider(http_root.url, connections=3)
+        dest = http_root.dirpath().join('dest')
+
+        assert provider.download_image('image', str(dest)) == \
+            sha1(image_data)
+        assert dest.read_binary() == image_data
+
+    def test_fallback_without_accept_ranges(self, http_root, random_data):
+        http_root.join('image').write_binary(random_data)
+        http_root.server.accept_ranges = False
+        provider = templates.HttpTemplateProvider(http_root.url, connections=4)
+        dest = http_root.dirpath().join('dest')
+
+        assert provider.download_image('image', str(dest)) == \
+            sha1(random_data)
+        assert dest.read_binary() == random_data
+        assert not http_root.dirpath().join('dest.segments').check()
+
+    def test_interrupted_download_is_resumed(self, http_root, random_data):
+        http_root.join('image').write_binary(random_data)
+        provider = templates.HttpTemplateProvider(http_root.url, connections=2)
+        dest = http_root.dirpath().join('dest')
+        checkpoint = http_root.dirpath().join('dest.segments.checkpoint')
+
+        http_root.server.fail_after = 1000
+        with pytest.raises(Exception):
+            provider.download_image('image', str(dest))
+
+        segments = json.loads(checkpoint.read())['segments']
+        assert not all(position > end for position, end in segments)
+
+        assert provider.download_image('image', str(dest)) == \
+            sha1(random_data)
+        assert dest.read_binary() == random_data
+        assert not checkpoint.check()
+
+    def _segmented_download(self, http_root, data):
+        http_root.join('image').write_binary(data)
+        return templates.SegmentedDownload(
+            path=str(http_root.dirpath().join('dest.segments')),
+            dest=str(http_root.dirpath().join('dest')),
+            url=http_root.url + '/image',
+            size=len(data),
+            validator=None,
+            connections=2,
+        )
+
+    def test_failed_segment_stops_the_others(
+        self, http_root, random_data, monkeypatch
+    ):
+        monkeypatch.setattr(templates, 'CHUNK_SIZE', 1024)
+        download = self._segmented_download(http_root, random_data)
+        second_start = download.segments[1][0]
+        pwrite = os.pwrite
+
+        def failing_pwrite(fd, data, offset):
+            if offset == second_start:
+                # the second segment only goes on once it was told to stop
+                download._stop.wait(10)
+            elif 4096 <= offset < second_start:
+                raise IOError('disk full')
+            return pwrite(fd, data, offset)
+
+        monkeypatch.setattr(templates.os, 'pwrite', failing_pwrite)
+        with pytest.raises(IOError):
+            download.run()
+
+        assert download.segments[1][0] <= second_start + 1024
+        segments = json.loads(
+            http_root.dirpath().join('dest.segments.checkpoint').read()
+        )['segments']
+        assert segments == download.segments
+
+    def test_checkpoint_is_written_while_downloading(
+        self, http_root, random_data, monkeypatch
+    ):
+        monkeypatch.setattr(templates, 'CHUNK_SIZE', 1024)
+        monkeypatch.setattr(templates, 'CHECKPOINT_INTERVAL', 16 * 1024)
+        download = self._segmented_download(http_root, random_data)
+        checkpoint = http_root.dirpath().join('dest.segments.checkpoint')
+        pwrite = os.pwrite
+        checkpoints = []
+
+        def checking_pwrite(fd, data, offset):
+            if offset == 64 * 1024:
+                checkpoints.append(json.loads(checkpoint.read()))
+            return pwrite(fd, data, offset)
+
+        monkeypatch.setattr(templates.os, 'pwrite', checking_pwrite)
+        assert download.run() == sha1(random_data)
+
+        first_position, _ = checkpoints[0]['segments'][0]
+        assert first_position >= 16 * 1024
+        assert not checkpoint.check()
+
+
+class TemplateVersionMock(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class TestTemplateStoreIndex(object):
+    @pytest.fixture
+    def store(self, tmpdir):
+        return templates.TemplateStore(str(tmpdir.mkdir('store')))
+
+    def _add_image(self, store, name, users=None):
+        store_dir = py.path.local(store._root)
+        store_dir.join(name).write_binary(b'image')
+        store_dir.join(name + '.hash').write('hash-of-%s' % name)
+        store_dir.join(name + '.metadata').write('{"distro": "el7"}')
+        if users is not None:
+            store_dir.join(name + '.users').write(json.dumps(users))
+        return TemplateVersionMock(name)
+
+    def test_index_is_built_from_sidecars(self, store):
+        temp_ver = self._add_image(
+            store, 'repo:tpl:v1', users={
+                'last_access': 10,
+                'users': []
+            }
+        )
+        legacy = self._add_image(store, 'repo:tpl:v2')
+
+        assert temp_ver in store
+        assert legacy in store
+        assert TemplateVersionMock('repo:tpl:v3') not in store
+        assert store.get_stored_hash(temp_ver) == 'hash-of-repo:tpl:v1'
+        assert store.get_stored_metadata(legacy) == {'distro': 'el7'}
+
+        listing = store.list()
+        assert listing['repo:tpl:v1']['last_access'] == 10
+        assert listing['repo:tpl:v1']['refcount'] == 0
+        assert listing['repo:tpl:v2']['refcount'] is None
+        assert py.path.local(store._root).join(templates.INDEX_FILE).check()
+
+    def test_lookups_do_not_touch_sidecars(self, store):
+        temp_ver = self._add_image(store, 'repo:tpl:v1')
+        store.list()
+
+        py.path.local(store._root).join('repo:tpl:v1.hash').remove()
+        py.path.local(store._root).join('repo:tpl:v1.metadata').remove()
+
+        assert temp_ver in store
+        assert store.get_stored_hash(temp_ver) == 'hash-of-repo:tpl:v1'
+        assert store.get_stored_metadata(temp_ver) == {'distro': 'el7'}
+
+    def test_missing_image_is_dropped_from_index(self, store):
+        temp_ver = self._add_image(store, 'repo:tpl:v1')
+        store.list()
+
+        py.path.local(store._root).join('repo:tpl:v1').remove()
+
+        assert temp_ver not in store
+        assert 'repo:tpl:v1' not in store.list()
+        with pytest.raises(RuntimeError):
+            store.get_path(temp_ver)
+
+    def test_index_changes_are_seen_by_other_instances(self, store, tmpdir):
+        temp_ver = self._add_image(store, 'repo:tpl:v1')
+        other_store = templates.TemplateStore(store._root)
+        assert temp_ver in other_store
+
+        uuid_file = tmpdir.join('uuid')
+        uuid_file.write('some-uuid')
+        store.mark_used(temp_ver, str(uuid_file))
+
+        assert other_store.list()['repo:tpl:v1']['refcount'] == 1
+
+
+class TestTemplateStoreGC(object):
+    @pytest.fixture
+    def store(self, tmpdir):
+        return templates.TemplateStore(str(tmpdir.mkdir('store')))
+
+    @pytest.fixture
+    def prefix_uuid(self, tmpdir):
+        uuid_file = tmpdir.join('uuid')
+        uuid_file.write('some-uuid')
+        return str(uuid_file)
+
+    def _add_image(self, store, name, size=64 * 1024):
+        store_dir = py.path.local(store._root)
+        store_dir.join(name).write_binary(os.urandom(size))
+        store_dir.join(name + '.hash').write('hash')
+        store_dir.join(name + '.metadata').write('{}')
+        return TemplateVersionMock(name)
+
+    def _set_last_access(self, store, temp_ver, last_access):
+        with store._edit_index() as index:
+            index['usage'][temp_ver.name]['last_access'] = last_access
+
+    def test_mark_used_drops_dead_users(self, store, prefix_uuid, tmpdir):
+        temp_ver = self._add_image(store, 'repo:tpl:v1')
+        dead_uuid = tmpdir.join('dead_uuid')
+        dead_uuid.write('dead')
+        store.mark_used(temp_ver, str(dead_uuid))
+        dead_uuid.remove()
+
+        store.mark_used(temp_ver, prefix_uuid)
+        store.mark_used(temp_ver, prefix_uuid)
+
+        users = store._index()['usage'][temp_ver.name]
+        assert users['users'] == [[prefix_uuid, 'some-uuid']]
+
+    def test_evicts_least_recently_used_first(self, store, tmpdir):
+        gone_uuid = tmpdir.join('gone_uuid')
+        gone_uuid.write('gone')
+        versions = [
+            self._add_image(store, 'repo:tpl:v%d' % idx) for idx in range(3)
+        ]
+        for idx, temp_ver in enumerate(versions):
+            store.mark_used(temp_ver, str(gone_uuid))
+            self._set_last_access(store, temp_ver, 100 - idx)
+        gone_uuid.remove()
+
+        evicted = store.gc(quota=2 * 64 * 1024)
+
+        assert evicted == ['repo:tpl:v2']
+        assert not py.path.local(store._root).join('repo:tpl:v2').check()
+        assert versions[0] in store
+        assert versions[1] in store
+
+    def test_never_evicts_used_or_unknown_templates(self, store, prefix_uuid):
+        used = self._add_image(store, 'repo:tpl:used')
+        legacy = self._add_image(store, 'repo:tpl:legacy')
+        store.mark_used(used, prefix_uuid)
+
+        assert store.gc(quota=0) == []
+        assert used in store
+        assert legacy in store
+
+    def test_skips_templates_being_downloaded(self, store, tmpdir):
+        gone_uuid = tmpdir.join('gone_uuid')
+        gone_uuid.write('gone')
+        temp_ver = self._add_image(store, 'repo:tpl:v1')
+        store.mark_used(temp_ver, str(gone_uuid))
+        gone_uuid.remove()
+
+        lock_path = os.path.join(store._root, temp_ver.name + '.lock')
+        with utils.LockFile(lock_path):
+            assert store.gc(quota=0) == []
+        assert store.gc(quota=0) == [temp_ver.name]
+
+
+class TestTemplateRepositoryCache(object):
+    @pytest.fixture(autouse=True)
+    def cache_dir(self, tmpdir, monkeypatch):
+        cache_dir = tmpdir.mkdir('cache')
+        monkeypatch.setattr(
+            templates, '_repos_cache_dir', lambda: str(cache_dir)
+        )
+        monkeypatch.setattr(templates, '_REPOS_CACHE', {})
+        return cache_dir
+
+    def _repo_spec(self, name):
+        return {
+            'name': name,
+            'sources': {},
+            'templates': {},
+        }
+
+    def test_find_repo_by_name(self, tmpdir):
+        repos = tmpdir.mkdir('repos')
+        repos.join('first.json').write(json.dumps(self._repo_spec('first')))
+        repos.mkdir('sub').join('second.json').write(
+            json.dumps(self._repo_spec('second'))
+        )
+        repos.join('not_a_repo.txt').write('garbage')
+
+        repo = templates.find_repo_by_name('second', repo_dir=str(repos))
+        assert repo.name == 'second'
+        assert repo.path == str(repos.join('sub', 'second.json'))
+
+        with pytest.raises(RuntimeError):
+            templates.find_repo_by_name('third', repo_dir=str(repos))
+
+    def test_find_repo_only_parses_changed_files(self, tmpdir, monkeypatch):
+        repos = tmpdir.mkdir('repos')
+        repos.join('first.json').write(json.dumps(self._repo_spec('first')))
+        repos.join('second.json').write(json.dumps(self._repo_spec('second')))
+        templates.find_repo_by_name('first', repo_dir=str(repos))
+
+        # a new process, with an empty in memory cache
+        monkeypatch.setattr(templates, '_REPOS_CACHE', {})
+        loaded = []
+        load_repo_file = templates._load_repo_file
+
+        def tracking_load(path):
+            loaded.append(os.path.basename(path))
+            return load_repo_file(path)
+
+        monkeypatch.setattr(templates, '_load_repo_file', tracking_load)
+        assert templates.find_repo_by_name(
+            'second', repo_dir=str(repos)
+        ).name == 'second'
+        assert loaded == ['second.json']
+
+    def test_file_repo_is_reparsed_when_modified(self, tmpdir):
+        repo_file = tmpdir.join('repo.json')
+        repo_file.write(json.dumps(self._repo_spec('old')))
+        assert templates.TemplateRepository.from_url(str(repo_file)
+                                                     ).name == 'old'
+
+        repo_file.write(json.dumps(self._repo_spec('renamed')))
+        assert templates.TemplateRepository.from_url(str(repo_file)
+                                                     ).name == 'renamed'
+
+    def test_http_repo_is_revalidated(self, http_root, monkeypatch):
+        http_root.join('repo.json').write(
+            json.dumps(self._repo_spec('remote'))
+        )
+        url = http_root.url + '/repo.json'
+
+        assert templates.TemplateRepository.from_url(url).name == 'remote'
+        assert 'If-None-Match' not in http_root.server.requests[-1]
+
+        # a new process, it should use the on disk cache
+        monkeypatch.setattr(templates, '_REPOS_CACHE', {})
+        assert templates.TemplateRepository.from_url(url).name == 'remote'
+        assert 'If-None-Match' in http_root.server.requests[-1]
+
+        http_root.join('repo.json').write(
+            json.dumps(self._repo_spec('changed'))
+        )
+        assert templates.TemplateRepository.from_url(url).name == 'changed'
+
+
+class TestTemplateStoreFormat(object):
+    def _store(self, tmpdir, **kwargs):
+        return templates.TemplateStore(str(tmpdir.join('store')), **kwargs)
+
+    def _add_image(self, store, name, **entry):
+        store_dir = py.path.local(store._root)
+        store_dir.join(name).write_binary(b'image')
+        with store._edit_index() as index:
+            index['templates'][name] = dict(
+                {
+                    'path': str(store_dir.join(name)),
+                    'size': 1,
+                    'hash': 'hash',
+                    'metadata': {},
+                }, **entry
+            )
+        return TemplateVersionMock(name)
+
+    def test_unsupported_format(self, tmpdir):
+        with pytest.raises(utils.LagoUserException):
+            self._store(tmpdir, image_format='vmdk')
+
+    @pytest.mark.parametrize(
+        'image_format,expected_options', [
+            ('raw', ['-O', 'raw', '-S', '4k']),
+            ('qcow2', ['-O', 'qcow2']),
+            ('qcow2-compressed', ['-O', 'qcow2', '-c']),
+        ]
+    )
+    def test_convert_options(self, tmpdir, image_format, expected_options):
+        store = self._store(tmpdir, image_format=image_format)
+        run_command_patch = mock.patch(
+            'lago.utils.run_command',
+            return_value=utils.CommandStatus(0, '', ''),
+        )
+        with mock.patch('lago.utils.get_qemu_info', return_value={}), \
+                run_command_patch as run_command:
+            stored = store._store_image('repo:tpl:v1', 'src', 'dest')
+
+        assert stored == (expected_options[1], None)
+        command = run_command.call_args[0][0]
+        assert command[2:-2] == expected_options
+        assert command[-2:] == ['src', 'dest']
+
+    def test_layered_template_is_kept_as_layer(self, tmpdir):
+        store = self._store(tmpdir, share_layers=True)
+        self._add_image(store, 'repo:tpl:v1', format='qcow2')
+        src = tmpdir.join('src')
+        src.write('layer')
+        dest = tmpdir.join('dest')
+
+        with mock.patch(
+            'lago.utils.get_qemu_info',
+            return_value={'backing-filename': './tpl:v1'},
+        ), mock.patch('lago.utils.qemu_rebase') as qemu_rebase:
+            stored = store._store_image('repo:tpl:v2', str(src), str(dest))
+
+        assert stored == ('qcow2', 'repo:tpl:v1')
+        qemu_rebase.assert_called_once_with(
+            target=str(src),
+            backing_file=os.path.join(store._root, 'repo:tpl:v1'),
+            backing_format='qcow2',
+            safe=False,
+        )
+        assert dest.read() == 'layer'
+
+    def test_layered_template_without_base_fails(self, tmpdir):
+        store = self._store(tmpdir, share_layers=True)
+        with mock.patch(
+            'lago.utils.get_qemu_info',
+            return_value={'backing-filename': './tpl:v1'},
+        ), pytest.raises(RuntimeError):
+            store._store_image('repo:tpl:v2', 'src', 'dest')
+
+    def test_stored_format(self, tmpdir):
+        store = self._store(tmpdir)
+        legacy = self._add_image(store, 'repo:tpl:v1')
+        layer = self._add_image(store, 'repo:tpl:v2', format='qcow2')
+
+        assert store.get_stored_format(legacy) == 'raw'
+        assert store.get_stored_format(layer) == 'qcow2'
+
+    def test_gc_keeps_bases_of_stored_layers(self, tmpdir):
+        store = self._store(tmpdir)
+        base = self._add_image(store, 'repo:tpl:v1', format='raw')
+        self._add_image(
+            store, 'repo:tpl:v2', format='qcow2', backing='repo:tpl:v1'
+        )
+        with store._edit_index() as index:
+            for name in index['templates']:
+                index['usage'][name] = {'last_access': 0, 'users': []}
+
+        assert store.gc(quota=0) == ['repo:tpl:v2']
+        assert base in store
+        assert store.gc(quota=0) == ['repo:tpl:v1']
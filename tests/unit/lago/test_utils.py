@@ -1,14 +1,18 @@
 from __future__ import absolute_import
 
 import json
+import lzma
 import os
+import threading
+import time
 import yaml
+import mock
 
 from six import StringIO
 
 import pytest
 
-from lago import utils
+from lago import compression, utils
 
 
 def deep_compare(original_obj, copy_obj):
@@ -143,3 +147,122 @@ def test_temporary_directory_should_respect_ignoring_errors_in():
     with pytest.raises(OSError):
         with utils.TemporaryDirectory(ignore_errors=False) as tmpdir_path:
             os.rmdir(tmpdir_path)
+
+
+class TestInvokeInParallel(object):
+    def test_results_keep_order(self):
+        results = utils.invoke_in_parallel(
+            lambda x, y: x * y, [1, 2, 3], [4, 5, 6], max_workers=2
+        )
+        assert results == [4, 10, 18]
+
+    def test_max_workers_bounds_concurrency(self):
+        lock = threading.Lock()
+        running = []
+        max_running = []
+
+        def work(_):
+            with lock:
+                running.append(1)
+                max_running.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+
+        utils.invoke_in_parallel(work, range(8), max_workers=3)
+        assert max(max_running) <= 3
+
+    def test_waits_for_all_before_raising(self):
+        finished = []
+
+        def work(idx):
+            if idx == 0:
+                raise RuntimeError('failed %s' % idx)
+            time.sleep(0.05)
+            finished.append(idx)
+
+        with pytest.raises(RuntimeError):
+            utils.invoke_in_parallel(work, range(4), max_workers=2)
+
+        assert sorted(finished) == [1, 2, 3]
+
+
+def test_lock_file_without_timeout_works_from_threads(tmpdir):
+    lock_path = str(tmpdir.join('lock'))
+
+    def take_lock():
+        with utils.LockFile(lock_path):
+            return True
+
+    results = utils.invoke_different_funcs_in_parallel(take_lock, take_lock)
+    assert results == [True, True]
+
+
+class TestHashAndCompress(object):
+    @pytest.fixture
+    def data_file(self, tmpdir):
+        data_file = tmpdir.join('disk')
+        data_file.write_binary(os.urandom(1024) * 3000)
+        return data_file
+
+    @pytest.fixture
+    def xz(self):
+        return compression.get_codec('xz')
+
+    def test_hash_only(self, data_file):
+        assert utils.hash_and_compress(str(data_file)) == \
+            utils.get_hash(str(data_file))
+
+    def test_hash_and_compress(self, tmpdir, data_file, xz):
+        compressed = tmpdir.join('disk.xz')
+        sha = utils.hash_and_compress(
+            str(data_file),
+            'sha256',
+            compress_to=str(compressed),
+            compress_cmd=xz.compress_cmd(block_size=65536),
+        )
+
+        assert sha == utils.get_hash(str(data_file), 'sha256')
+        assert lzma.decompress(compressed.read_binary()) == \
+            data_file.read_binary()
+
+    def test_compress_failure(self, tmpdir, data_file, xz):
+        with pytest.raises(RuntimeError):
+            utils.hash_and_compress(
+                str(data_file),
+                compress_to=str(tmpdir.join('disk.xz')),
+                compress_cmd=xz.compress_cmd(block_size='bad'),
+            )
+
+    def test_compress_without_command(self, tmpdir, data_file):
+        with pytest.raises(ValueError):
+            utils.hash_and_compress(
+                str(data_file),
+                compress_to=str(tmpdir.join('disk.xz')),
+            )
+
+    def test_read_failure(self, tmpdir, data_file, xz):
+        source = open(str(data_file), 'rb')
+        reads = [source.read(utils.HASH_CHUNK_SIZE), IOError('bad sector')]
+
+        def _open(path, mode='r'):
+            if path == str(data_file):
+                source.read = mock.Mock(side_effect=reads)
+                return source
+            return open(path, mode)
+
+        with mock.patch('lago.utils.open', side_effect=_open, create=True):
+            with pytest.raises(IOError):
+                utils.hash_and_compress(
+                    str(data_file),
+                    compress_to=str(tmpdir.join('disk.xz')),
+                    compress_cmd=xz.compress_cmd(),
+                )
+
+    def test_compressor_exits_early(self, tmpdir, data_file):
+        with pytest.raises(RuntimeError):
+            utils.hash_and_compress(
+                str(data_file),
+                compress_to=str(tmpdir.join('disk.xz')),
+                compress_cmd=['head', '-c', '10'],
+            )
@@ -0,0 +1,240 @@
+from __future__ import absolute_import
+
+import threading
+import time
+
+import mock
+import pytest
+
+from lago import utils, virt
+
+
+def _fake_vm(name, depends_on=None, events=None):
+    vm = mock.Mock()
+    vm.name.return_value = name
+    vm.spec = {}
+    if depends_on is not None:
+        vm.spec['depends-on'] = depends_on
+    vm.nets.return_value = []
+    if events is not None:
+        vm.start.side_effect = lambda: events.append(('start', name))
+        vm.stop.side_effect = lambda: events.append(('stop', name))
+    return vm
+
+
+def _names(waves):
+    return [sorted(vm.name() for vm in wave) for wave in waves]
+
+
+@pytest.fixture
+def prefix(tmpdir):
+    uuid_file = tmpdir.join('uuid')
+    uuid_file.write('uuid')
+    prefix = mock.Mock()
+    prefix.paths.uuid.return_value = str(uuid_file)
+    prefix.metadata = {}
+    return prefix
+
+
+@pytest.fixture
+def make_env(prefix):
+    def _make_env(vm_specs=None):
+        return virt.VirtEnv(prefix, vm_specs or {}, {})
+
+    return _make_env
+
+
+@pytest.fixture
+def shared_connection():
+    with mock.patch.object(
+        virt.libvirt_utils, 'get_shared_connection'
+    ) as get_shared_connection:
+        con = get_shared_connection.return_value.con
+        con.getAllDomainStats.return_value = []
+        con.listAllNetworks.return_value = []
+        yield con
+
+
+class TestStateSnapshot(object):
+    def test_snapshot(self, make_env, shared_connection):
+        env = make_env()
+        with env.state_snapshot() as snapshot:
+            assert env.current_state_snapshot is snapshot
+
+        assert env.current_state_snapshot is None
+
+    def test_nested_snapshots_are_shared(self, make_env, shared_connection):
+        env = make_env()
+        with env.state_snapshot() as outer:
+            with env.state_snapshot() as inner:
+                assert inner is outer
+            assert env.current_state_snapshot is outer
+
+        assert shared_connection.getAllDomainStats.call_count == 1
+
+    def test_envs_do_not_share_snapshots(self, make_env, shared_connection):
+        env, other_env = make_env(), make_env()
+        with env.state_snapshot():
+            assert other_env.current_state_snapshot is None
+            with other_env.state_snapshot() as other:
+                assert env.current_state_snapshot is not other
+
+
+class TestStartWaves(object):
+    def test_waves(self):
+        vms = [
+            _fake_vm('engine', ['db', 'storage']),
+            _fake_vm('db'),
+            _fake_vm('storage'),
+            _fake_vm('host', 'engine'),
+            _fake_vm('other'),
+        ]
+
+        waves = virt._start_waves(vms, [vm.name() for vm in vms])
+
+        assert _names(waves) == [
+            ['db', 'other', 'storage'],
+            ['engine'],
+            ['host'],
+        ]
+
+    def test_dependencies_not_started_are_up(self):
+        vms = [_fake_vm('host', ['engine'])]
+
+        waves = virt._start_waves(vms, ['engine', 'host'])
+
+        assert _names(waves) == [['host']]
+
+    def test_unknown_dependency(self):
+        vms = [_fake_vm('host', ['engine', 'missing'])]
+
+        with pytest.raises(utils.LagoUserException) as excinfo:
+            virt._start_waves(vms, ['engine', 'host'])
+
+        assert 'missing' in str(excinfo.value)
+
+    def test_cycle(self):
+        vms = [
+            _fake_vm('a', ['c']),
+            _fake_vm('b', ['a']),
+            _fake_vm('c', ['b']),
+            _fake_vm('d'),
+        ]
+
+        with pytest.raises(utils.LagoUserException) as excinfo:
+            virt._start_waves(vms, [vm.name() for vm in vms])
+
+        assert 'a, b, c' in str(excinfo.value)
+
+
+class TestStart(object):
+    @pytest.fixture
+    def env(self, make_env):
+        return make_env()
+
+    def test_waves_start_in_order(self, env):
+        events = []
+        env._vms = {
+            vm.name(): vm
+            for vm in (
+                _fake_vm('db', events=events),
+                _fake_vm('engine', ['db'], events=events),
+            )
+        }
+
+        env.start()
+
+        assert events == [('start', 'db'), ('start', 'engine')]
+
+    def test_start_workers_bounds_concurrency(self, env):
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+
+        def _start():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+
+        env._vms = {}
+        for idx in range(6):
+            vm = _fake_vm('vm{}'.format(idx))
+            vm.start.side_effect = _start
+            env._vms[vm.name()] = vm
+
+        with mock.patch.object(
+            virt.config,
+            'get',
+            side_effect={'start_workers': '2'}.get,
+        ):
+            env.start()
+
+        assert peak[0] == 2
+
+    def test_failed_start_stops_started_vms(self, env):
+        events = []
+        failing = _fake_vm('engine', ['db'])
+        failing.start.side_effect = RuntimeError('failed')
+        env._vms = {
+            'db': _fake_vm('db', events=events),
+            'engine': failing,
+        }
+
+        with pytest.raises(RuntimeError):
+            env.start()
+
+        assert events == [('start', 'db'), ('stop', 'db')]
+
+
+class TestSelectVMs(object):
+    @pytest.fixture
+    def env(self, make_env):
+        env = make_env()
+        env._vms = {}
+        for name, groups, vm_type in (
+            ('engine', ['ovirt'], 'ovirt-engine'),
+            ('host0', ['ovirt', 'hosts'], 'ovirt-host'),
+            ('host1', 'hosts', 'ovirt-host'),
+            ('storage', [], 'default'),
+        ):
+            vm = _fake_vm(name)
+            vm.groups = groups
+            vm.vm_type = vm_type
+            env._vms[name] = vm
+        return env
+
+    @pytest.mark.parametrize(
+        'criteria,expected', [
+            ({}, ['engine', 'host0', 'host1', 'storage']),
+            ({
+                'names': ['storage', 'engine']
+            }, ['engine', 'storage']),
+            ({
+                'groups': ['hosts']
+            }, ['host0', 'host1']),
+            ({
+                'vm_types': ['ovirt-engine', 'default']
+            }, ['engine', 'storage']),
+            (
+                {
+                    'names': ['storage'],
+                    'groups': ['ovirt'],
+                    'vm_types': ['ovirt-host'],
+                }, ['engine', 'host0', 'host1', 'storage']
+            ),
+            ({
+                'groups': ['missing']
+            }, []),
+        ]
+    )
+    def test_select(self, env, criteria, expected):
+        assert [vm.name() for vm in env.select_vms(**criteria)] == expected
+
+    def test_unknown_name(self, env):
+        with pytest.raises(utils.LagoUserException) as excinfo:
+            env.select_vms(names=['engine', 'missing'], groups=['hosts'])
+
+        assert 'missing' in str(excinfo.value)
@@ -0,0 +1,378 @@
+import contextlib
+import functools
+import json
+import os
+import subprocess
+
+import mock
+import pytest
+
+from lago import ssh
+from lago.plugins import vm
+
+
+class LocalChannel(object):
+    """
+    Runs the 'remote' commands locally, in place of a paramiko.Channel
+    """
+
+    def exec_command(self, command):
+        self.proc = subprocess.Popen(
+            ['sh', '-c', command],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+    def makefile(self, mode):
+        return self.proc.stdin if 'w' in mode else self.proc.stdout
+
+    def makefile_stderr(self, mode):
+        return self.proc.stderr
+
+    def sendall(self, data):
+        self.proc.stdin.write(data)
+        self.proc.stdin.flush()
+
+    def shutdown_write(self):
+        self.proc.stdin.close()
+
+    def recv_exit_status(self):
+        return self.proc.wait()
+
+    def close(self):
+        for stream in (self.proc.stdout, self.proc.stderr):
+            stream.close()
+
+
+def _ssh_with(channel_class):
+    @contextlib.contextmanager
+    def _ssh(propagate_fail=True):
+        client = mock.Mock()
+        client.get_transport.return_value.open_session.side_effect = \
+            channel_class
+        yield client
+
+    return _ssh
+
+
+@pytest.fixture
+def fake_vm():
+    fake = mock.Mock()
+    fake._ssh = _ssh_with(LocalChannel)
+    return fake
+
+
+@pytest.fixture
+def src_tree(tmpdir):
+    src = tmpdir.mkdir('src')
+    src.join('file').write('content')
+    src.mkdir('sub').join('nested').write('nested content')
+    src.join('sub', 'link').mksymlinkto('nested')
+    return src
+
+
+def _tree(path):
+    return sorted(
+        os.path.relpath(os.path.join(root, name), str(path))
+        for root, dirs, files in os.walk(str(path)) for name in dirs + files
+    )
+
+
+@pytest.mark.parametrize('compress', [False, True])
+class TestTarCopy(object):
+    def test_copy_to_new_path(self, tmpdir, fake_vm, src_tree, compress):
+        dest = tmpdir.join('dest')
+        vm.VMPlugin._tar_copy_to(fake_vm, str(src_tree), str(dest), compress)
+
+        assert _tree(dest) == _tree(src_tree)
+        assert dest.join('sub', 'nested').read() == 'nested content'
+        assert dest.join('sub', 'link').readlink() == 'nested'
+
+    def test_copy_to_existing_dir(self, tmpdir, fake_vm, src_tree, compress):
+        dest = tmpdir.mkdir('dest')
+        vm.VMPlugin._tar_copy_to(fake_vm, str(src_tree), str(dest), compress)
+
+        assert _tree(dest.join('src')) == _tree(src_tree)
+
+    def test_copy_from_new_path(self, tmpdir, fake_vm, src_tree, compress):
+        dest = tmpdir.join('dest')
+        vm.VMPlugin._tar_copy_from(
+            fake_vm, str(src_tree), str(dest), compress, True
+        )
+
+        assert _tree(dest) == _tree(src_tree)
+        assert dest.join('file').read() == 'content'
+
+    def test_copy_from_existing_dir(self, tmpdir, fake_vm, src_tree, compress):
+        dest = tmpdir.mkdir('dest')
+        vm.VMPlugin._tar_copy_from(
+            fake_vm,
+            str(src_tree) + '/', str(dest), compress, True
+        )
+
+        assert _tree(dest.join('src')) == _tree(src_tree)
+
+    def test_copy_from_missing_path(self, tmpdir, fake_vm, compress):
+        with pytest.raises(vm.ExtractPathNoPathError):
+            vm.VMPlugin._tar_copy_from(
+                fake_vm,
+                str(tmpdir.join('missing')),
+                str(tmpdir.join('dest')),
+                compress,
+                True,
+            )
+
+
+@pytest.fixture
+def fake_provider(fake_vm):
+    provider = mock.Mock()
+    provider.vm = fake_vm
+    provider._get_collect_compression.side_effect = lambda compression: \
+        compression
+    return provider
+
+
+@pytest.mark.parametrize('compression', ['none', 'gzip', 'zstd'])
+class TestExtractPathsTar(object):
+    def test_extract(self, tmpdir, fake_provider, src_tree, compression):
+        out = tmpdir.mkdir('out')
+        paths = [
+            (str(src_tree), str(out.join('tree'))),
+            (str(src_tree.join('file')), str(out.join('file'))),
+        ]
+        vm.VMProviderPlugin._extract_paths_tar(
+            fake_provider, paths, False, compression
+        )
+
+        assert _tree(out.join('tree')) == _tree(src_tree)
+        assert out.join('tree', 'sub', 'nested').read() == 'nested content'
+        # symlinks are followed
+        assert not out.join('tree', 'sub', 'link').islink()
+        assert out.join('file').read() == 'content'
+
+    def test_missing_path(self, tmpdir, fake_provider, src_tree, compression):
+        out = tmpdir.mkdir('out')
+        paths = [
+            (str(tmpdir.join('missing')), str(out.join('missing'))),
+            (str(src_tree.join('file')), str(out.join('file'))),
+        ]
+        with pytest.raises(vm.ExtractPathNoPathError):
+            vm.VMProviderPlugin._extract_paths_tar(
+                fake_provider, paths, False, compression
+            )
+
+        vm.VMProviderPlugin._extract_paths_tar(
+            fake_provider, paths, True, compression
+        )
+        assert out.join('file').read() == 'content'
+        assert not out.join('missing').exists()
+
+
+class TestExtractPathsTarFailures(object):
+    def _extract(self, fake_provider, paths, compression, *replacements):
+        class _Channel(LocalChannel):
+            def exec_command(self, command):
+                for old, new in replacements:
+                    command = command.replace(old, new)
+                super().exec_command(command)
+
+        fake_provider.vm._ssh = _ssh_with(_Channel)
+        vm.VMProviderPlugin._extract_paths_tar(
+            fake_provider, paths, True, compression
+        )
+
+    def test_all_paths_missing(self, tmpdir, fake_provider):
+        out = tmpdir.mkdir('out')
+        self._extract(
+            fake_provider,
+            [(str(tmpdir.join('missing')), str(out.join('missing')))],
+            'gzip',
+        )
+
+        assert out.listdir() == []
+
+    def test_truncated_archive(self, tmpdir, fake_provider, src_tree):
+        src_tree.join('big').write('x' * 4096)
+        out = tmpdir.mkdir('out')
+        with pytest.raises(vm.ExtractPathError):
+            self._extract(
+                fake_provider,
+                [(str(src_tree), str(out.join('tree')))],
+                'none',
+                ('-T -;', '-T - | head -c 2048; (exit 2);'),
+            )
+
+    def test_compressor_failure(self, tmpdir, fake_provider, src_tree):
+        out = tmpdir.mkdir('out')
+        with pytest.raises(vm.ExtractPathError):
+            self._extract(
+                fake_provider,
+                [(str(src_tree), str(out.join('tree')))],
+                'gzip',
+                ('gzip -c', 'gzip -c | head -c 64; exit 1'),
+            )
+
+
+class TestCollectCompression(object):
+    @pytest.mark.parametrize(
+        'tools,local_zstd,expected', [
+            (set(['tar', 'gzip', 'zstd']), True, 'zstd'),
+            (set(['tar', 'gzip', 'zstd']), False, 'gzip'),
+            (set(['tar', 'gzip']), True, 'gzip'),
+            (set(['tar']), True, 'none'),
+        ]
+    )
+    def test_auto(self, tools, local_zstd, expected):
+        provider = mock.Mock()
+        provider._get_guest_tools.return_value = tools
+        with mock.patch(
+            'shutil.which',
+            return_value='/usr/bin/zstd' if local_zstd else None
+        ):
+            assert vm.VMProviderPlugin._get_collect_compression(
+                provider, 'auto'
+            ) == expected
+
+    @pytest.mark.parametrize('compression', ['gzip', 'bzip2'])
+    def test_unavailable(self, compression):
+        provider = mock.Mock()
+        provider._get_guest_tools.return_value = set(['tar'])
+        with pytest.raises(vm.utils.LagoUserException):
+            vm.VMProviderPlugin._get_collect_compression(provider, compression)
+
+
+class TestListPaths(object):
+    def test_list(self, tmpdir, fake_provider, src_tree):
+        root = str(src_tree)
+        listing = vm.VMProviderPlugin.list_paths(
+            fake_provider,
+            [root + '/', root + '/file',
+             str(tmpdir.join('missing'))],
+        )
+
+        assert sorted(listing) == [root + '/', root + '/file']
+        tree = listing[root + '/']
+        assert sorted(tree['dirs']) == [root, root + '/sub']
+        assert sorted(tree['files']) == [
+            root + '/file',
+            root + '/sub/link',
+            root + '/sub/nested',
+        ]
+        assert tree['files'][root + '/file'][0] == len('content')
+        assert list(listing[root + '/file']['files']) == [root + '/file']
+
+
+@pytest.fixture
+def incremental_vm(fake_provider, src_tree):
+    fake = mock.Mock()
+    fake.name.return_value = 'vm0'
+    fake.provider = fake_provider
+    fake_provider._has_tar.return_value = True
+    fake_provider.list_paths.side_effect = functools.partial(
+        vm.VMProviderPlugin.list_paths, fake_provider
+    )
+    fake.extract_paths.side_effect = functools.partial(
+        vm.VMProviderPlugin._extract_paths_tar, fake_provider
+    )
+    fake._collect_artifacts_incremental = functools.partial(
+        vm.VMPlugin._collect_artifacts_incremental, fake
+    )
+    fake._artifact_paths.return_value = [
+        str(src_tree), str(src_tree.join('file'))
+    ]
+    return fake
+
+
+def _collect(fake, path, previous_path=None, ignore_nopath=False):
+    path.ensure(dir=True)
+    vm.VMPlugin.collect_artifacts(
+        fake,
+        str(path),
+        ignore_nopath,
+        compression='none',
+        incremental=True,
+        previous_path=previous_path and str(previous_path),
+    )
+
+
+class TestIncrementalCollect(object):
+    def test_first_collection(self, tmpdir, incremental_vm, src_tree):
+        out = tmpdir.join('out')
+        _collect(incremental_vm, out)
+
+        tree = out.join(str(src_tree).replace('/', '_'))
+        assert _tree(tree) == _tree(src_tree)
+        assert tree.join('sub', 'nested').read() == 'nested content'
+        manifest = json.loads(out.join(vm.COLLECT_MANIFEST).read())
+        assert len(manifest) == 4
+
+    def test_only_changes_are_transferred(
+        self, tmpdir, incremental_vm, src_tree
+    ):
+        first = tmpdir.join('first')
+        _collect(incremental_vm, first)
+        src_tree.join('sub', 'nested').write('changed content')
+        src_tree.join('new').write('new content')
+
+        second = tmpdir.join('second')
+        _collect(incremental_vm, second, previous_path=first)
+
+        to_extract, = incremental_vm.extract_paths.call_args[0]
+        assert sorted(guest for guest, _ in to_extract) == [
+            str(src_tree.join('new')),
+            str(src_tree.join('sub', 'link')),
+            str(src_tree.join('sub', 'nested')),
+        ]
+        tree = second.join(str(src_tree).replace('/', '_'))
+        assert _tree(tree) == _tree(src_tree)
+        assert tree.join('sub', 'nested').read() == 'changed content'
+        assert tree.join('new').read() == 'new content'
+        assert tree.join('file').read() == 'content'
+        assert os.path.samefile(
+            str(tree.join('file')),
+            str(first.join(str(src_tree).replace('/', '_'), 'file')),
+        )
+
+    def test_missing_path(self, tmpdir, incremental_vm, src_tree):
+        incremental_vm._artifact_paths.return_value.append(
+            str(tmpdir.join('missing'))
+        )
+        with pytest.raises(vm.ExtractPathNoPathError):
+            _collect(incremental_vm, tmpdir.join('out'))
+
+        out = tmpdir.join('out')
+        _collect(incremental_vm, out, ignore_nopath=True)
+        assert out.join(str(src_tree.join('file')).replace('/', '_')).read() \
+            == 'content'
+
+    def test_stopped_vm(self, tmpdir, incremental_vm, src_tree):
+        provider = incremental_vm.provider
+        provider.running.return_value = False
+        provider._has_tar.side_effect = functools.partial(
+            vm.VMProviderPlugin._has_tar, provider
+        )
+        incremental_vm.extract_paths.side_effect = None
+
+        out = tmpdir.join('out')
+        _collect(incremental_vm, out)
+
+        provider.list_paths.assert_not_called()
+        incremental_vm.extract_paths.assert_called_once_with(
+            [
+                (path, str(out.join(path.replace('/', '_'))))
+                for path in (str(src_tree), str(src_tree.join('file')))
+            ],
+            ignore_nopath=False,
+            compression='none',
+        )
+        assert not out.join(vm.COLLECT_MANIFEST).check()
+
+    def test_unreachable_vm(self, tmpdir, incremental_vm):
+        incremental_vm.provider.list_paths.side_effect = \
+            ssh.LagoSSHTimeoutException()
+        incremental_vm.extract_paths.side_effect = None
+
+        _collect(incremental_vm, tmpdir.join('out'))
+
+        incremental_vm.extract_paths.assert_called_once()